@@ -15,6 +15,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.circuit_breaker import backoff_delay
 from common import const
 from config import conf, load_config
 
@@ -83,7 +84,7 @@ class AliQwenBot(Bot):
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
+                reply = Reply(ReplyType.TEXT, reply_content["content"], cacheable=True)
             else:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
                 logger.debug("[QWEN] reply {} used 0 tokens.".format(reply_content))
@@ -113,23 +114,23 @@ class AliQwenBot(Bot):
                 "content": completion_content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            need_retry = retry_count < conf().get("request_max_retries", 2)
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[QWEN] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
                 if need_retry:
-                    time.sleep(20)
+                    time.sleep(backoff_delay(retry_count, 20))
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[QWEN] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
                 if need_retry:
-                    time.sleep(5)
+                    time.sleep(backoff_delay(retry_count, 5))
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[QWEN] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
                 if need_retry:
-                    time.sleep(10)
+                    time.sleep(backoff_delay(retry_count, 10))
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[QWEN] APIConnectionError: {}".format(e))
                 need_retry = False
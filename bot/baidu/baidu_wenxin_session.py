@@ -1,5 +1,6 @@
 from bot.session_manager import Session
 from common.log import logger
+from config import conf
 
 """
     e.g.  [
@@ -26,6 +27,10 @@ class BaiduWenxinSession(Session):
             if cur_tokens is None:
                 raise e
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+        if precise and cur_tokens > max_tokens and conf().get("prompt_cache", False):
+            excess = cur_tokens - max_tokens * conf().get("prompt_cache_trim_ratio", 0.5)
+            del self.messages[: self.block_discard_index(0, excess, lambda i: len(self.messages[i]["content"]))]
+            cur_tokens = self.calc_tokens()
         while cur_tokens > max_tokens:
             if len(self.messages) >= 2:
                 self.messages.pop(0)
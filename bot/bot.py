@@ -2,9 +2,9 @@
 Auto-replay chat robot abstract class
 """
 
-
 from bridge.context import Context
 from bridge.reply import Reply
+from common.event_loop import run_sync
 
 
 class Bot(object):
@@ -15,3 +15,12 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def async_reply(self, query, context: Context = None) -> Reply:
+        """
+        asyncio mode auto-reply, by default runs the sync reply in the event loop's thread pool.
+        bots with a native async client should override it
+        :param req: received message
+        :return: reply content
+        """
+        return await run_sync(self.reply, query, context)
@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
@@ -12,26 +13,38 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import stream
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common import token_bucket
+from common.circuit_breaker import backoff_delay
+from common.single_flight import SingleFlight, make_key
 from config import conf, load_config
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
+# 合并相同的并发请求，如同一条消息被转发到多个群时只请求一次
+_flight = SingleFlight("chatgpt")
+
+
+def _completion_key(client_args, messages, args):
+    # 超时时间可能按消息的处理期限调整，不影响回复内容；api_key和api_base不同的请求不能合并，否则会用别人的key请求别的后端
+    return make_key(client_args, messages, {key: value for key, value in args.items() if key not in ("request_timeout", "timeout")})
+
+
 # OpenAI对话模型API (可用)
 class ChatGPTBot(Bot, OpenAIImage):
     def __init__(self):
-        super().__init__()
-        # set the default api_key
-        openai.api_key = conf().get("open_ai_api_key")
-        if conf().get("open_ai_api_base"):
-            openai.api_base = conf().get("open_ai_api_base")
+        # 不调用OpenAIImage.__init__，api_key等记录在实例上，每次请求时传入，不修改openai的全局配置，chat_backends中的多个后端可以使用不同的key和地址
+        self.client_args = {
+            "api_key": conf().get("open_ai_api_key"),
+            "api_base": conf().get("open_ai_api_base") or None,
+            "api_type": None,
+            "api_version": None,
+        }
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
-        if conf().get("rate_limit_chatgpt"):
-            self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
         conf_model = conf().get("model") or "gpt-3.5-turbo"
-        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
+        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo", client_args=self.client_args)
         # o1相关模型不支持system prompt，暂时用文心模型的session
 
         self.args = {
@@ -57,53 +70,23 @@ class ChatGPTBot(Bot, OpenAIImage):
             logger.info("[CHATGPT] query={}".format(query))
 
             session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply = self._command_reply(query, session_id)
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
             logger.debug("[CHATGPT] session query={}".format(session.messages))
 
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
-
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
+            api_key, new_args = self._request_args(context)
+            deadline = context.get("deadline")
+            if context.get("stream"):
+                # reply in stream
+                reply_content = self.reply_text_stream(session, api_key, args=new_args, deadline=deadline)
             else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+                reply_content = self.reply_text(session, api_key, args=new_args, deadline=deadline)
+            return self._build_reply(session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
-            ok, retstring = self.create_img(query, 0)
+            ok, retstring = self.create_img(query, 0, api_key=context.get("openai_api_key") or self.client_args["api_key"], api_base=self.client_args["api_base"])
             reply = None
             if ok:
                 reply = Reply(ReplyType.IMAGE_URL, retstring)
@@ -114,7 +97,74 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    async def async_reply(self, query, context=None):
+        if context.type != ContextType.TEXT or context.get("stream"):  # 流式回复由发送线程逐段消费，仍使用同步接口
+            return await super().async_reply(query, context)
+        logger.info("[CHATGPT] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._command_reply(query, session_id)
+        if reply:
+            return reply
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+        api_key, new_args = self._request_args(context)
+        reply_content = await self.async_reply_text(session, api_key, args=new_args, deadline=context.get("deadline"))
+        return self._build_reply(session, reply_content)
+
+    def _command_reply(self, query, session_id):
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+        return None
+
+    def _request_args(self, context):
+        api_key = context.get("openai_api_key")
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        time_left = context.time_left()
+        if time_left is not None:
+            # 请求超时不超过消息的处理期限
+            new_args = new_args or self.args.copy()
+            timeout = max(1, time_left)
+            if new_args.get("request_timeout") is None or new_args["request_timeout"] > timeout:
+                new_args["request_timeout"] = timeout
+                new_args["timeout"] = timeout
+        return api_key, new_args
+
+    def _build_reply(self, session: ChatGPTSession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        if reply_content.get("stream"):
+            chunks = stream.record_stream(reply_content["content"], lambda content: self._on_stream_finish(session_id, content))
+            return Reply(ReplyType.TEXT_STREAM, chunks)
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"], cacheable=True)
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
@@ -122,63 +172,177 @@ class ChatGPTBot(Bot, OpenAIImage):
         :param retry_count: retry count
         :return: {}
         """
+        if retry_count == 0 and self._session_rate_limited(session):
+            return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            # api_key为None时使用该bot配置的key，见_client_args
+            if args is None:
+                args = self.args
+            response = self._create_completion(api_key, session.messages, args)
+            self._record_cache_usage(session, response)
+            return self._parse_response(response)
+        except Exception as e:
+            result, need_retry, delay = self._handle_error(e, session, retry_count, deadline)
+            if need_retry:
+                time.sleep(delay)
+                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+                return self.reply_text(session, api_key, args, retry_count + 1, deadline)
+            else:
+                return result
+
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, deadline=None) -> dict:
+        """
+        call openai's ChatCompletion with stream=True
+        :return: 请求成功时content为逐段产出回复文本的生成器，失败时与reply_text相同
+        """
+        if retry_count == 0 and self._session_rate_limited(session):
+            return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+        try:
+            if conf().get("rate_limit_chatgpt") and not token_bucket.get_bucket("chatgpt", conf().get("rate_limit_chatgpt")).get_token():
                 raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
             if args is None:
                 args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            # logger.debug("[CHATGPT] response={}".format(response))
-            logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            response = openai.ChatCompletion.create(messages=session.messages, stream=True, **self._client_args(api_key), **args)
+            return {"stream": True, "content": self._iter_stream(response)}
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+            result, need_retry, delay = self._handle_error(e, session, retry_count, deadline)
+            if need_retry:
+                time.sleep(delay)
+                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+                return self.reply_text_stream(session, api_key, args, retry_count + 1, deadline)
             else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+                return result
 
+    def _iter_stream(self, response):
+        for chunk in response:
+            if chunk.get("choices"):
+                content = chunk["choices"][0].get("delta", {}).get("content")
+                if content:
+                    yield content
+
+    def _on_stream_finish(self, session_id, content):
+        logger.info("[ChatGPT] stream reply={}".format(content))
+        if content:
+            self.sessions.session_reply(content, session_id)
+
+    async def async_reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, deadline=None) -> dict:
+        """
+        asyncio version of reply_text, uses openai's ChatCompletion.acreate
+        """
+        if retry_count == 0 and self._session_rate_limited(session):
+            return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+        try:
+            if args is None:
+                args = self.args
+            response = await self._async_create_completion(api_key, session.messages, args)
+            self._record_cache_usage(session, response)
+            return self._parse_response(response)
+        except Exception as e:
+            result, need_retry, delay = self._handle_error(e, session, retry_count, deadline)
             if need_retry:
+                await asyncio.sleep(delay)
                 logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+                return await self.async_reply_text(session, api_key, args, retry_count + 1, deadline)
             else:
                 return result
 
+    def _create_completion(self, api_key, messages, args):
+        client_args = self._client_args(api_key)
+
+        def create():
+            if conf().get("rate_limit_chatgpt") and not token_bucket.get_bucket("chatgpt", conf().get("rate_limit_chatgpt")).get_token():
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            return openai.ChatCompletion.create(messages=messages, **client_args, **args)
+
+        if not conf().get("request_coalescing", True):
+            return create()
+        return _flight.do(_completion_key(client_args, messages, args), create, conf().get("request_coalescing_max_waiters", 50))
+
+    async def _async_create_completion(self, api_key, messages, args):
+        client_args = self._client_args(api_key)
+
+        async def create():
+            if conf().get("rate_limit_chatgpt") and not await token_bucket.get_bucket("chatgpt", conf().get("rate_limit_chatgpt")).async_get_token():
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            return await openai.ChatCompletion.acreate(messages=messages, **client_args, **args)
+
+        if not conf().get("request_coalescing", True):
+            return await create()
+        return await _flight.async_do(_completion_key(client_args, messages, args), create, conf().get("request_coalescing_max_waiters", 50))
+
+    def _client_args(self, api_key=None) -> dict:
+        """
+        :param api_key: 用户通过#set_openai_api_key设置的key，没有时使用该bot配置的key
+        """
+        return {**self.client_args, "api_key": api_key or self.client_args["api_key"]}
+
+    def _record_cache_usage(self, session: ChatGPTSession, response):
+        # openai对较长的相同前缀自动缓存，usage中返回命中缓存的token数
+        usage = response.get("usage") or {}
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        self.sessions.record_cache_usage(session.session_id, usage.get("prompt_tokens", 0), cached_tokens)
+
+    def _parse_response(self, response) -> dict:
+        # logger.debug("[CHATGPT] response={}".format(response))
+        logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _session_rate_limited(self, session: ChatGPTSession) -> bool:
+        """
+        单个会话的限流，超出时直接回复，不占用线程等待
+        """
+        tpm = conf().get("rate_limit_chatgpt_per_session")
+        if not tpm or session.session_id is None:
+            return False
+        return not token_bucket.get_bucket("chatgpt_session", tpm, key=session.session_id).try_acquire()
+
+    def _handle_error(self, e, session: ChatGPTSession, retry_count, deadline=None):
+        """
+        :param deadline: 消息的处理期限(time.monotonic)，重试等待后会超过期限时不再重试
+        :return: (失败时的回复, 是否需要重试, 重试前等待的秒数)
+        """
+        need_retry = retry_count < conf().get("request_max_retries", 2)
+        delay = 0
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            delay = 20
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            delay = 5
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            delay = 10
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            delay = 5
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+        delay = backoff_delay(retry_count, delay)
+        if need_retry and deadline is not None and time.monotonic() + delay >= deadline:
+            logger.warn("[CHATGPT] deadline exceeded, give up retry")
+            need_retry = False
+        return result, need_retry, delay
+
 
 class AzureChatGPTBot(ChatGPTBot):
     def __init__(self):
         super().__init__()
-        openai.api_type = "azure"
-        openai.api_version = conf().get("azure_api_version", "2023-06-01-preview")
+        self.client_args["api_type"] = "azure"
+        self.client_args["api_version"] = conf().get("azure_api_version", "2023-06-01-preview")
         self.args["deployment_id"] = conf().get("azure_deployment_id")
 
-    def create_img(self, query, retry_count=0, api_key=None):
+    def create_img(self, query, retry_count=0, api_key=None, api_base=None):
         text_to_image_model = conf().get("text_to_image")
         if text_to_image_model == "dall-e-2":
             api_version = "2023-06-01-preview"
@@ -1,6 +1,10 @@
+import functools
+
+from bot import session_compactor
 from bot.session_manager import Session
 from common.log import logger
 from common import const
+from config import conf
 
 """
     e.g.  [
@@ -13,11 +17,23 @@ from common import const
 
 
 class ChatGPTSession(Session):
-    def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
+    def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo", client_args=None):
         super().__init__(session_id, system_prompt)
         self.model = model
+        self.client_args = client_args or {}  # 所属bot的api_key、api_base等，总结时使用
+        self.token_cache = []  # 与messages一一对应的(message, content, token数)，只对新增的消息调用tokenizer
+        self.total_tokens = 0  # token_cache中token数之和
+        self.compaction = None  # 会话压缩的状态，见session_compactor
         self.reset()
 
+    def copy(self):
+        session = super().copy()
+        session.token_cache = []
+        session.total_tokens = 0
+        # 副本不发起会话压缩，也不应用原会话未完成的摘要
+        session.compaction = session_compactor.DETACHED
+        return session
+
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
@@ -27,15 +43,15 @@ class ChatGPTSession(Session):
             if cur_tokens is None:
                 raise e
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+        if precise and session_compactor.enabled():
+            cur_tokens = session_compactor.compact(self, cur_tokens, max_tokens)
+        if precise and cur_tokens > max_tokens and conf().get("prompt_cache", False):
+            cur_tokens = self._discard_block(cur_tokens - max_tokens * conf().get("prompt_cache_trim_ratio", 0.5))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                cur_tokens = self._discard_message(1, cur_tokens, max_tokens, precise)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
-                if precise:
-                    cur_tokens = self.calc_tokens()
-                else:
-                    cur_tokens = cur_tokens - max_tokens
+                cur_tokens = self._discard_message(1, cur_tokens, max_tokens, precise)
                 break
             elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
                 logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
@@ -43,57 +59,134 @@ class ChatGPTSession(Session):
             else:
                 logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
+    def summarize(self, messages) -> str:
+        """
+        会话压缩时调用较便宜的模型总结对话
+        """
+        import openai
+
+        response = openai.ChatCompletion.create(
+            model=conf().get("session_compaction_model") or const.GPT_4o_MINI,
+            messages=messages,
+            temperature=0.3,
+            request_timeout=60,
+            **self.client_args,
+        )
+        return response.choices[0]["message"]["content"]
+
+    def _discard_block(self, excess):
+        # calc_tokens刚同步过token_cache，保留第一条system消息
+        cut = self.block_discard_index(1, excess, lambda i: self.token_cache[i][2])
+        self.total_tokens -= sum(item[2] for item in self.token_cache[1:cut])
+        del self.messages[1:cut]
+        del self.token_cache[1:cut]
+        return self.total_tokens + reply_priming_tokens(self.model)
+
+    def _discard_message(self, index, cur_tokens, max_tokens, precise):
+        """
+        删除一条消息，精确计数时calc_tokens刚同步过token_cache，直接减去该消息缓存的token数即可
+        """
+        self.messages.pop(index)
+        if not precise:
+            return cur_tokens - max_tokens
+        self.total_tokens -= self.token_cache.pop(index)[2]
+        return self.total_tokens + reply_priming_tokens(self.model)
+
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        """
+        增量计算：每条消息的token数在首次计算时缓存，只对新增或content被替换过的消息调用tokenizer
+        """
+        cache, messages = self.token_cache, self.messages
+        n = len(cache)
+        if n <= len(messages) and all(cache[i][0] is messages[i] and cache[i][1] is messages[i].get("content") for i in range(n)):
+            for message in messages[n:]:
+                tokens = num_tokens_from_message(message, self.model)
+                cache.append((message, message.get("content"), tokens))
+                self.total_tokens += tokens
+        else:
+            # messages被重置或直接修改过，content未变的消息沿用缓存的计数
+            cached = {id(item[0]): item for item in cache}
+            new_cache = []
+            for message in messages:
+                item = cached.get(id(message))
+                if item is None or item[0] is not message or item[1] is not message.get("content"):
+                    item = (message, message.get("content"), num_tokens_from_message(message, self.model))
+                new_cache.append(item)
+            self.token_cache = new_cache
+            self.total_tokens = sum(item[2] for item in new_cache)
+        return self.total_tokens + reply_priming_tokens(self.model)
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
+    num_tokens = 0
+    for message in messages:
+        num_tokens += num_tokens_from_message(message, model)
+    return num_tokens + reply_priming_tokens(model)
 
-    if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
-        return num_tokens_by_character(messages)
 
-    import tiktoken
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, excluding reply priming."""
+    encoding, tokens_per_message, tokens_per_name = _token_params(model)
+    if encoding is None:
+        return len(message["content"])
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
+def reply_priming_tokens(model):
+    if _is_character_model(model):
+        return 0
+    return 3  # every reply is primed with <|start|>assistant<|message|>
+
 
+def _is_character_model(model):
+    return model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI)
+
+
+@functools.lru_cache(maxsize=None)
+def _token_params(model):
+    """
+    :return: (encoding, tokens_per_message, tokens_per_name)，按字符计数的模型encoding为None
+    """
+    if _is_character_model(model):
+        return None, 0, 0
     if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+        return _token_params("gpt-3.5-turbo")
     elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
                    "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
                    "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
                    const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
+        return _token_params("gpt-4")
     elif model.startswith("claude-3"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+        return _token_params("gpt-3.5-turbo")
+    if model == "gpt-3.5-turbo":
+        return get_encoding(model), 4, -1  # every message follows <|start|>{role/name}\n{content}<|end|>\n; if there's a name, the role is omitted
+    elif model == "gpt-4":
+        return get_encoding(model), 3, 1
+    logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+    return _token_params("gpt-3.5-turbo")
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """
+    进程内缓存tiktoken的encoding，避免每次计数都查找、加载
+    """
+    import tiktoken
+
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
         logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+        return tiktoken.get_encoding("cl100k_base")
 
 
 def num_tokens_by_character(messages):
@@ -13,6 +13,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.circuit_breaker import backoff_delay
 from common import const
 from config import conf
 
@@ -62,7 +63,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                         reply = Reply(ReplyType.ERROR, reply_content)
                     else:
                         self.sessions.session_reply(reply_content, session_id, total_tokens)
-                        reply = Reply(ReplyType.TEXT, reply_content)
+                        reply = Reply(ReplyType.TEXT, reply_content, cacheable=True)
                 return reply
             elif context.type == ContextType.IMAGE_CREATE:
                 ok, retstring = self.create_img(query, 0)
@@ -76,15 +77,23 @@ class ClaudeAPIBot(Bot, OpenAIImage):
     def reply_text(self, session: BaiduWenxinSession, retry_count=0):
         try:
             actual_model = self._model_mapping(conf().get("model"))
+            system, messages = conf().get("character_desc", ""), session.messages
+            if conf().get("prompt_cache", False):
+                system, messages = self._cache_control(system, messages)
             response = self.claudeClient.messages.create(
                 model=actual_model,
                 max_tokens=4096,
-                system=conf().get("character_desc", ""),
-                messages=session.messages
+                system=system,
+                messages=messages
             )
             # response = openai.Completion.create(prompt=str(session), **self.args)
             res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
-            total_tokens = response.usage.input_tokens+response.usage.output_tokens
+            # input_tokens不含读写缓存的token
+            cache_read = getattr(response.usage, "cache_read_input_tokens", 0) or 0
+            cache_creation = getattr(response.usage, "cache_creation_input_tokens", 0) or 0
+            prompt_tokens = response.usage.input_tokens + cache_read + cache_creation
+            self.sessions.record_cache_usage(session.session_id, prompt_tokens, cache_read)
+            total_tokens = prompt_tokens + response.usage.output_tokens
             completion_tokens = response.usage.output_tokens
             logger.info("[CLAUDE_API] reply={}".format(res_content))
             return {
@@ -93,18 +102,18 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 "content": res_content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            need_retry = retry_count < conf().get("request_max_retries", 2)
             result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
                 if need_retry:
-                    time.sleep(20)
+                    time.sleep(backoff_delay(retry_count, 20))
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CLAUDE_API] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
                 if need_retry:
-                    time.sleep(5)
+                    time.sleep(backoff_delay(retry_count, 5))
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -120,6 +129,18 @@ class ClaudeAPIBot(Bot, OpenAIImage):
             else:
                 return result
 
+    def _cache_control(self, system, messages):
+        """
+        标记提示词缓存的断点：system和最后一条消息，下一轮请求可以复用到上一轮最后一条消息为止的前缀
+        """
+        cache_control = {"type": "ephemeral"}
+        if system:
+            system = [{"type": "text", "text": system, "cache_control": cache_control}]
+        if messages and isinstance(messages[-1].get("content"), str):
+            last = messages[-1]
+            messages = messages[:-1] + [{"role": last["role"], "content": [{"type": "text", "text": last["content"], "cache_control": cache_control}]}]
+        return system, messages
+
     def _model_mapping(self, model) -> str:
         if model == "claude-3-opus":
             return const.CLAUDE_3_OPUS
@@ -64,7 +64,7 @@ class DashscopeBot(Bot):
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
+                reply = Reply(ReplyType.TEXT, reply_content["content"], cacheable=True)
             else:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
                 logger.debug("[DASHSCOPE] reply {} used 0 tokens.".format(reply_content))
@@ -90,6 +90,8 @@ class DashscopeBot(Bot):
             )
             if response.status_code == HTTPStatus.OK:
                 content = response.output.choices[0]["message"]["content"]
+                cached_tokens = (response.usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+                self.sessions.record_cache_usage(session.session_id, response.usage.get("input_tokens", 0), cached_tokens)
                 return {
                     "total_tokens": response.usage["total_tokens"],
                     "completion_tokens": response.usage["output_tokens"],
@@ -101,7 +103,7 @@ class DashscopeBot(Bot):
                     response.code, response.message
                 ))
                 result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-                need_retry = retry_count < 2
+                need_retry = retry_count < conf().get("request_max_retries", 2)
                 result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
                 if need_retry:
                     return self.reply_text(session, retry_count + 1)
@@ -109,7 +111,7 @@ class DashscopeBot(Bot):
                     return result
         except Exception as e:
             logger.exception(e)
-            need_retry = retry_count < 2
+            need_retry = retry_count < conf().get("request_max_retries", 2)
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
                 return self.reply_text(session, retry_count + 1)
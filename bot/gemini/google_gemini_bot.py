@@ -59,7 +59,7 @@ class GoogleGeminiBot(Bot):
                 reply_text = response.candidates[0].content.parts[0].text
                 logger.info(f"[Gemini] reply={reply_text}")
                 self.sessions.session_reply(reply_text, session_id)
-                return Reply(ReplyType.TEXT, reply_text)
+                return Reply(ReplyType.TEXT, reply_text, cacheable=True)
             else:
                 # 没有有效响应内容，可能内容被屏蔽，输出安全评分
                 logger.warning("[Gemini] No valid response generated. Checking safety ratings.")
@@ -1,19 +1,24 @@
 # access LinkAI knowledge base platform
 # docs: https://link-ai.tech/platform/link-app/wechat
 
+import asyncio
 import re
 import time
-import requests
 import config
+from bot import session_compactor
 from bot.bot import Bot
-from bot.chatgpt.chat_gpt_session import ChatGPTSession
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, num_tokens_by_character
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common.event_loop import run_sync
+from common import http
+from common.http import async_post_json
 from common.log import logger
+from common.circuit_breaker import backoff_delay
 from config import conf, pconf
 import threading
-from common import memory, utils
+from common import const, memory, utils
 import base64
 import os
 
@@ -52,129 +57,182 @@ class LinkAIBot(Bot):
         :param retry_count: 当前递归重试次数
         :return: 回复
         """
-        if retry_count > 2:
+        if retry_count > conf().get("request_max_retries", 2):
             # exit from retry 2 times
             logger.warn("[LINKAI] failed after maximum number of retry times")
-            return Reply(ReplyType.TEXT, "请再问我一次吧")
+            return Reply(ReplyType.ERROR, "请再问我一次吧")
 
         try:
-            # load config
-            if context.get("generate_breaked_by"):
-                logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
-                app_code = None
-            else:
-                plugin_app_code = self._find_group_mapping_code(context)
-                app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
-            linkai_api_key = conf().get("linkai_api_key")
-
-            session_id = context["session_id"]
-            session_message = self.sessions.session_msg_query(query, session_id)
-            logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
-
-            # image process
-            img_cache = memory.USER_IMAGE_CACHE.get(session_id)
-            if img_cache:
-                messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
-                if messages:
-                    session_message = messages
-
-            model = conf().get("model")
-            # remove system message
-            if session_message[0].get("role") == "system":
-                if app_code or model == "wenxin":
-                    session_message.pop(0)
-            body = {
-                "app_code": app_code,
-                "messages": session_message,
-                "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
-                "temperature": conf().get("temperature"),
-                "top_p": conf().get("top_p", 1),
-                "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "session_id": session_id,
-                "sender_id": session_id,
-                "channel_type": conf().get("channel_type", "wx")
-            }
-            try:
-                from linkai import LinkAIClient
-                client_id = LinkAIClient.fetch_client_id()
-                if client_id:
-                    body["client_id"] = client_id
-                    # start: client info deliver
-                    if context.kwargs.get("msg"):
-                        body["session_id"] = context.kwargs.get("msg").from_user_id
-                        if context.kwargs.get("msg").is_group:
-                            body["is_group"] = True
-                            body["group_name"] = context.kwargs.get("msg").from_user_nickname
-                            body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
-                        else:
-                            if body.get("channel_type") in ["wechatcom_app"]:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_id
-                            else:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_nickname
-
-            except Exception as e:
-                pass
-            file_id = context.kwargs.get("file_id")
-            if file_id:
-                body["file_id"] = file_id
-            logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
-            headers = {"Authorization": "Bearer " + linkai_api_key}
+            session_id, body, headers = self._build_chat_request(query, context)
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                res_code = response.get('code')
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
-                if res_code == 429:
-                    logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
-                else:
-                    self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
-                agent_suffix = self._fetch_agent_suffix(response)
-                if agent_suffix:
-                    reply_content += agent_suffix
-                if not agent_suffix:
-                    knowledge_suffix = self._fetch_knowledge_search_suffix(response)
-                    if knowledge_suffix:
-                        reply_content += knowledge_suffix
-                # image process
-                if response["choices"][0].get("img_urls"):
-                    thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
-                    thread.start()
-                    reply_content = response["choices"][0].get("text_content")
-                if reply_content:
-                    reply_content = self._process_url(reply_content)
-                return Reply(ReplyType.TEXT, reply_content)
+            reply = self._handle_chat_response(res.status_code, res.json(), query, context, session_id, body)
+            if reply is None:
+                # server error, need retry
+                time.sleep(backoff_delay(retry_count, 2))
+                logger.warn(f"[LINKAI] do retry, times={retry_count}")
+                return self._chat(query, context, retry_count + 1)
+            return reply
 
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
+        except Exception as e:
+            logger.exception(e)
+            # retry
+            time.sleep(backoff_delay(retry_count, 2))
+            logger.warn(f"[LINKAI] do retry, times={retry_count}")
+            return self._chat(query, context, retry_count + 1)
 
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+    async def async_reply(self, query, context: Context = None) -> Reply:
+        if context.type != ContextType.TEXT:
+            return await super().async_reply(query, context)
+        return await self._async_chat(query, context)
+
+    async def _async_chat(self, query, context, retry_count=0) -> Reply:
+        """
+        asyncio version of _chat
+        """
+        if retry_count > conf().get("request_max_retries", 2):
+            # exit from retry 2 times
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return Reply(ReplyType.ERROR, "请再问我一次吧")
 
-                error_reply = "提问太快啦，请休息一下再问我吧"
-                if res.status_code == 409:
-                    error_reply = "这个问题我还没有学会，请问我其它问题吧"
-                return Reply(ReplyType.TEXT, error_reply)
+        try:
+            # 构造请求时可能需要读取图片、查询应用信息，放到线程池执行
+            session_id, body, headers = await run_sync(self._build_chat_request, query, context)
+            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+            status_code, response = await async_post_json(base_url + "/v1/chat/completions", headers=headers, json=body,
+                                                          timeout=conf().get("request_timeout", 180))
+            reply = self._handle_chat_response(status_code, response, query, context, session_id, body)
+            if reply is None:
+                # server error, need retry
+                await asyncio.sleep(backoff_delay(retry_count, 2))
+                logger.warn(f"[LINKAI] do retry, times={retry_count}")
+                return await self._async_chat(query, context, retry_count + 1)
+            return reply
 
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            await asyncio.sleep(backoff_delay(retry_count, 2))
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            return await self._async_chat(query, context, retry_count + 1)
+
+    def _build_chat_request(self, query, context):
+        """
+        构造对话请求
+        :return: (session_id, 请求体, 请求头)
+        """
+        # load config
+        if context.get("generate_breaked_by"):
+            logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
+            app_code = None
+        else:
+            plugin_app_code = self._find_group_mapping_code(context)
+            app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
+        linkai_api_key = conf().get("linkai_api_key")
+
+        session_id = context["session_id"]
+        session_message = self.sessions.session_msg_query(query, session_id)
+        logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
+
+        # image process
+        img_cache = memory.USER_IMAGE_CACHE.get(session_id)
+        if img_cache:
+            messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
+            if messages:
+                session_message = messages
+
+        model = conf().get("model")
+        # remove system message
+        if session_message[0].get("role") == "system":
+            if app_code or model == "wenxin":
+                session_message.pop(0)
+        body = {
+            "app_code": app_code,
+            "messages": session_message,
+            "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
+            "temperature": conf().get("temperature"),
+            "top_p": conf().get("top_p", 1),
+            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "session_id": session_id,
+            "sender_id": session_id,
+            "channel_type": conf().get("channel_type", "wx")
+        }
+        try:
+            from linkai import LinkAIClient
+            client_id = LinkAIClient.fetch_client_id()
+            if client_id:
+                body["client_id"] = client_id
+                # start: client info deliver
+                if context.kwargs.get("msg"):
+                    body["session_id"] = context.kwargs.get("msg").from_user_id
+                    if context.kwargs.get("msg").is_group:
+                        body["is_group"] = True
+                        body["group_name"] = context.kwargs.get("msg").from_user_nickname
+                        body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
+                    else:
+                        if body.get("channel_type") in ["wechatcom_app"]:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_id
+                        else:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_nickname
+
+        except Exception as e:
+            pass
+        file_id = context.kwargs.get("file_id")
+        if file_id:
+            body["file_id"] = file_id
+        logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
+        headers = {"Authorization": "Bearer " + linkai_api_key}
+        return session_id, body, headers
+
+    def _handle_chat_response(self, status_code, response, query, context, session_id, body):
+        """
+        处理对话请求的响应
+        :return: 回复，服务端错误需要重试时返回None
+        """
+        if status_code == 200:
+            # execute success
+            reply_content = response["choices"][0]["message"]["content"]
+            total_tokens = response["usage"]["total_tokens"]
+            res_code = response.get('code')
+            logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
+            # 限流提示和附带图片的回复不进入回复缓存
+            cacheable = res_code != 429 and not response["choices"][0].get("img_urls")
+            if res_code == 429:
+                logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
+            else:
+                self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
+            agent_suffix = self._fetch_agent_suffix(response)
+            if agent_suffix:
+                reply_content += agent_suffix
+            if not agent_suffix:
+                knowledge_suffix = self._fetch_knowledge_search_suffix(response)
+                if knowledge_suffix:
+                    reply_content += knowledge_suffix
+            # image process
+            if response["choices"][0].get("img_urls"):
+                thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
+                thread.start()
+                reply_content = response["choices"][0].get("text_content")
+            if reply_content:
+                reply_content = self._process_url(reply_content)
+            return Reply(ReplyType.TEXT, reply_content, cacheable=cacheable)
+
+        error = response.get("error")
+        logger.error(f"[LINKAI] chat failed, status_code={status_code}, "
+                     f"msg={error.get('message')}, type={error.get('type')}")
+
+        if status_code >= 500:
+            return None
+
+        # 返回ERROR，配置了chat_backends时bridge会切换到其他后端并计入熔断
+        error_reply = "提问太快啦，请休息一下再问我吧"
+        if status_code == 409:
+            error_reply = "这个问题我还没有学会，请问我其它问题吧"
+        return Reply(ReplyType.ERROR, error_reply)
 
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
@@ -237,7 +295,7 @@ class LinkAIBot(Bot):
             logger.exception(e)
 
     def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0) -> dict:
-        if retry_count >= 2:
+        if retry_count >= conf().get("request_max_retries", 2):
             # exit from retry 2 times
             logger.warn("[LINKAI] failed after maximum number of retry times")
             return {
@@ -262,7 +320,7 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
             if res.status_code == 200:
                 # execute success
@@ -284,7 +342,7 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
+                    time.sleep(backoff_delay(retry_count, 2))
                     logger.warn(f"[LINKAI] do retry, times={retry_count}")
                     return self.reply_text(session, app_code, retry_count + 1)
 
@@ -297,7 +355,7 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            time.sleep(backoff_delay(retry_count, 2))
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
             return self.reply_text(session, app_code, retry_count + 1)
 
@@ -306,7 +364,7 @@ class LinkAIBot(Bot):
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +385,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -430,7 +488,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = http.get(url)
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -455,21 +513,41 @@ class LinkAISessionManager(SessionManager):
             logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_session(session)
         return session
 
 
 class LinkAISession(ChatGPTSession):
-    def calc_tokens(self):
-        if not self.messages:
-            return 0
-        return len(str(self.messages))
-
     def discard_exceeding(self, max_tokens, cur_tokens=None):
-        cur_tokens = self.calc_tokens()
+        """
+        与ChatGPTSession一样按模型的tokenizer增量计数，超出时一次丢弃足够多的最早的对话，使上下文不超过max_tokens
+        """
+        try:
+            cur_tokens = self.calc_tokens()
+        except Exception as e:
+            logger.debug("[LinkAI] failed to count tokens, count by characters: {}".format(e))
+            return self._discard_by_characters(max_tokens)
+        if session_compactor.enabled():
+            cur_tokens = session_compactor.compact(self, cur_tokens, max_tokens)
+        if cur_tokens > max_tokens:
+            target = max_tokens
+            if conf().get("prompt_cache", False):
+                target = max_tokens * conf().get("prompt_cache_trim_ratio", 0.5)
+            cur_tokens = self._discard_block(cur_tokens - target)
+        return cur_tokens
+
+    def _discard_by_characters(self, max_tokens):
+        # tokenizer不可用时按字数估算
+        cur_tokens = num_tokens_by_character(self.messages)
         if cur_tokens > max_tokens:
-            for i in range(0, len(self.messages)):
-                if i > 0 and self.messages[i].get("role") == "assistant" and self.messages[i - 1].get("role") == "user":
-                    self.messages.pop(i)
-                    self.messages.pop(i - 1)
-                    return self.calc_tokens()
+            del self.messages[1 : self.block_discard_index(1, cur_tokens - max_tokens, lambda i: len(self.messages[i]["content"]))]
+            cur_tokens = num_tokens_by_character(self.messages)
         return cur_tokens
+
+    def summarize(self, messages) -> str:
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+        body = {"model": conf().get("session_compaction_model") or const.GPT_4o_MINI, "messages": messages, "temperature": 0.3}
+        headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
+        res = http.post(url=base_url + "/v1/chat/completions", json=body, headers=headers, timeout=60)
+        res.raise_for_status()
+        return res.json()["choices"][0]["message"]["content"]
@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import time
 import json
 import openai
@@ -8,7 +9,10 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import stream
+from common.http import async_post_json
 from common.log import logger
+from common.circuit_breaker import backoff_delay
 from config import conf, load_config
 from .modelscope_session import ModelScopeSession
 import requests
@@ -40,53 +44,21 @@ class ModelScopeBot(Bot):
             logger.info("[MODELSCOPE_AI] query={}".format(query))
 
             session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply = self._command_reply(query, session_id)
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
             logger.debug("[MODELSCOPE_AI] session query={}".format(session.messages))
 
-            model = context.get("modelscope_model")
-            new_args = self.args.copy()
-            if model:
-                new_args["model"] = model
-
-            if new_args["model"] == "Qwen/QwQ-32B":
+            new_args = self._request_args(context)
+            if context.get("stream") or new_args["model"] == "Qwen/QwQ-32B":
                 reply_content = self.reply_text_stream(session, args=new_args)
+                if reply_content.get("stream") and not context.get("stream"):  # 模型只支持流式接口，收集完整回复
+                    reply_content["stream"] = False
+                    reply_content["content"] = stream.collect(reply_content["content"])
             else:
                 reply_content = self.reply_text(session, args=new_args)
-
-            logger.debug(
-                "[MODELSCOPE_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                # 只有当 content 为空且 completion_tokens 为 0 时才标记为错误
-                if len(reply_content["content"]) == 0:
-                    reply = Reply(ReplyType.ERROR, reply_content["content"])
-                else:
-                    reply = Reply(ReplyType.TEXT, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[MODELSCOPE_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._build_reply(session, reply_content)
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
             reply = None
@@ -99,6 +71,69 @@ class ModelScopeBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def async_reply(self, query, context=None):
+        if context.type != ContextType.TEXT:
+            return await super().async_reply(query, context)
+        new_args = self._request_args(context)
+        if context.get("stream") or new_args["model"] == "Qwen/QwQ-32B":  # 流式接口仍使用线程池执行
+            return await super().async_reply(query, context)
+        logger.info("[MODELSCOPE_AI] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._command_reply(query, session_id)
+        if reply:
+            return reply
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[MODELSCOPE_AI] session query={}".format(session.messages))
+        reply_content = await self.async_reply_text(session, args=new_args)
+        return self._build_reply(session, reply_content)
+
+    def _command_reply(self, query, session_id):
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+        return None
+
+    def _request_args(self, context):
+        model = context.get("modelscope_model")
+        new_args = self.args.copy()
+        if model:
+            new_args["model"] = model
+        return new_args
+
+    def _build_reply(self, session: ModelScopeSession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        if reply_content.get("stream"):
+            chunks = stream.record_stream(reply_content["content"], lambda content: self._on_stream_finish(session_id, content))
+            return Reply(ReplyType.TEXT_STREAM, chunks)
+        logger.debug(
+            "[MODELSCOPE_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            # 只有当 content 为空且 completion_tokens 为 0 时才标记为错误
+            if len(reply_content["content"]) == 0:
+                reply = Reply(ReplyType.ERROR, reply_content["content"])
+            else:
+                reply = Reply(ReplyType.TEXT, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"], cacheable=True)
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[MODELSCOPE_AI] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
     def reply_text(self, session: ModelScopeSession, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -108,72 +143,101 @@ class ModelScopeBot(Bot):
         :return: {}
         """
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
-            
-            body = args
-            body["messages"] = session.messages
+            headers, body = self._build_request(session, args)
             res = requests.post(
                 self.base_url,
                 headers=headers,
                 data=json.dumps(body)
             )
-
-            if res.status_code == 200:
-                response = res.json()
-                return {
-                    "total_tokens": response["usage"]["total_tokens"],
-                    "completion_tokens": response["usage"]["completion_tokens"],
-                    "content": response["choices"][0]["message"]["content"]
-                }
+            result, need_retry = self._parse_result(res.status_code, res.json(), retry_count)
+            if need_retry:
+                time.sleep(backoff_delay(retry_count, 3))
+                return self.reply_text(session, args, retry_count + 1)
             else:
-                response = res.json()
-                if "errors" in response:
-                    error = response.get("errors")
-                elif "error" in response:
-                    error = response.get("error")
-                else:
-                    error = "Unknown error"
-                logger.error(f"[MODELSCOPE_AI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MODELSCOPE_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
-
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
+                return result
         except Exception as e:
             logger.exception(e)
-            need_retry = retry_count < 2
+            need_retry = retry_count < conf().get("request_max_retries", 2)
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
 
+    async def async_reply_text(self, session: ModelScopeSession, args=None, retry_count=0) -> dict:
+        """
+        asyncio version of reply_text
+        """
+        try:
+            headers, body = self._build_request(session, args)
+            status_code, response = await async_post_json(self.base_url, headers=headers, data=json.dumps(body))
+            result, need_retry = self._parse_result(status_code, response, retry_count)
+            if need_retry:
+                await asyncio.sleep(backoff_delay(retry_count, 3))
+                return await self.async_reply_text(session, args, retry_count + 1)
+            else:
+                return result
+        except Exception as e:
+            logger.exception(e)
+            need_retry = retry_count < conf().get("request_max_retries", 2)
+            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            if need_retry:
+                return await self.async_reply_text(session, args, retry_count + 1)
+            else:
+                return result
+
+    def _build_request(self, session: ModelScopeSession, args):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + self.api_key
+        }
+
+        body = args
+        body["messages"] = session.messages
+        return headers, body
+
+    def _parse_result(self, status_code, response, retry_count):
+        """
+        :return: (回复内容, 是否需要重试)
+        """
+        if status_code == 200:
+            return {
+                "total_tokens": response["usage"]["total_tokens"],
+                "completion_tokens": response["usage"]["completion_tokens"],
+                "content": response["choices"][0]["message"]["content"]
+            }, False
+
+        if "errors" in response:
+            error = response.get("errors")
+        elif "error" in response:
+            error = response.get("error")
+        else:
+            error = "Unknown error"
+        logger.error(f"[MODELSCOPE_AI] chat failed, status_code={status_code}, "
+                     f"msg={error.get('message')}, type={error.get('type')}")
+
+        result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+        need_retry = False
+        if status_code >= 500:
+            # server error, need retry
+            logger.warn(f"[MODELSCOPE_AI] do retry, times={retry_count}")
+            need_retry = retry_count < conf().get("request_max_retries", 2)
+        elif status_code == 401:
+            result["content"] = "授权失败，请检查API Key是否正确"
+        elif status_code == 429:
+            result["content"] = "请求过于频繁，请稍后再试"
+            need_retry = retry_count < conf().get("request_max_retries", 2)
+        else:
+            need_retry = False
+        return result, need_retry
+
     def reply_text_stream(self, session: ModelScopeSession, args=None, retry_count=0) -> dict:
         """
         call ModelScope's ChatCompletion to get the answer with stream response
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
-        :return: {}
+        :return: 请求成功时content为逐段产出回复文本的生成器
         """
         try:
             headers = {
@@ -192,22 +256,11 @@ class ModelScopeBot(Bot):
                 stream=True
             )
             if res.status_code == 200:
-                content = ""
-                for line in res.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith("data: "):
-                            try:
-                                json_data = json.loads(decoded_line[6:])
-                                delta_content = json_data.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                                if delta_content:
-                                    content += delta_content
-                            except json.JSONDecodeError as e:
-                                pass
                 return {
                     "total_tokens": 1,  # 流式响应通常不返回token使用情况
                     "completion_tokens": 1,
-                    "content": content
+                    "stream": True,
+                    "content": self._iter_stream(res)
                 }
             else:
                 response = res.json()
@@ -225,28 +278,50 @@ class ModelScopeBot(Bot):
                 if res.status_code >= 500:
                     # server error, need retry
                     logger.warn(f"[MODELSCOPE_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
+                    need_retry = retry_count < conf().get("request_max_retries", 2)
                 elif res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+                    need_retry = retry_count < conf().get("request_max_retries", 2)
                 else:
                     need_retry = False
 
                 if need_retry:
-                    time.sleep(3)
+                    time.sleep(backoff_delay(retry_count, 3))
                     return self.reply_text_stream(session, args, retry_count + 1)
                 else:
                     return result
         except Exception as e:
             logger.exception(e)
-            need_retry = retry_count < 2
+            need_retry = retry_count < conf().get("request_max_retries", 2)
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
                 return self.reply_text_stream(session, args, retry_count + 1)
             else:
                 return result
+
+    def _iter_stream(self, res):
+        try:
+            for line in res.iter_lines():
+                if line:
+                    decoded_line = line.decode('utf-8')
+                    if decoded_line.startswith("data: "):
+                        try:
+                            json_data = json.loads(decoded_line[6:])
+                            delta_content = json_data.get("choices", [{}])[0].get("delta", {}).get("content", "")
+                            if delta_content:
+                                yield delta_content
+                        except json.JSONDecodeError as e:
+                            pass
+        finally:
+            res.close()
+
+    def _on_stream_finish(self, session_id, content):
+        logger.info("[MODELSCOPE_AI] stream reply={}".format(content))
+        if content:
+            self.sessions.session_reply(content, session_id)
+
     def create_img(self, query, retry_count=0):
         try:
             logger.info("[ModelScopeImage] image_query={}".format(query))
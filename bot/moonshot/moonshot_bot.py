@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
@@ -8,10 +9,12 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http
+from common.http import async_post_json
 from common.log import logger
+from common.circuit_breaker import backoff_delay
 from config import conf, load_config
 from .moonshot_session import MoonshotSession
-import requests
 
 
 # ZhipuAI对话模型API
@@ -36,52 +39,76 @@ class MoonshotBot(Bot):
             logger.info("[MOONSHOT_AI] query={}".format(query))
 
             session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply = self._command_reply(query, session_id)
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
             logger.debug("[MOONSHOT_AI] session query={}".format(session.messages))
 
-            model = context.get("moonshot_model")
-            new_args = self.args.copy()
-            if model:
-                new_args["model"] = model
+            new_args = self._request_args(context)
             # if context.get('stream'):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
             reply_content = self.reply_text(session, args=new_args)
-            logger.debug(
-                "[MOONSHOT_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[MOONSHOT_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._build_reply(session, reply_content)
         else:
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def async_reply(self, query, context=None):
+        if context.type != ContextType.TEXT:
+            return await super().async_reply(query, context)
+        logger.info("[MOONSHOT_AI] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._command_reply(query, session_id)
+        if reply:
+            return reply
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[MOONSHOT_AI] session query={}".format(session.messages))
+        reply_content = await self.async_reply_text(session, args=self._request_args(context))
+        return self._build_reply(session, reply_content)
+
+    def _command_reply(self, query, session_id):
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+        return None
+
+    def _request_args(self, context):
+        model = context.get("moonshot_model")
+        new_args = self.args.copy()
+        if model:
+            new_args["model"] = model
+        return new_args
+
+    def _build_reply(self, session: MoonshotSession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "[MOONSHOT_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"], cacheable=True)
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[MOONSHOT_AI] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
     def reply_text(self, session: MoonshotSession, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -91,56 +118,86 @@ class MoonshotBot(Bot):
         :return: {}
         """
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
-            body = args
-            body["messages"] = session.messages
+            headers, body = self._build_request(session, args)
             # logger.debug("[MOONSHOT_AI] response={}".format(response))
             # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
+            res = http.post(
                 self.base_url,
                 headers=headers,
                 json=body
             )
-            if res.status_code == 200:
-                response = res.json()
-                return {
-                    "total_tokens": response["usage"]["total_tokens"],
-                    "completion_tokens": response["usage"]["completion_tokens"],
-                    "content": response["choices"][0]["message"]["content"]
-                }
+            result, need_retry = self._parse_result(res.status_code, res.json(), retry_count)
+            if need_retry:
+                time.sleep(backoff_delay(retry_count, 3))
+                return self.reply_text(session, args, retry_count + 1)
             else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[MOONSHOT_AI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
-
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
+                return result
         except Exception as e:
             logger.exception(e)
-            need_retry = retry_count < 2
+            need_retry = retry_count < conf().get("request_max_retries", 2)
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
+
+    async def async_reply_text(self, session: MoonshotSession, args=None, retry_count=0) -> dict:
+        """
+        asyncio version of reply_text
+        """
+        try:
+            headers, body = self._build_request(session, args)
+            status_code, response = await async_post_json(self.base_url, headers=headers, json=body)
+            result, need_retry = self._parse_result(status_code, response, retry_count)
+            if need_retry:
+                await asyncio.sleep(backoff_delay(retry_count, 3))
+                return await self.async_reply_text(session, args, retry_count + 1)
+            else:
+                return result
+        except Exception as e:
+            logger.exception(e)
+            need_retry = retry_count < conf().get("request_max_retries", 2)
+            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            if need_retry:
+                return await self.async_reply_text(session, args, retry_count + 1)
+            else:
+                return result
+
+    def _build_request(self, session: MoonshotSession, args):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + self.api_key
+        }
+        body = args
+        body["messages"] = session.messages
+        return headers, body
+
+    def _parse_result(self, status_code, response, retry_count):
+        """
+        :return: (回复内容, 是否需要重试)
+        """
+        if status_code == 200:
+            return {
+                "total_tokens": response["usage"]["total_tokens"],
+                "completion_tokens": response["usage"]["completion_tokens"],
+                "content": response["choices"][0]["message"]["content"]
+            }, False
+
+        error = response.get("error")
+        logger.error(f"[MOONSHOT_AI] chat failed, status_code={status_code}, "
+                     f"msg={error.get('message')}, type={error.get('type')}")
+
+        result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+        need_retry = False
+        if status_code >= 500:
+            # server error, need retry
+            logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
+            need_retry = retry_count < conf().get("request_max_retries", 2)
+        elif status_code == 401:
+            result["content"] = "授权失败，请检查API Key是否正确"
+        elif status_code == 429:
+            result["content"] = "请求过于频繁，请稍后再试"
+            need_retry = retry_count < conf().get("request_max_retries", 2)
+        else:
+            need_retry = False
+        return result, need_retry
@@ -0,0 +1,125 @@
+"""
+会话压缩：上下文超过conversation_max_tokens的一定比例时，把较早的对话交给较便宜的模型总结成摘要，
+摘要附在system消息后面，替代直接丢弃最早的消息
+
+总结在后台线程中进行，不阻塞消息处理；总结完成后，在该会话下一次query或reply时(处理该会话的线程中)替换消息，
+因此不需要给会话加锁。总结完成前仍按原来的方式丢弃超出的消息
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf
+
+SUMMARY_MARK = "\n\n以下是之前对话的摘要：\n"
+
+SUMMARY_PROMPT = "你负责压缩对话历史。请把已有摘要和新的对话合并成一份简洁的摘要，保留用户的身份、偏好、需求、已确定的结论和未解决的问题，省略寒暄和重复内容，不超过{}字，直接输出摘要。"
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session-compactor")
+_RUNNING = "running"
+DETACHED = "detached"  # 会话副本(如对冲请求使用的)不参与压缩
+
+# session_id -> 累计节省的上下文token数
+saved_tokens = ExpiredDict(86400)
+
+
+def enabled() -> bool:
+    return conf().get("session_compaction", False)
+
+
+def split_summary(system_content):
+    """
+    :return: (原system prompt, 摘要)
+    """
+    if SUMMARY_MARK not in system_content:
+        return system_content, ""
+    prompt, summary = system_content.split(SUMMARY_MARK, 1)
+    return prompt, summary
+
+
+def build_prompt(previous_summary, messages) -> list:
+    """构造请求总结模型的消息"""
+    lines = []
+    if previous_summary:
+        lines.append("已有摘要：\n" + previous_summary)
+    lines.append("新的对话：")
+    for message in messages:
+        role = "用户" if message.get("role") == "user" else "助手"
+        lines.append("{}：{}".format(role, message.get("content")))
+    max_length = conf().get("session_compaction_summary_length", 300)
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT.format(max_length)},
+        {"role": "user", "content": "\n".join(lines)},
+    ]
+
+
+def compact(session, cur_tokens, max_tokens):
+    """
+    在session的discard_exceeding中调用：先应用已完成的摘要，上下文仍超过阈值时在后台开始新的总结
+    :return: 应用摘要后的token数
+    """
+    if _apply(session):
+        cur_tokens = session.calc_tokens()
+    if cur_tokens > max_tokens * conf().get("session_compaction_ratio", 0.7):
+        _schedule(session)
+    return cur_tokens
+
+
+def _schedule(session):
+    if getattr(session, "compaction", None) is not None:
+        return
+    messages = session.messages
+    if not messages or messages[0].get("role") != "system":
+        return
+    # 保留最近的消息原文，保留部分从用户消息开始
+    cut = len(messages) - max(2, conf().get("session_compaction_keep_messages", 4))
+    while cut > 1 and messages[cut].get("role") != "user":
+        cut -= 1
+    if cut < 3:
+        return
+    folded = messages[1:cut]
+    session.compaction = _RUNNING
+    _executor.submit(_summarize, session, messages[0], folded)
+
+
+def _summarize(session, system_message, folded):
+    try:
+        _, previous_summary = split_summary(system_message["content"])
+        summary = session.summarize(build_prompt(previous_summary, folded))
+        if not summary:
+            raise ValueError("empty summary")
+        session.compaction = (system_message, folded, summary.strip())
+    except Exception as e:
+        logger.warn("[SessionCompactor] failed to summarize session {}: {}".format(session.session_id, e))
+        session.compaction = None
+
+
+def _apply(session) -> bool:
+    pending = getattr(session, "compaction", None)
+    if not isinstance(pending, tuple):
+        return False
+    session.compaction = None
+    system_message, folded, summary = pending
+    messages = session.messages
+    if not messages or messages[0] is not system_message:
+        # 总结期间会话被重置或已经应用过其他摘要
+        return False
+    before = session.calc_tokens()
+    # 总结期间可能已经丢弃了部分被总结的消息，只移除还在的
+    folded_ids = {id(message) for message in folded}
+    i = 1
+    while i < len(messages) and id(messages[i]) in folded_ids:
+        i += 1
+    prompt, _ = split_summary(system_message["content"])
+    session.messages = [{"role": "system", "content": prompt + SUMMARY_MARK + summary}] + messages[i:]
+    after = session.calc_tokens()
+    saved = before - after
+    saved_tokens[session.session_id] = saved_tokens.get(session.session_id, 0) + saved
+    logger.info("[SessionCompactor] session {} summarized {} messages, tokens {} -> {}".format(session.session_id, len(folded), before, after))
+    return True
+
+
+def metrics() -> dict:
+    items = saved_tokens.items()
+    return {"sessions": len(items), "saved_tokens": sum(saved for _, saved in items), "top": sorted(items, key=lambda item: item[1], reverse=True)[:5]}
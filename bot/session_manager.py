@@ -1,7 +1,28 @@
+import contextlib
+import contextvars
+import copy
+import zlib
+
+from common import session_store
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from config import conf
 
+_scratch = contextvars.ContextVar("scratch_sessions", default=None)
+
+
+@contextlib.contextmanager
+def scratch_sessions():
+    """
+    块内(包括复制了当前上下文的线程和task)读写的是会话的副本，修改不写回进程内缓存和存储，结束后丢弃
+    对冲请求在副本上调用bot，落败的请求不会改动真实的会话，由bridge只把胜出的一轮写入会话
+    """
+    token = _scratch.set({})
+    try:
+        yield
+    finally:
+        _scratch.reset(token)
+
 
 class Session(object):
     def __init__(self, session_id, system_prompt=None):
@@ -17,6 +38,12 @@ class Session(object):
         system_item = {"role": "system", "content": self.system_prompt}
         self.messages = [system_item]
 
+    def copy(self):
+        """会话的副本，修改副本的消息不影响原会话"""
+        session = copy.copy(self)
+        session.messages = [dict(message) for message in self.messages]
+        return session
+
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
         self.reset()
@@ -32,6 +59,24 @@ class Session(object):
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
 
+    def block_discard_index(self, start, excess, count):
+        """
+        前缀缓存模式(prompt_cache)下，超出上限时一次丢弃一整块较早的消息，而不是每轮丢弃一条，
+        之后的多轮对话只在末尾追加消息，前缀保持不变，可以命中模型服务商的提示词缓存
+        :param start: 可丢弃的第一条消息，之前的system消息保留
+        :param excess: 至少需要丢弃的token数
+        :param count: count(i)返回第i条消息的token数
+        :return: cut，丢弃messages[start:cut]后保留部分从用户消息开始，最后一条消息总是保留
+        """
+        last = len(self.messages) - 1
+        cut, removed = start, 0
+        while cut < last and removed < excess:
+            removed += count(cut)
+            cut += 1
+        while cut < last and self.messages[cut].get("role") != "user":
+            cut += 1
+        return cut
+
     def calc_tokens(self):
         raise NotImplementedError
 
@@ -42,9 +87,13 @@ class SessionManager(object):
             sessions = ExpiredDict(conf().get("expires_in_seconds"))
         else:
             sessions = dict()
-        self.sessions = sessions
+        self.sessions = sessions  # 进程内缓存，持久化存储中的会话在首次使用时加载
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.store = session_store.get_store()
+        self.store_prefix = sessioncls.__name__ + ":"
+        self.store_shared = self.store.persistent and conf().get("session_store_shared", False)
+        self.cache_usage = ExpiredDict(conf().get("expires_in_seconds") or 86400)  # session_id -> [提示词token数, 命中缓存的token数]
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -53,14 +102,68 @@ class SessionManager(object):
         """
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
-
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+        scratch = _scratch.get()
+        if scratch is not None:
+            return self._build_scratch_session(scratch, session_id, system_prompt)
+
+        session = self._load_session(session_id)
+        if session is None:
+            session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            self.sessions[session_id] = session
+            self.save_session(session)
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
+            session.set_system_prompt(system_prompt)
+            self.save_session(session)
+        return session
+
+    def _build_scratch_session(self, scratch, session_id, system_prompt):
+        session = scratch.get((self, session_id))
+        if session is None:
+            origin = self._load_session(session_id)
+            if origin is None:
+                session = self.sessioncls(session_id, system_prompt, **self.session_args)
+                system_prompt = None
+            else:
+                session = origin.copy()
+            scratch[(self, session_id)] = session
+        if system_prompt is not None:
+            session.set_system_prompt(system_prompt)
         return session
 
+    def _load_session(self, session_id):
+        """
+        优先使用进程内缓存；多实例共享会话时，存储中的数据被其他实例修改过才重新加载
+        """
+        session = self.sessions.get(session_id)
+        if not self.store.persistent or (session is not None and not self.store_shared):
+            return session
+        try:
+            payload = self.store.load(self.store_prefix + session_id)
+            if payload is None:
+                return None
+            revision = zlib.crc32(payload)
+            if session is not None and getattr(session, "store_revision", None) == revision:
+                return session
+            system_prompt, messages = session_store.loads(payload)
+        except Exception as e:
+            logger.warn("[SessionStore] failed to load session {}: {}".format(session_id, e))
+            return session
+        session = self.sessioncls(session_id, system_prompt, **self.session_args)
+        session.messages = messages
+        session.store_revision = revision
+        self.sessions[session_id] = session
+        return session
+
+    def save_session(self, session):
+        """
+        会话被修改后调用，由后台线程异步写入存储
+        """
+        if not self.store.persistent or session.session_id is None or _scratch.get() is not None:
+            return
+        payload = session_store.dumps(session.system_prompt, session.messages)
+        session.store_revision = zlib.crc32(payload)
+        self.store.put(self.store_prefix + session.session_id, payload)
+
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
         session.add_query(query)
@@ -70,6 +173,7 @@ class SessionManager(object):
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -81,11 +185,43 @@ class SessionManager(object):
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_session(session)
         return session
 
+    def record_cache_usage(self, session_id, prompt_tokens, cached_tokens):
+        """
+        记录模型返回的提示词token数和其中命中服务商提示词缓存的token数
+        """
+        if session_id is None or not prompt_tokens:
+            return
+        usage = self.cache_usage.get(session_id)
+        if usage is None:
+            usage = self.cache_usage[session_id] = [0, 0]
+        usage[0] += prompt_tokens
+        usage[1] += cached_tokens or 0
+        if cached_tokens:
+            logger.debug("[Session] session {} prompt cache hit {}/{} tokens".format(session_id, cached_tokens, prompt_tokens))
+
+    def cache_usage_stats(self) -> dict:
+        items = self.cache_usage.items()
+        prompt_tokens = sum(usage[0] for _, usage in items)
+        cached_tokens = sum(usage[1] for _, usage in items)
+        return {
+            "sessions": len(items),
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "hit_rate": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+        }
+
     def clear_session(self, session_id):
+        scratch = _scratch.get()
+        if scratch is not None:
+            scratch[(self, session_id)] = self.sessioncls(session_id, None, **self.session_args)
+            return
         if session_id in self.sessions:
             del self.sessions[session_id]
+        self.store.delete(self.store_prefix + session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        self.store.clear(self.store_prefix)
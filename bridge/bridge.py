@@ -1,13 +1,51 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 from bot.bot_factory import create_bot
-from bridge.context import Context
-from bridge.reply import Reply
+from bot.session_manager import scratch_sessions
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
 from common import const
+from common.reply_cache import ReplyCache
+from common.circuit_breaker import CircuitBreaker
 from common.log import logger
 from common.singleton import singleton
-from config import conf
+from config import conf, override
 from translate.factory import create_translator
 from voice.factory import create_voice
 
+# 主后端耗时样本少于该数量时，对冲等待时间使用hedge_delay配置
+HEDGE_MIN_SAMPLES = 20
+
+
+class ChatBackend:
+    """
+    chat_backends中的一个模型后端，可以为该后端单独覆盖model、api key等配置
+    """
+
+    def __init__(self, bot_type, overrides=None, weight=None, name=None):
+        self.bot_type = bot_type
+        self.overrides = overrides or {}
+        self.weight = weight
+        self.name = name or (bot_type + (":" + self.overrides["model"] if self.overrides.get("model") else ""))
+        self.bot = None
+        self.breaker = CircuitBreaker(
+            self.name,
+            failure_threshold=conf().get("circuit_breaker_failures", 5),
+            error_rate=conf().get("circuit_breaker_error_rate", 0.5),
+            cooldown=conf().get("circuit_breaker_cooldown", 30),
+        )
+
+    def get_bot(self):
+        if self.bot is None:
+            with override(self.overrides):
+                self.bot = create_bot(self.bot_type)
+        return self.bot
+
 
 @singleton
 class Bridge(object):
@@ -64,6 +102,14 @@ class Bridge(object):
 
         self.bots = {}
         self.chat_bots = {}
+        self.chat_backends = self._load_chat_backends()
+        self.hedge_executor = None
+        self.hedge_lock = threading.Lock()
+        self.reply_cache = ReplyCache(
+            conf().get("reply_cache_ttl", 3600),
+            conf().get("reply_cache_max_size", 1000),
+            conf().get("reply_cache_similarity", 0),
+        )
 
     # 模型对应的接口
     def get_bot(self, typename):
@@ -74,7 +120,10 @@ class Bridge(object):
             elif typename == "voice_to_text":
                 self.bots[typename] = create_voice(self.btype[typename])
             elif typename == "chat":
-                self.bots[typename] = create_bot(self.btype[typename])
+                if self.chat_backends:
+                    self.bots[typename] = self.chat_backends[0].get_bot()
+                else:
+                    self.bots[typename] = create_bot(self.btype[typename])
             elif typename == "translate":
                 self.bots[typename] = create_translator(self.btype[typename])
         return self.bots[typename]
@@ -82,8 +131,342 @@ class Bridge(object):
     def get_bot_type(self, typename):
         return self.btype[typename]
 
+    def _load_chat_backends(self):
+        """
+        chat_backends配置多个模型后端时，按顺序(或配置了weight时按权重随机选择首选)调用，失败或熔断时切换到下一个
+        每项可以是bot_type，也可以是包含bot_type及需要覆盖的配置的dict，如 {"bot_type": "moonshot", "model": "moonshot-v1-8k", "weight": 2}
+        """
+        backends = []
+        for item in conf().get("chat_backends") or []:
+            if isinstance(item, str):
+                item = {"bot_type": item}
+            item = dict(item)
+            bot_type = item.pop("bot_type", None)
+            if not bot_type:
+                logger.warn("[Bridge] chat backend without bot_type: {}".format(item))
+                continue
+            weight = item.pop("weight", None)
+            name = item.pop("name", None)
+            backends.append(ChatBackend(bot_type, item, weight, name))
+        if len(backends) == 1:
+            self.btype["chat"] = backends[0].bot_type
+        if backends:
+            logger.info("[Bridge] chat backends: {}".format([backend.name for backend in backends]))
+        return backends
+
+    def _route_chat_backends(self):
+        """
+        :return: 本次请求依次尝试的后端，不包括熔断中的后端
+        """
+        backends = [backend for backend in self.chat_backends if backend.breaker.available()]
+        weighted = [backend for backend in backends if backend.weight]
+        if weighted:
+            first = random.choices(weighted, weights=[backend.weight for backend in weighted])[0]
+            backends.remove(first)
+            backends.insert(0, first)
+        return backends
+
+    def _backend_overrides(self, backend: ChatBackend, is_last):
+        # 还有备用后端时不在bot内部重试，失败后立即切换
+        if is_last:
+            return backend.overrides
+        return {**backend.overrides, "request_max_retries": 0}
+
+    @staticmethod
+    def _reply_ok(reply: Reply):
+        return reply is not None and reply.type != ReplyType.ERROR
+
+    def _record_backend_result(self, backend: ChatBackend, reply: Reply, start, next_backend):
+        """
+        :return: 是否调用成功
+        """
+        latency = time.monotonic() - start
+        if self._reply_ok(reply):
+            backend.breaker.record_success(latency)
+            return True
+        backend.breaker.record_failure(latency)
+        if next_backend:
+            logger.warn("[Bridge] chat backend {} failed, fail over to {}".format(backend.name, next_backend.name))
+        return False
+
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        if context and context.is_expired():
+            return self._expired_reply(context)
+        cache = self._reply_cache_scope(query, context)
+        if cache is not None:
+            reply = self._cached_reply(query, context, cache)
+            if reply is not None:
+                return reply
+        reply = self._fetch_chat_reply(query, context)
+        if cache is not None:
+            self._cache_reply(query, cache, reply)
+        return reply
+
+    def _fetch_chat_reply(self, query, context: Context) -> Reply:
+        if len(self.chat_backends) <= 1:
+            return self.get_bot("chat").reply(query, context)
+        reply, error = None, None
+        backends = self._route_chat_backends()
+        if self._should_hedge(query, context, backends) and backends[0].breaker.allow():
+            reply, error = self._hedged_fetch(query, context, backends[0], backends[1])
+            if error is None and self._reply_ok(reply):
+                return reply
+            backends = backends[2:]
+        for i, backend in enumerate(backends):
+            if not backend.breaker.allow():
+                continue
+            next_backend = backends[i + 1] if i + 1 < len(backends) else None
+            start = time.monotonic()
+            try:
+                with override(self._backend_overrides(backend, next_backend is None)):
+                    reply, error = backend.get_bot().reply(query, context), None
+            except Exception as e:
+                logger.exception("[Bridge] chat backend {} error: {}".format(backend.name, e))
+                reply, error = None, e
+            if self._record_backend_result(backend, reply, start, next_backend):
+                return reply
+        if error is not None:
+            raise error
+        return reply or Reply(ReplyType.ERROR, "模型服务暂不可用，请稍后再试")
+
+    async def async_fetch_reply_content(self, query, context: Context) -> Reply:
+        if context and context.is_expired():
+            return self._expired_reply(context)
+        cache = self._reply_cache_scope(query, context)
+        if cache is not None:
+            reply = self._cached_reply(query, context, cache)
+            if reply is not None:
+                return reply
+        reply = await self._async_fetch_chat_reply(query, context)
+        if cache is not None:
+            self._cache_reply(query, cache, reply)
+        return reply
+
+    async def _async_fetch_chat_reply(self, query, context: Context) -> Reply:
+        if len(self.chat_backends) <= 1:
+            return await self.get_bot("chat").async_reply(query, context)
+        reply, error = None, None
+        backends = self._route_chat_backends()
+        if self._should_hedge(query, context, backends) and backends[0].breaker.allow():
+            reply, error = await self._async_hedged_fetch(query, context, backends[0], backends[1])
+            if error is None and self._reply_ok(reply):
+                return reply
+            backends = backends[2:]
+        for i, backend in enumerate(backends):
+            if not backend.breaker.allow():
+                continue
+            next_backend = backends[i + 1] if i + 1 < len(backends) else None
+            start = time.monotonic()
+            try:
+                with override(self._backend_overrides(backend, next_backend is None)):
+                    reply, error = await backend.get_bot().async_reply(query, context), None
+            except Exception as e:
+                logger.exception("[Bridge] chat backend {} error: {}".format(backend.name, e))
+                reply, error = None, e
+            if self._record_backend_result(backend, reply, start, next_backend):
+                return reply
+        if error is not None:
+            raise error
+        return reply or Reply(ReplyType.ERROR, "模型服务暂不可用，请稍后再试")
+
+    def _reply_cache_scope(self, query, context: Context):
+        """
+        判断消息能否使用回复缓存，回复可能因人而异时不使用：
+        有较多上下文(多轮对话)、流式回复、清除记忆等指令、reply_cache_exclude中的群或用户、插件设置了context["reply_cache"] = False
+        :return: 可以使用时返回(scope, history)，否则返回None
+        """
+        if not conf().get("reply_cache", False) or context is None or context.type != ContextType.TEXT:
+            return None
+        if context.get("reply_cache") is False or context.get("stream") or query in conf().get("clear_memory_commands", ["#清除记忆"]):
+            self.reply_cache.skip()
+            return None
+        exclude = conf().get("reply_cache_exclude") or []
+        if exclude and (context.get("session_id") in exclude or context.get("receiver") in exclude or getattr(context.get("msg"), "other_user_nickname", None) in exclude):
+            self.reply_cache.skip()
+            return None
+        sessions = getattr(self.get_bot("chat"), "sessions", None)
+        session_id = context.get("session_id")
+        if sessions is None or session_id is None:
+            return None
+        session = sessions.build_session(session_id)
+        history = tuple((message.get("role"), message.get("content")) for message in session.messages if message.get("role") != "system")
+        if len(history) > conf().get("reply_cache_context_messages", 0):
+            self.reply_cache.skip()
+            return None
+        # 用户通过#set_gpt_model切换的模型优先于配置中的模型，不同模型的回复不能互相命中
+        scope = (self.btype["chat"], context.get("gpt_model") or conf().get("model"), session.system_prompt)
+        return scope, history
+
+    def _cached_reply(self, query, context: Context, cache):
+        scope, history = cache
+        content = self.reply_cache.get(scope, history, query)
+        if content is None:
+            return None
+        logger.info("[Bridge] reply cache hit, session_id={}".format(context.get("session_id")))
+        # 命中时也记入会话，用户可以接着追问
+        sessions = self.get_bot("chat").sessions
+        sessions.session_query(query, context["session_id"])
+        sessions.session_reply(content, context["session_id"])
+        return Reply(ReplyType.TEXT, content)
+
+    def _cache_reply(self, query, cache, reply: Reply):
+        # 只缓存bot标记为调用成功的回复，bot以TEXT返回的限流、重试失败等提示不会缓存给其他用户
+        if reply is not None and reply.type == ReplyType.TEXT and reply.cacheable and reply.content:
+            scope, history = cache
+            self.reply_cache.put(scope, history, query, reply.content)
+
+    def _should_hedge(self, query, context: Context, backends):
+        if not conf().get("hedge_requests", False) or len(backends) < 2:
+            return False
+        # 清除记忆等指令需要修改真实的会话，不在会话副本上执行
+        if query in conf().get("clear_memory_commands", ["#清除记忆"]) or query == "#清除所有":
+            return False
+        # 流式回复在开始返回时就结束了请求，对冲没有意义
+        return not (context and context.get("stream"))
+
+    def _hedge_delay(self, backend: ChatBackend):
+        """
+        发送对冲请求前等待主后端的时间：主后端近期耗时的hedge_percentile分位数，不小于hedge_min_delay
+        """
+        latency = backend.breaker.latency
+        if len(latency.samples) < HEDGE_MIN_SAMPLES:
+            delay = conf().get("hedge_delay", 10)
+        else:
+            delay = latency.percentile(conf().get("hedge_percentile", 95))
+        return max(conf().get("hedge_min_delay", 2), delay)
+
+    def _hedge_won(self, backend: ChatBackend, reply: Reply, error):
+        """先返回成功回复的请求胜出"""
+        if error is not None or not self._reply_ok(reply):
+            return False
+        return True
+
+    def _record_hedge_turn(self, backends, query, context: Context, reply: Reply):
+        """
+        对冲请求在会话副本上执行，胜出后只把胜出的一轮写入主、备后端的会话(不论是否发出了对冲请求)，两个后端的上下文保持一致
+        在处理该消息的线程中写入，落败的请求之后结束也不会改动会话
+        """
+        session_id = context.get("session_id") if context else None
+        if reply.type != ReplyType.TEXT or session_id is None:
+            return
+        for backend in backends:
+            sessions = getattr(backend.get_bot(), "sessions", None)
+            if sessions is None:
+                continue
+            try:
+                sessions.session_query(query, session_id)
+                sessions.session_reply(reply.content, session_id)
+            except Exception as e:
+                logger.warn("[Bridge] failed to record hedged reply in session of {}: {}".format(backend.name, e))
+
+    def _run_attempt(self, backend: ChatBackend, query, context: Context):
+        start = time.monotonic()
+        try:
+            with override(self._backend_overrides(backend, False)), scratch_sessions():
+                reply, error = backend.get_bot().reply(query, context), None
+        except Exception as e:
+            logger.exception("[Bridge] chat backend {} error: {}".format(backend.name, e))
+            reply, error = None, e
+        # 落败的请求返回后也记录耗时，否则耗时统计只剩较快的请求，对冲等待时间会越来越短
+        self._record_backend_result(backend, reply, start, None)
+        return reply, error
+
+    def _submit_attempt(self, backend: ChatBackend, query, context: Context):
+        with self.hedge_lock:
+            if self.hedge_executor is None:
+                # 每个处理线程同时最多有主、备两个请求
+                workers = 2 * max(conf().get("handler_pool_size", 8), conf().get("handler_pool_max_size", 0))
+                self.hedge_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hedge")
+        # 在复制的上下文中执行，override不会影响其他请求
+        return self.hedge_executor.submit(contextvars.copy_context().run, self._run_attempt, backend, query, context)
+
+    def _hedged_fetch(self, query, context: Context, primary: ChatBackend, secondary: ChatBackend):
+        """
+        对冲请求：先请求primary，超过_hedge_delay仍未回复(或已失败)时再请求secondary，采用先成功的回复
+        线程无法中断，落败的请求会继续执行完，但结果被丢弃；请求都在会话副本上执行，胜出后只把胜出的一轮写入会话
+        :return: (reply, error)
+        """
+        delay = self._hedge_delay(primary)
+        pending = {self._submit_attempt(primary, query, context): primary}
+        hedged = False
+        reply, error = None, None
+        while pending:
+            done, _ = wait(pending, timeout=None if hedged else delay, return_when=FIRST_COMPLETED)
+            for future in done:
+                backend = pending.pop(future)
+                reply, error = future.result()
+                if self._hedge_won(backend, reply, error):
+                    for other, other_backend in pending.items():
+                        # 还没开始执行就被取消的请求不会记录结果，归还half_open的探测名额
+                        if other.cancel():
+                            other_backend.breaker.release_probe()
+                    if hedged:
+                        logger.info("[Bridge] hedged request won by {}".format(backend.name))
+                    self._record_hedge_turn((primary, secondary), query, context, reply)
+                    return reply, None
+            if not hedged:
+                hedged = True
+                if secondary.breaker.allow():
+                    logger.info("[Bridge] chat backend {} no reply in {:.1f}s, hedge to {}".format(primary.name, delay, secondary.name))
+                    pending[self._submit_attempt(secondary, query, context)] = secondary
+        return reply, error
+
+    async def _async_run_attempt(self, backend: ChatBackend, query, context: Context):
+        # 每个task有独立的上下文，override不会影响其他请求
+        start = time.monotonic()
+        try:
+            with override(self._backend_overrides(backend, False)), scratch_sessions():
+                reply, error = await backend.get_bot().async_reply(query, context), None
+        except asyncio.CancelledError:
+            # 被取消的请求只记录已等待的时长，没有成功或失败的结果，归还half_open的探测名额
+            backend.breaker.latency.add(time.monotonic() - start)
+            backend.breaker.release_probe()
+            raise
+        except Exception as e:
+            logger.exception("[Bridge] chat backend {} error: {}".format(backend.name, e))
+            reply, error = None, e
+        self._record_backend_result(backend, reply, start, None)
+        return reply, error
+
+    async def _async_hedged_fetch(self, query, context: Context, primary: ChatBackend, secondary: ChatBackend):
+        """
+        _hedged_fetch的asyncio版本，胜出后取消另一个请求
+        """
+        delay = self._hedge_delay(primary)
+        pending = {asyncio.ensure_future(self._async_run_attempt(primary, query, context)): primary}
+        hedged = False
+        reply, error = None, None
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=None if hedged else delay, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                backend = pending.pop(task)
+                reply, error = task.result()
+                if self._hedge_won(backend, reply, error):
+                    for other, other_backend in pending.items():
+                        # 还没开始执行就被取消的请求不会记录结果，归还half_open的探测名额
+                        if other.cancel():
+                            other_backend.breaker.release_probe()
+                    if hedged:
+                        logger.info("[Bridge] hedged request won by {}".format(backend.name))
+                    self._record_hedge_turn((primary, secondary), query, context, reply)
+                    return reply, None
+            if not hedged:
+                hedged = True
+                if secondary.breaker.allow():
+                    logger.info("[Bridge] chat backend {} no reply in {:.1f}s, hedge to {}".format(primary.name, delay, secondary.name))
+                    pending[asyncio.ensure_future(self._async_run_attempt(secondary, query, context))] = secondary
+        return reply, error
+
+    def chat_backend_stats(self) -> dict:
+        return {backend.name: backend.breaker.metrics() for backend in self.chat_backends}
+
+    def _expired_reply(self, context: Context) -> Reply:
+        # 消息已超过处理期限(如插件或语音识别耗时过长)，不再调用模型
+        logger.warning("[Bridge] message deadline exceeded, skip bot, session_id={}".format(context.get("session_id")))
+        busy_reply = conf().get("busy_reply", "当前消息较多，请稍后再试")
+        if busy_reply:
+            return Reply(ReplyType.TEXT, busy_reply)
+        return Reply()
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import time
 from enum import Enum
 
 
@@ -24,10 +25,10 @@ class ContextType(Enum):
 
 
 class Context:
-    def __init__(self, type: ContextType = None, content=None, kwargs=dict()):
+    def __init__(self, type: ContextType = None, content=None, kwargs=None):
         self.type = type
         self.content = content
-        self.kwargs = kwargs
+        self.kwargs = kwargs if kwargs is not None else dict()
 
     def __contains__(self, key):
         if key == "type":
@@ -67,5 +68,25 @@ class Context:
         else:
             del self.kwargs[key]
 
+    def set_deadline(self, seconds):
+        """
+        设置处理期限，超过期限仍未处理完的消息不再调用模型
+        :param seconds: 距现在的秒数
+        """
+        self.kwargs["deadline"] = time.monotonic() + seconds
+
+    def time_left(self):
+        """
+        :return: 距处理期限的剩余秒数，没有设置期限时返回None
+        """
+        deadline = self.kwargs.get("deadline")
+        if deadline is None:
+            return None
+        return deadline - time.monotonic()
+
+    def is_expired(self) -> bool:
+        time_left = self.time_left()
+        return time_left is not None and time_left <= 0
+
     def __str__(self):
         return "Context(type={}, content={}, kwargs={})".format(self.type, self.content, self.kwargs)
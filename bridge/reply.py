@@ -17,15 +17,17 @@ class ReplyType(Enum):
     TEXT_ = 11  # 强制文本
     VIDEO = 12
     MINIAPP = 13  # 小程序
+    TEXT_STREAM = 14  # 流式文本，content为逐段产出文本增量的生成器
 
     def __str__(self):
         return self.name
 
 
 class Reply:
-    def __init__(self, type: ReplyType = None, content=None):
+    def __init__(self, type: ReplyType = None, content=None, cacheable=False):
         self.type = type
         self.content = content
+        self.cacheable = cacheable  # 模型正常生成的回复，bot确认调用成功时才设置，只有这类回复会进入回复缓存(reply_cache)
 
     def __str__(self):
         return "Reply(type={}, content={})".format(self.type, self.content)
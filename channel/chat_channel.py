@@ -1,15 +1,20 @@
 import os
-import re
 import threading
 import time
 from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import Future
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
 from common.dequeue import Dequeue
-from common import memory
+from common.event_loop import run_coroutine, run_sync
+from common.fair_queue import FairScheduler
+from common.mention import strip_mentions
+from common.trigger_index import trigger_index
+from common.worker_pool import WorkerLane, WorkerPool
+from common import memory, stream
+from config import global_config
 from plugins import *
 
 try:
@@ -17,7 +22,18 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+# 处理消息的线程池，轻量消息和耗时消息分开排队，避免模型接口变慢时阻塞指令等消息
+handler_pool = WorkerPool(
+    {
+        WorkerPool.HEAVY: WorkerLane(
+            WorkerPool.HEAVY,
+            conf().get("handler_pool_size", 8),
+            max_workers=conf().get("handler_pool_max_size", 0),
+            scale_queue_depth=conf().get("handler_pool_scale_queue_depth", 1),
+        ),
+        WorkerPool.LIGHT: WorkerLane(WorkerPool.LIGHT, conf().get("handler_pool_light_size", 2)),
+    }
+)
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
@@ -26,7 +42,12 @@ class ChatChannel(Channel):
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    lock = threading.RLock()  # 用于控制对sessions的访问，可重入：取消future时回调会在持锁线程中同步执行
+    ready_sessions = FairScheduler()  # 有待处理消息且未达到并发上限的session_id，按租户(私聊用户、群)加权轮转
+    ready_cond = threading.Condition(lock)  # 有session就绪或任务结束时通知消费者线程
+    inflight = {}  # 租户 -> 处理中的模型调用数
+    heavy_inflight = 0  # 已提交到heavy线程池且未结束的任务数
+    queued_total = 0  # 所有会话排队中的消息数
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
@@ -44,6 +65,7 @@ class ChatChannel(Channel):
             context["origin_ctype"] = ctype
         # context首次传入时，receiver是None，根据类型设置receiver
         first_in = "receiver" not in context
+        triggers = trigger_index()
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
             config = conf()
@@ -56,12 +78,11 @@ class ChatChannel(Channel):
                 group_id = cmsg.other_user_id
 
                 group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
                 if any(
                     [
                         group_name in group_name_white_list,
                         "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
+                        triggers.match(group_name, contain=("group_name_keyword_white_list",))["group_name_keyword_white_list"],
                     ]
                 ):
                     group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
@@ -99,8 +120,8 @@ class ChatChannel(Channel):
             nick_name_black_list = conf().get("nick_name_black_list", [])
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match = triggers.match(content, prefix=("group_chat_prefix",), contain=("group_chat_keyword",))
+                match_prefix, match_contain = match["group_chat_prefix"], match["group_chat_keyword"]
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
                     if match_prefix is not None or match_contain is not None:
@@ -118,16 +139,13 @@ class ChatChannel(Channel):
                         if not conf().get("group_at_off", False):
                             flag = True
                         self.name = self.name if self.name is not None else ""  # 部分渠道self.name可能没有赋值
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        mentions = [self.name]
                         if isinstance(context["msg"].at_list, list):
-                            for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                            mentions.extend(context["msg"].at_list)
+                        subtract_res = strip_mentions(content, mentions)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = strip_mentions(content, (context["msg"].self_display_name,))
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
@@ -140,7 +158,7 @@ class ChatChannel(Channel):
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = triggers.match(content, prefix=("single_chat_prefix",))["single_chat_prefix"]
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -149,7 +167,7 @@ class ChatChannel(Channel):
                     logger.info("[chat_channel]receive single chat msg, but checkprefix didn't match")
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""]))
+            img_match_prefix = triggers.match(content, prefix=("image_create_prefix",))["image_create_prefix"]
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
@@ -158,6 +176,8 @@ class ChatChannel(Channel):
             context.content = content.strip()
             if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
+            if "stream" not in context and conf().get("stream_reply") and context.get("desire_rtype") != ReplyType.VOICE:
+                context["stream"] = True
         elif context.type == ContextType.VOICE:
             if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
@@ -172,65 +192,108 @@ class ChatChannel(Channel):
 
         logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
-        # reply的包装步骤
         if reply and reply.content:
-            reply = self._decorate_reply(context, reply)
+            self._decorate_and_send(context, reply)
+
+    async def _async_handle(self, context: Context):
+        """
+        异步模式下的处理流程，模型请求在事件循环中等待，插件事件和发送等同步步骤放到线程池执行
+        """
+        if context is None or not context.content:
+            return
+        logger.debug("[chat_channel] ready to async handle context: {}".format(context))
+        reply = await self._async_generate_reply(context)
+
+        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+        if reply and reply.content:
+            await run_sync(self._decorate_and_send, context, reply)
 
-            # reply的发送步骤
-            self._send_reply(context, reply)
+    def _decorate_and_send(self, context: Context, reply: Reply):
+        # reply的包装步骤
+        reply = self._decorate_reply(context, reply)
+
+        # reply的发送步骤
+        self._send_reply(context, reply)
 
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
+        e_context = self._emit_handle_context(context, reply)
+        if e_context.is_pass():
+            return e_context["reply"]
+        if self._need_bot_reply(context):
+            context["channel"] = e_context["channel"]
+            return super().build_reply_content(context.content, context)
+        return self._reply_by_type(context, e_context["reply"])
+
+    async def _async_generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
+        """
+        _generate_reply的异步版本，只有调用模型的步骤不同，插件事件和其他类型消息的处理在线程池中执行
+        """
+        e_context = await run_sync(self._emit_handle_context, context, reply)
+        if e_context.is_pass():
+            return e_context["reply"]
+        if self._need_bot_reply(context):
+            context["channel"] = e_context["channel"]
+            return await super().async_build_reply_content(context.content, context)
+        return await run_sync(self._reply_by_type, context, e_context["reply"])
+
+    def _emit_handle_context(self, context: Context, reply: Reply) -> EventContext:
         e_context = PluginManager().emit_event(
             EventContext(
                 Event.ON_HANDLE_CONTEXT,
                 {"channel": self, "context": context, "reply": reply},
             )
         )
-        reply = e_context["reply"]
         if not e_context.is_pass():
             logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
-            if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
-                context["channel"] = e_context["channel"]
-                reply = super().build_reply_content(context.content, context)
-            elif context.type == ContextType.VOICE:  # 语音消息
-                cmsg = context["msg"]
-                cmsg.prepare()
-                file_path = context.content
-                wav_path = os.path.splitext(file_path)[0] + ".wav"
-                try:
-                    any_to_wav(file_path, wav_path)
-                except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
-                    logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
-                    wav_path = file_path
-                # 语音识别
-                reply = super().build_voice_to_text(wav_path)
-                # 删除临时文件
-                try:
-                    os.remove(file_path)
-                    if wav_path != file_path:
-                        os.remove(wav_path)
-                except Exception as e:
-                    pass
-                    # logger.warning("[chat_channel]delete temp file error: " + str(e))
+        return e_context
 
-                if reply.type == ReplyType.TEXT:
-                    new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
-                    if new_context:
-                        reply = self._generate_reply(new_context)
-                    else:
-                        return
-            elif context.type == ContextType.IMAGE:  # 图片消息，当前仅做下载保存到本地的逻辑
-                memory.USER_IMAGE_CACHE[context["session_id"]] = {
-                    "path": context.content,
-                    "msg": context.get("msg")
-                }
-            elif context.type == ContextType.SHARING:  # 分享信息，当前无默认逻辑
-                pass
-            elif context.type == ContextType.FUNCTION or context.type == ContextType.FILE:  # 文件消息及函数调用等，当前无默认逻辑
+    @staticmethod
+    def _need_bot_reply(context: Context) -> bool:
+        return context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE  # 文字和图片消息
+
+    def _reply_by_type(self, context: Context, reply: Reply) -> Reply:
+        """
+        不需要调用模型的消息类型的默认处理
+        """
+        if context.type == ContextType.VOICE:  # 语音消息
+            cmsg = context["msg"]
+            cmsg.prepare()
+            file_path = context.content
+            wav_path = os.path.splitext(file_path)[0] + ".wav"
+            try:
+                any_to_wav(file_path, wav_path)
+            except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
+                logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
+                wav_path = file_path
+            # 语音识别
+            reply = super().build_voice_to_text(wav_path)
+            # 删除临时文件
+            try:
+                os.remove(file_path)
+                if wav_path != file_path:
+                    os.remove(wav_path)
+            except Exception as e:
                 pass
-            else:
-                logger.warning("[chat_channel] unknown context type: {}".format(context.type))
-                return
+                # logger.warning("[chat_channel]delete temp file error: " + str(e))
+
+            if reply.type == ReplyType.TEXT:
+                new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
+                if new_context:
+                    reply = self._generate_reply(new_context)
+                else:
+                    return
+        elif context.type == ContextType.IMAGE:  # 图片消息，当前仅做下载保存到本地的逻辑
+            memory.USER_IMAGE_CACHE[context["session_id"]] = {
+                "path": context.content,
+                "msg": context.get("msg")
+            }
+        elif context.type == ContextType.SHARING:  # 分享信息，当前无默认逻辑
+            pass
+        elif context.type == ContextType.FUNCTION or context.type == ContextType.FILE:  # 文件消息及函数调用等，当前无默认逻辑
+            pass
+        else:
+            logger.warning("[chat_channel] unknown context type: {}".format(context.type))
+            return
         return reply
 
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
@@ -261,6 +324,17 @@ class ChatChannel(Channel):
                     else:
                         reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
                     reply.content = reply_text
+                elif reply.type == ReplyType.TEXT_STREAM:
+                    if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+                        return self._decorate_reply(context, Reply(ReplyType.TEXT, stream.collect(reply.content)))
+                    if context.get("isgroup", False):
+                        prefix = conf().get("group_chat_reply_prefix", "")
+                        if not context.get("no_need_at", False):
+                            prefix += "@" + context["msg"].actual_user_nickname + "\n"
+                        suffix = conf().get("group_chat_reply_suffix", "")
+                    else:
+                        prefix, suffix = conf().get("single_chat_reply_prefix", ""), conf().get("single_chat_reply_suffix", "")
+                    reply.content = stream.wrap(reply.content, prefix, suffix)
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
                 elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE or reply.type == ReplyType.FILE or reply.type == ReplyType.VIDEO or reply.type == ReplyType.VIDEO_URL:
@@ -283,7 +357,18 @@ class ChatChannel(Channel):
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
-                self._send(reply, context)
+                if reply.type == ReplyType.TEXT_STREAM and not self.SUPPORT_STREAM:
+                    self._send_stream_chunks(reply, context)
+                else:
+                    self._send(reply, context)
+
+    def _send_stream_chunks(self, reply: Reply, context: Context):
+        """
+        不支持增量显示的通道，把流式回复按句合并成若干段文本依次发送
+        """
+        min_length = conf().get("stream_chunk_min_length", 100)
+        for segment in stream.sentence_chunks(reply.content, min_length):
+            self._send(Reply(ReplyType.TEXT, segment), context)
 
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
@@ -293,7 +378,7 @@ class ChatChannel(Channel):
             if isinstance(e, NotImplementedError):
                 return
             logger.exception(e)
-            if retry_cnt < 2:
+            if retry_cnt < 2 and reply.type != ReplyType.TEXT_STREAM:  # 流式回复已被部分消费，无法重发
                 time.sleep(3 + 3 * retry_cnt)
                 self._send(reply, context, retry_cnt + 1)
 
@@ -303,83 +388,269 @@ class ChatChannel(Channel):
     def _fail_callback(self, session_id, exception, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("Worker return exception: {}".format(exception))
 
+    def _notify_result(self, session_id, worker: Future, **kwargs):
+        try:
+            worker_exception = worker.exception()
+            if worker_exception:
+                self._fail_callback(session_id, exception=worker_exception, **kwargs)
+            else:
+                self._success_callback(session_id, **kwargs)
+        except CancelledError as e:
+            logger.info("Worker cancelled, session_id = {}".format(session_id))
+        except Exception as e:
+            logger.exception("Worker raise exception: {}".format(e))
+
     def _thread_pool_callback(self, session_id, **kwargs):
         def func(worker: Future):
-            try:
-                worker_exception = worker.exception()
-                if worker_exception:
-                    self._fail_callback(session_id, exception=worker_exception, **kwargs)
-                else:
-                    self._success_callback(session_id, **kwargs)
-            except CancelledError as e:
-                logger.info("Worker cancelled, session_id = {}".format(session_id))
-            except Exception as e:
-                logger.exception("Worker raise exception: {}".format(e))
+            self._notify_result(session_id, worker, **kwargs)
             with self.lock:
                 self.sessions[session_id][1].release()
+                self._release_inflight(kwargs["context"])
+                self._schedule(session_id)
 
         return func
 
+    def _select_lane(self, context: Context):
+        """
+        选择处理消息的线程池通道，管理指令、插件指令以及不需要调用模型的消息走轻量通道
+        插件可以在ON_RECEIVE_MESSAGE事件中设置context["lane"]指定通道
+        """
+        if context.get("lane"):
+            return context["lane"]
+        if context.type == ContextType.TEXT:
+            content = context.content or ""
+            plugin_trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+            if content.startswith("#") or (plugin_trigger_prefix and content.startswith(plugin_trigger_prefix)):
+                return WorkerPool.LIGHT
+            return WorkerPool.HEAVY
+        if context.type in [ContextType.IMAGE_CREATE, ContextType.VOICE, ContextType.JOIN_GROUP, ContextType.PATPAT]:
+            return WorkerPool.HEAVY
+        return WorkerPool.LIGHT
+
+    def _schedule(self, session_id):
+        """
+        根据session的状态更新就绪队列，调用方需持有self.lock
+        有排队消息且信号量未耗尽时标记为就绪并唤醒消费者；没有排队消息且没有处理中的任务时清理session
+        """
+        if session_id not in self.sessions:
+            return
+        context_queue, semaphore = self.sessions[session_id]
+        if session_id in self.ready_sessions:
+            # 等待额度的会话，队首换成了不受限制的消息(如优先处理的管理命令)时立即恢复就绪
+            if not context_queue.empty() and context_queue.queue[0]["dispatch_route"] == WorkerPool.LIGHT:
+                if self.ready_sessions.unpark_session(session_id):
+                    self.ready_cond.notify()
+            return
+        if not context_queue.empty():
+            if semaphore._value > 0:
+                head = context_queue.queue[0]
+                self.ready_sessions.push(head.get("tenant", session_id), session_id, self._tenant_weight(head))
+                self.ready_cond.notify()
+        elif semaphore._value == semaphore._initial_value:  # 没有任务在处理，说明所有任务都处理完毕
+            self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+            assert len(self.futures[session_id]) == 0, "thread pool error"
+            del self.futures[session_id]
+            del self.sessions[session_id]
+
+    def _tenant(self, context: Context):
+        """
+        公平调度的租户：群聊按群，私聊按用户，不同通道分开
+        """
+        receiver = context.get("receiver") or context["session_id"]
+        return "{}:{}:{}".format(self.channel_type, "group" if context.get("isgroup") else "user", receiver)
+
+    def _tenant_weight(self, context: Context):
+        """
+        租户权重，fair_queue_weights可按群名、群id、用户id配置，私聊管理员默认使用fair_queue_admin_weight
+        """
+        weights = conf().get("fair_queue_weights") or {}
+        receiver = context.get("receiver")
+        if receiver in weights:
+            return weights[receiver]
+        if context.get("isgroup"):
+            msg = context.get("msg")
+            group_name = getattr(msg, "other_user_nickname", None)
+            if group_name in weights:
+                return weights[group_name]
+        elif receiver and receiver in global_config["admin_users"]:
+            return conf().get("fair_queue_admin_weight", 2)
+        return 1
+
+    def _dispatch_route(self, context: Context):
+        """
+        :return: 消息的处理方式，async表示在事件循环中以协程处理，否则为线程池的lane
+        """
+        lane = self._select_lane(context)
+        if lane == WorkerPool.HEAVY and conf().get("async_mode") and context.type in [ContextType.TEXT, ContextType.IMAGE_CREATE]:
+            return "async"
+        return lane
+
+    def _wait_key(self, tenant, context: Context):
+        """
+        调用模型的消息受租户并发上限限制；heavy线程池已满时不再提交，在等待列表中按先后等待，而不是在线程池中先到先得
+        :return: 消息需要等待的额度，可以立即处理时返回None
+        """
+        route = context["dispatch_route"]
+        if route == WorkerPool.LIGHT:
+            return None
+        if not self._tenant_has_capacity(tenant):
+            return ("tenant", tenant)
+        if route == WorkerPool.HEAVY and not self._heavy_has_capacity():
+            return WorkerPool.HEAVY
+        return None
+
+    def _tenant_has_capacity(self, tenant):
+        max_inflight = conf().get("fair_queue_tenant_max_inflight", 0)
+        return not max_inflight or self.inflight.get(tenant, 0) < max_inflight
+
+    def _heavy_has_capacity(self):
+        return self.heavy_inflight < handler_pool.lanes[WorkerPool.HEAVY].max_workers
+
+    def _park(self, tenant, session_id, context: Context, key):
+        """
+        会话等待key对应的额度，调用方需持有self.lock
+        从另一个等待列表恢复的会话可能转而等待这里的额度，原来的额度仍有空余时交给下一个等待的会话，避免额度空闲
+        """
+        self.ready_sessions.park(key, tenant, session_id, self._tenant_weight(context))
+        if key == WorkerPool.HEAVY:
+            if self._tenant_has_capacity(tenant):
+                self.ready_sessions.unpark(("tenant", tenant), 1)
+        elif self._heavy_has_capacity():
+            self.ready_sessions.unpark(WorkerPool.HEAVY, 1)
+
+    def _release_inflight(self, context: Context):
+        route = context.get("dispatch_route")
+        if route is None or route == WorkerPool.LIGHT:
+            return
+        tenant = context.get("tenant")
+        self.inflight[tenant] -= 1
+        if self.inflight[tenant] <= 0:
+            del self.inflight[tenant]
+        # 释放了并发额度，等待中的会话重新就绪
+        self.ready_sessions.unpark(("tenant", tenant), 1)
+        if route == WorkerPool.HEAVY:
+            self.heavy_inflight -= 1
+            self.ready_sessions.unpark(WorkerPool.HEAVY, 1)
+        self.ready_cond.notify()
+
+    def _is_command(self, context: Context):
+        return context.type == ContextType.TEXT and context.content.startswith("#")
+
+    def _admit(self, session_id, context: Context):
+        """
+        准入控制，调用方需持有self.lock
+        :return: 拒绝的原因，可以排队时返回None
+        """
+        if self._is_command(context):  # 管理命令总是可以排队
+            return None
+        max_size = conf().get("message_queue_max_size", 0)
+        if max_size and session_id in self.sessions and self.sessions[session_id][0].qsize() >= max_size:
+            return "session queue full"
+        total_max_size = conf().get("message_queue_total_max_size", 0)
+        if total_max_size and self.queued_total >= total_max_size:
+            return "total queue full"
+        return None
+
+    def _shed(self, context: Context, reason):
+        """
+        放弃处理消息，不调用模型；配置了busy_reply时回复繁忙提示
+        """
+        logger.warning("[chat_channel] shed message, reason={}, session_id={}".format(reason, context.get("session_id")))
+        busy_reply = conf().get("busy_reply", "当前消息较多，请稍后再试")
+        if busy_reply:
+            self._decorate_and_send(context, Reply(ReplyType.TEXT, busy_reply))
+
     def produce(self, context: Context):
         session_id = context["session_id"]
+        if "tenant" not in context:
+            context["tenant"] = self._tenant(context)
+        context["dispatch_route"] = self._dispatch_route(context)
+        context["queued_at"] = time.monotonic()
+        deadline_seconds = conf().get("message_deadline_seconds", 0)
+        if deadline_seconds and "deadline" not in context and not self._is_command(context):
+            context.set_deadline(deadline_seconds)
         with self.lock:
+            reason = self._admit(session_id, context)
+            if reason:
+                # 不占用会话的并发额度，但仍通过回调通知通道消息已处理结束
+                future = handler_pool.submit_to(WorkerPool.LIGHT, self._shed, context, reason)
+                future.add_done_callback(lambda worker: self._notify_result(session_id, worker, context=context))
+                return
             if session_id not in self.sessions:
                 self.sessions[session_id] = [
                     Dequeue(),
                     threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
                 ]
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
+            if self._is_command(context):
                 self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
             else:
                 self.sessions[session_id][0].put(context)
+            self.queued_total += 1
+            self._schedule(session_id)
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 消费者函数，单独线程，等待produce或任务结束的回调通知，按租户公平地从就绪的session中取出消息并处理
     def consume(self):
         while True:
-            with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
+            with self.ready_cond:
+                item = None
+                while item is None:
+                    if self.ready_sessions:
+                        item = self.ready_sessions.pop()
+                    if item is None:
+                        self.ready_cond.wait()
+                tenant, session_id = item
+                context_queue, semaphore = self.sessions[session_id]
+                if not context_queue.empty():
+                    wait_key = self._wait_key(tenant, context_queue.queue[0])
+                    if wait_key is not None:
+                        self._park(tenant, session_id, context_queue.queue[0], wait_key)
+                        continue
+                if context_queue.empty() or not semaphore.acquire(blocking=False):
+                    self._schedule(session_id)
+                    continue
+                context = context_queue.get()
+                self.queued_total -= 1
+                tenant = context.get("tenant", session_id)
+                if context.get("queued_at"):
+                    self.ready_sessions.record_wait(tenant, time.monotonic() - context["queued_at"])
+                route = context["dispatch_route"]
+                if route != WorkerPool.LIGHT and context.is_expired():
+                    # 排队超过期限的消息不再调用模型
+                    context["dispatch_route"] = WorkerPool.LIGHT
+                    future: Future = handler_pool.submit_to(WorkerPool.LIGHT, self._shed, context, "deadline exceeded")
+                else:
+                    context["dispatch_route"] = route
+                    if route != WorkerPool.LIGHT:
+                        context["tenant"] = tenant
+                        self.inflight[tenant] = self.inflight.get(tenant, 0) + 1
+                    if route == "async":
+                        future: Future = run_coroutine(self._async_handle(context))
                     else:
-                        semaphore.release()
-            time.sleep(0.2)
+                        if route == WorkerPool.HEAVY:
+                            self.heavy_inflight += 1
+                        future: Future = handler_pool.submit_to(route, self._handle, context)
+                self._schedule(session_id)  # 还有消息且未达到并发上限时，重新标记为就绪
+                self.futures.setdefault(session_id, []).append(future)
+            logger.debug("[chat_channel] consume context: {}".format(context))
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                    self.queued_total -= cnt
                 self.sessions[session_id][0] = Dequeue()
+                for future in self.futures.get(session_id, []):
+                    future.cancel()
+                self._schedule(session_id)
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            for session_id in list(self.sessions):
+                self.cancel_session(session_id)
 
 
 def check_prefix(content, prefix_list):
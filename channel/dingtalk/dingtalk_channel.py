@@ -20,6 +20,7 @@ from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
 from channel.dingtalk.dingtalk_message import DingTalkMessage
+from common import stream
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
@@ -83,6 +84,7 @@ def _check(func):
 
 @singleton
 class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
+    SUPPORT_STREAM = True  # 开启AI卡片时通过卡片流式更新，否则按句分段发送
     dingtalk_client_id = conf().get('dingtalk_client_id')
     dingtalk_client_secret = conf().get('dingtalk_client_secret')
 
@@ -177,6 +179,13 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
         isgroup = context.kwargs['msg'].is_group
         incoming_message = context.kwargs['msg'].incoming_message
 
+        if reply.type == ReplyType.TEXT_STREAM:
+            if conf().get("dingtalk_card_enabled"):
+                self.reply_ai_markdown_stream(incoming_message, reply, isgroup)
+            else:
+                self._send_stream_chunks(reply, context)
+            return
+
         if conf().get("dingtalk_card_enabled"):
             logger.info("[Dingtalk] sendMsg={}, receiver={}".format(reply, receiver))
             def reply_with_text():
@@ -200,6 +209,23 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
             self.reply_text(reply.content, incoming_message)
 
 
+    def reply_ai_markdown_stream(self, incoming_message, reply: Reply, isgroup):
+        """
+        通过AI卡片流式更新回复内容
+        """
+        card = self.ai_markdown_card_start(incoming_message, "", "")
+        text = ""
+        try:
+            for text in stream.snapshots(reply.content, conf().get("stream_update_interval", 1.0)):
+                card.ai_streaming(markdown=text, append=False)
+            card.ai_finish(markdown=text, tips="📌 内容由AI生成")
+        except Exception as e:
+            logger.error("[Dingtalk] stream reply error: {}".format(e))
+            card.ai_fail()
+            raise
+        if isgroup:
+            self.reply_text("📢 您有一条新的消息，请查看。", incoming_message)
+
     def generate_button_markdown_content(self, context, reply):
         image_url = context.kwargs.get("image_url")
         promptEn = context.kwargs.get("promptEn")
@@ -8,11 +8,11 @@
 # -*- coding=utf-8 -*-
 import uuid
 
-import requests
 import web
 from channel.feishu.feishu_message import FeishuMessage
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
+from common import http, http_server, stream
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -24,10 +24,13 @@ import json
 import os
 
 URL_VERIFICATION = "url_verification"
+# 飞书单条消息最多可编辑20次
+MAX_MESSAGE_EDITS = 20
 
 
 @singleton
 class FeiShuChanel(ChatChannel):
+    SUPPORT_STREAM = True
     feishu_app_id = conf().get('feishu_app_id')
     feishu_app_secret = conf().get('feishu_app_secret')
     feishu_token = conf().get('feishu_token')
@@ -48,11 +51,10 @@ class FeiShuChanel(ChatChannel):
         )
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("feishu_port", 9891)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        http_server.serve(app.wsgifunc(), port)
 
     def send(self, reply: Reply, context: Context):
         msg = context.get("msg")
-        is_group = context["isgroup"]
         if msg:
             access_token = msg.access_token
         else:
@@ -63,6 +65,9 @@ class FeiShuChanel(ChatChannel):
         }
         msg_type = "text"
         logger.info(f"[FeiShu] start send reply message, type={context.type}, content={reply.content}")
+        if reply.type == ReplyType.TEXT_STREAM:
+            self._send_stream(reply, context, headers)
+            return
         reply_content = reply.content
         content_key = "text"
         if reply.type == ReplyType.IMAGE_URL:
@@ -73,29 +78,73 @@ class FeiShuChanel(ChatChannel):
                 return
             msg_type = "image"
             content_key = "image_key"
-        if is_group:
+        self._post_message(context, headers, msg_type, {content_key: reply_content})
+
+    def _post_message(self, context: Context, headers, msg_type, content):
+        """
+        发送消息，群聊中直接回复原消息
+        :return: 发送成功时返回message_id
+        """
+        if context["isgroup"]:
             # 群聊中直接回复
-            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{msg.msg_id}/reply"
+            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{context.get('msg').msg_id}/reply"
             data = {
                 "msg_type": msg_type,
-                "content": json.dumps({content_key: reply_content})
+                "content": json.dumps(content)
             }
-            res = requests.post(url=url, headers=headers, json=data, timeout=(5, 10))
+            res = http.post(url=url, headers=headers, json=data, timeout=(5, 10))
         else:
             url = "https://open.feishu.cn/open-apis/im/v1/messages"
             params = {"receive_id_type": context.get("receive_id_type") or "open_id"}
             data = {
                 "receive_id": context.get("receiver"),
                 "msg_type": msg_type,
-                "content": json.dumps({content_key: reply_content})
+                "content": json.dumps(content)
             }
-            res = requests.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
+            res = http.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
         res = res.json()
         if res.get("code") == 0:
             logger.info(f"[FeiShu] send message success")
+            return res.get("data", {}).get("message_id")
         else:
             logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
 
+    def _send_stream(self, reply: Reply, context: Context, headers):
+        """
+        流式回复：先发送首段文本，之后按stream_update_interval编辑同一条消息
+        """
+        message_id = None
+        edits = 0
+        text = sent_text = ""
+        for text in stream.snapshots(reply.content, conf().get("stream_update_interval", 1.0)):
+            if message_id is None:
+                message_id = self._post_message(context, headers, "text", {"text": text})
+                if message_id is None:
+                    break
+                sent_text = text
+            elif edits < MAX_MESSAGE_EDITS - 1:  # 预留一次编辑给最终结果
+                edits += 1
+                if self._edit_message(message_id, headers, text):
+                    sent_text = text
+        if message_id is None:
+            # 首条消息发送失败，收集剩余内容后按普通文本重试一次
+            text += stream.collect(reply.content)
+            self._post_message(context, headers, "text", {"text": text})
+        elif text != sent_text:
+            self._edit_message(message_id, headers, text)
+
+    def _edit_message(self, message_id, headers, text) -> bool:
+        url = f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}"
+        data = {
+            "msg_type": "text",
+            "content": json.dumps({"text": text})
+        }
+        res = http.request("PUT", url, headers=headers, json=data, timeout=(5, 10)).json()
+        if res.get("code") != 0:
+            logger.warn(f"[FeiShu] edit message failed, code={res.get('code')}, msg={res.get('msg')}")
+            return False
+        return True
+
 
     def fetch_access_token(self) -> str:
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
@@ -107,7 +156,7 @@ class FeiShuChanel(ChatChannel):
             "app_secret": self.feishu_app_secret
         }
         data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
+        response = http.post(url=url, data=data, headers=headers)
         if response.status_code == 200:
             res = response.json()
             if res.get("code") != 0:
@@ -121,7 +170,7 @@ class FeiShuChanel(ChatChannel):
 
     def _upload_image_url(self, img_url, access_token):
         logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
+        response = http.get(img_url)
         suffix = utils.get_path_suffix(img_url)
         temp_name = str(uuid.uuid4()) + "." + suffix
         if response.status_code == 200:
@@ -138,7 +187,7 @@ class FeiShuChanel(ChatChannel):
             'Authorization': f'Bearer {access_token}',
         }
         with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
+            upload_response = http.post(upload_url, files={"image": file}, data=data, headers=headers)
             logger.info(f"[FeiShu] upload file, res={upload_response.content}")
             os.remove(temp_name)
             return upload_response.json().get("data").get("image_key")
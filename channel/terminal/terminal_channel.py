@@ -28,6 +28,7 @@ class TerminalMessage(ChatMessage):
 
 class TerminalChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
+    SUPPORT_STREAM = True
 
     def send(self, reply: Reply, context: Context):
         print("\nBot:")
@@ -54,6 +55,10 @@ class TerminalChannel(ChatChannel):
             img = Image.open(image_storage)
             print(img_url)
             img.show()
+        elif reply.type == ReplyType.TEXT_STREAM:
+            for chunk in reply.content:
+                print(chunk, end="", flush=True)
+            print()
         else:
             print(reply.content)
         print("\nUser:", end="")
@@ -8,6 +8,7 @@ from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
 from channel.chat_message import ChatMessage
+from common import http_server, stream
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -37,6 +38,9 @@ class WebMessage(ChatMessage):
 @singleton
 class WebChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
+    SUPPORT_STREAM = True
+    STREAM_UPDATE_INTERVAL = 0.2  # 流式回复推送到页面的最小间隔(秒)
+    POLL_RETRY_AFTER = 3  # 等待中的连接数已满时，页面改为间隔多久(秒)轮询一次
     _instance = None
     
     # def __new__(cls):
@@ -49,6 +53,8 @@ class WebChannel(ChatChannel):
         self.msg_id_counter = 0  # 添加消息ID计数器
         self.session_queues = {}  # 存储session_id到队列的映射
         self.request_to_session = {}  # 存储request_id到session_id的映射
+        self.waiting_connections = 0  # 当前占用处理线程等待回复的连接数(SSE连接和长轮询)
+        self.waiting_lock = threading.Lock()
         # web channel无需前缀
         conf()["single_chat_prefix"] = [""]
 
@@ -85,22 +91,49 @@ class WebChannel(ChatChannel):
                 return
             
             # 检查是否有会话队列
-            if session_id in self.session_queues:
-                # 创建响应数据，包含请求ID以区分不同请求的响应
-                response_data = {
-                    "type": str(reply.type),
-                    "content": reply.content,
-                    "timestamp": time.time(),
-                    "request_id": request_id
-                }
-                self.session_queues[session_id].put(response_data)
-                logger.debug(f"Response sent to queue for session {session_id}, request {request_id}")
-            else:
+            if session_id not in self.session_queues:
                 logger.warning(f"No response queue found for session {session_id}, response dropped")
+                return
+
+            if reply.type == ReplyType.TEXT_STREAM:
+                # 流式回复：推送截至当前的完整文本，最后一条标记done，页面在同一条消息上原地更新
+                text = None
+                for snapshot in stream.snapshots(reply.content, self.STREAM_UPDATE_INTERVAL):
+                    if text is not None:
+                        self._put_response(session_id, request_id, reply.type, text, stream=True, done=False)
+                    text = snapshot
+                self._put_response(session_id, request_id, reply.type, text or "", stream=True, done=True)
+            else:
+                self._put_response(session_id, request_id, reply.type, reply.content)
             
         except Exception as e:
             logger.error(f"Error in send method: {e}")
 
+    def _put_response(self, session_id, request_id, reply_type, content, **kwargs):
+        # 创建响应数据，包含请求ID以区分不同请求的响应
+        response_data = {
+            "type": str(reply_type),
+            "content": content,
+            "timestamp": time.time(),
+            "request_id": request_id
+        }
+        response_data.update(kwargs)
+        self.session_queues[session_id].put(response_data)
+        logger.debug(f"Response sent to queue for session {session_id}, request {request_id}")
+
+    def _next_response(self, queue, timeout=0):
+        """
+        从会话队列取出一条回复，timeout大于0时最多阻塞等待timeout秒，没有回复时抛出Empty
+        """
+        response = queue.get(block=timeout > 0, timeout=timeout if timeout > 0 else None)
+        # 流式回复的中间结果只需要最新的一条，跳过已过时的
+        while response.get("stream") and not response.get("done"):
+            with queue.mutex:
+                if not queue.queue or queue.queue[0].get("request_id") != response["request_id"]:
+                    break
+                response = queue.queue.popleft()
+        return response
+
     def post_message(self):
         """
         Handle incoming messages from users via POST request.
@@ -119,8 +152,7 @@ class WebChannel(ChatChannel):
             self.request_to_session[request_id] = session_id
             
             # 确保会话队列存在
-            if session_id not in self.session_queues:
-                self.session_queues[session_id] = Queue()
+            self.session_queues.setdefault(session_id, Queue())
             
             # 创建消息对象
             msg = WebMessage(self._generate_msg_id(), prompt)
@@ -148,6 +180,7 @@ class WebChannel(ChatChannel):
     def poll_response(self):
         """
         Poll for responses using the session_id.
+        请求中带timeout时为长轮询，队列为空时最多等待timeout秒，有回复立即返回
         """
         try:
             # 不记录轮询请求的日志
@@ -159,29 +192,99 @@ class WebChannel(ChatChannel):
             
             if not session_id or session_id not in self.session_queues:
                 return json.dumps({"status": "error", "message": "Invalid session ID"})
-            
-            # 尝试从队列获取响应，不等待
+
+            timeout = min(float(json_data.get('timeout') or 0), conf().get("web_long_poll_timeout", 30))
+            waiting = timeout > 0 and self._acquire_waiting()
             try:
-                # 使用peek而不是get，这样如果前端没有成功处理，下次还能获取到
-                response = self.session_queues[session_id].get(block=False)
-                
-                # 返回响应，包含请求ID以区分不同请求
-                return json.dumps({
-                    "status": "success", 
-                    "has_content": True,
-                    "content": response["content"],
-                    "request_id": response["request_id"],
-                    "timestamp": response["timestamp"]
-                })
-                
+                response = self._next_response(self.session_queues[session_id], timeout if waiting else 0)
+                return json.dumps(self._response_payload(response))
             except Empty:
                 # 没有新响应
-                return json.dumps({"status": "success", "has_content": False})
+                result = {"status": "success", "has_content": False}
+                if timeout > 0 and not waiting:
+                    # 等待中的连接数已满，立即返回，页面间隔retry_after秒后再轮询
+                    result["retry_after"] = self.POLL_RETRY_AFTER
+                return json.dumps(result)
+            finally:
+                if waiting:
+                    self._release_waiting()
                 
         except Exception as e:
             logger.error(f"Error polling response: {e}")
             return json.dumps({"status": "error", "message": str(e)})
 
+    def stream_response(self):
+        """
+        SSE推送：连接保持打开，会话队列中有回复时立即推送，空闲时定期发送心跳以便及时发现断开的连接
+        """
+        session_id = web.input(session_id=None).session_id
+        if not session_id:
+            raise web.badrequest()
+        if not self._acquire_waiting():
+            # 等待中的连接数已达上限，返回503，页面改用轮询，为发送消息等请求保留处理线程
+            raise web.HTTPError("503 Service Unavailable", {"Retry-After": str(self.POLL_RETRY_AFTER)}, "too many waiting connections")
+        # 页面可能在发送第一条消息前就建立连接
+        queue = self.session_queues.setdefault(session_id, Queue())
+        heartbeat = conf().get("web_stream_heartbeat", 15)
+        web.header("Content-Type", "text/event-stream")
+        web.header("Cache-Control", "no-cache")
+        web.header("X-Accel-Buffering", "no")  # 禁止nginx等反向代理缓冲
+
+        def events():
+            try:
+                yield "retry: 3000\n\n"
+                while True:
+                    try:
+                        response = self._next_response(queue, heartbeat)
+                    except Empty:
+                        yield ": ping\n\n"
+                        continue
+                    try:
+                        yield "data: {}\n\n".format(json.dumps(self._response_payload(response)))
+                    except GeneratorExit:
+                        # 连接已断开，把回复放回队列，由重连后的连接推送
+                        with queue.mutex:
+                            queue.queue.appendleft(response)
+                            queue.not_empty.notify()
+                        raise
+            finally:
+                self._release_waiting()
+
+        return events()
+
+    def _acquire_waiting(self):
+        """
+        SSE连接和长轮询在等待期间一直占用一个处理线程，二者合计不超过max_waiting_connections，其余线程留给发送消息等请求
+        """
+        with self.waiting_lock:
+            if self.waiting_connections >= self.max_waiting_connections():
+                return False
+            self.waiting_connections += 1
+            return True
+
+    def _release_waiting(self):
+        with self.waiting_lock:
+            self.waiting_connections -= 1
+
+    @staticmethod
+    def max_waiting_connections():
+        threads = conf().get("web_server_threads", 200)
+        limit = conf().get("web_max_waiting_connections", 150)
+        # 至少保留四分之一的线程处理其他请求
+        return max(0, min(limit, threads - max(threads // 4, 1)))
+
+    def _response_payload(self, response):
+        # 返回响应，包含请求ID以区分不同请求
+        return {
+            "status": "success",
+            "has_content": True,
+            "content": response["content"],
+            "request_id": response["request_id"],
+            "timestamp": response["timestamp"],
+            "stream": response.get("stream", False),
+            "done": response.get("done", True)
+        }
+
     def chat_page(self):
         """Serve the chat HTML page."""
         file_path = os.path.join(os.path.dirname(__file__), 'chat.html')  # 使用绝对路径
@@ -210,24 +313,21 @@ class WebChannel(ChatChannel):
             '/', 'RootHandler',  # 添加根路径处理器
             '/message', 'MessageHandler',
             '/poll', 'PollHandler',  # 添加轮询处理器
+            '/stream', 'StreamHandler',  # SSE推送
             '/chat', 'ChatHandler',
             '/assets/(.*)', 'AssetsHandler',  # 匹配 /assets/任何路径
         )
         app = web.application(urls, globals(), autoreload=False)
         
-        # 禁用web.py的默认日志输出
-        import io
-        from contextlib import redirect_stdout
-        
         # 配置web.py的日志级别为ERROR，只显示错误
         logging.getLogger("web").setLevel(logging.ERROR)
         
         # 禁用web.httpserver的日志
         logging.getLogger("web.httpserver").setLevel(logging.ERROR)
         
-        # 临时重定向标准输出，捕获web.py的启动消息
-        with redirect_stdout(io.StringIO()):
-            web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        # SSE和长轮询连接会在等待期间占用一个处理线程，合计受web_max_waiting_connections限制，超出的页面改为定时轮询
+        logger.info(f"[WebChannel] waiting connections limited to {self.max_waiting_connections()}")
+        http_server.serve(app.wsgifunc(), port, threads=conf().get("web_server_threads", 200))
 
 
 class RootHandler:
@@ -246,6 +346,11 @@ class PollHandler:
         return WebChannel().poll_response()
 
 
+class StreamHandler:
+    def GET(self):
+        return WebChannel().stream_response()
+
+
 class ChatHandler:
     def GET(self):
         # 正常返回聊天页面
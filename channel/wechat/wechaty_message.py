@@ -1,5 +1,4 @@
 import asyncio
-import re
 
 from wechaty import MessageType
 from wechaty.user import Message
@@ -7,6 +6,7 @@ from wechaty.user import Message
 from bridge.context import ContextType
 from channel.chat_message import ChatMessage
 from common.log import logger
+from common.mention import has_mention
 from common.tmp_dir import TmpDir
 
 
@@ -80,8 +80,7 @@ class WechatyMessage(ChatMessage, aobject):
             self.is_at = await wechaty_msg.mention_self()
             if not self.is_at:  # 有时候复制粘贴的消息，不算做@，但是内容里面会有@xxx，这里做一下兼容
                 name = wechaty_msg.wechaty.user_self().name
-                pattern = f"@{re.escape(name)}(\u2005|\u0020)"
-                if re.search(pattern, self.content):
+                if has_mention(self.content, name):
                     logger.debug(f"wechaty message {self.msg_id} include at")
                     self.is_at = True
 
@@ -1,13 +1,13 @@
 import datetime
 import json
 import os
-import re
 import time
 import pilk
 
 from bridge.context import ContextType
 from channel.chat_message import ChatMessage
 from common.log import logger
+from common.mention import has_mention
 from ntwork.const import send_type
 
 
@@ -210,8 +210,7 @@ class WeworkMessage(ChatMessage):
                     # 检查消息内容是否包含@用户名。处理复制粘贴的消息，这类消息可能不会触发@通知，但内容中可能包含 "@用户名"。
                     content = data.get('content', '')
                     name = nickname
-                    pattern = f"@{re.escape(name)}(\u2005|\u0020)"
-                    if re.search(pattern, content):
+                    if has_mention(content, name):
                         logger.debug(f"Wechaty message {self.msg_id} includes at")
                         self.is_at = True
 
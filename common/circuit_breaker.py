@@ -0,0 +1,120 @@
+import random
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+from common.metrics import LatencyStat
+
+
+def backoff_delay(retry_count, base=1.0, cap=60.0):
+    """
+    指数退避加随机抖动(equal jitter)：第n次重试等待 base*2^n 的一半到全部之间的随机秒数，不超过cap
+    避免同时失败的请求在同一时刻一起重试
+    """
+    delay = min(cap, base * (2 ** retry_count))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker:
+    """
+    熔断器
+      closed:    正常放行，连续失败failure_threshold次，或最近window次请求的失败率达到error_rate时熔断
+      open:      熔断期间直接拒绝，cooldown秒后进入half_open；连续多次熔断时cooldown指数增长，最长max_cooldown
+      half_open: 只放行一个探测请求，成功则恢复为closed，失败则重新熔断
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, error_rate=0.5, window=20, min_requests=10, cooldown=30, max_cooldown=600):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = self.CLOSED
+        self.results = deque(maxlen=window)  # 最近请求是否成功
+        self.consecutive_failures = 0
+        self.open_count = 0  # 连续熔断次数，恢复后清零
+        self.open_until = 0.0
+        self.probing = False
+        self.latency = LatencyStat()
+        self.lock = threading.Lock()
+
+    def available(self) -> bool:
+        """是否可能放行，不占用half_open的探测名额"""
+        with self.lock:
+            if self.state == self.OPEN:
+                return time.monotonic() >= self.open_until
+            return self.state == self.CLOSED or not self.probing
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() < self.open_until:
+                    return False
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.probing:  # half_open时已有探测请求在处理
+                return False
+            self.probing = True
+            return True
+
+    def release_probe(self):
+        """allow()放行的请求被取消、没有结果时调用，归还half_open的探测名额，否则之后一直不会放行"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probing = False
+
+    def record_success(self, latency=None):
+        if latency is not None:
+            self.latency.add(latency)
+        with self.lock:
+            self.results.append(True)
+            self.consecutive_failures = 0
+            if self.state != self.CLOSED:
+                logger.info("[CircuitBreaker] {} recovered".format(self.name))
+                self.state = self.CLOSED
+                self.open_count = 0
+                self.probing = False
+                self.results.clear()
+
+    def record_failure(self, latency=None):
+        if latency is not None:
+            self.latency.add(latency)
+        with self.lock:
+            self.results.append(False)
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN:
+                self._open()
+            elif self.state == self.CLOSED and (self.consecutive_failures >= self.failure_threshold or self._error_rate() >= self.error_rate):
+                self._open()
+
+    def _error_rate(self):
+        if len(self.results) < self.min_requests:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def _open(self):
+        cooldown = backoff_delay(self.open_count, self.cooldown, self.max_cooldown)
+        self.open_count += 1
+        self.state = self.OPEN
+        self.probing = False
+        self.open_until = time.monotonic() + cooldown
+        logger.warn("[CircuitBreaker] {} opened for {:.0f}s, consecutive_failures={}".format(self.name, cooldown, self.consecutive_failures))
+
+    def metrics(self) -> dict:
+        with self.lock:
+            stats = {
+                "state": self.state,
+                "error_rate": self.results.count(False) / len(self.results) if self.results else 0.0,
+                "consecutive_failures": self.consecutive_failures,
+                "open_remaining": max(0.0, self.open_until - time.monotonic()) if self.state == self.OPEN else 0.0,
+            }
+        stats["latency"] = self.latency.snapshot()
+        return stats
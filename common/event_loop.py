@@ -0,0 +1,39 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future
+
+_loop = None
+_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    获取全局事件循环，首次调用时在后台守护线程中启动
+    异步模式下所有模型请求都在这个事件循环中并发执行
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            t = threading.Thread(target=loop.run_forever, name="event-loop")
+            t.daemon = True
+            t.start()
+            _loop = loop
+    return _loop
+
+
+def run_coroutine(coro) -> Future:
+    """
+    在全局事件循环中执行协程，返回concurrent.futures.Future，可在任意线程中等待或取消
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+async def run_sync(func, *args):
+    """
+    在线程池中执行同步函数，避免阻塞事件循环
+    函数在当前协程的contextvars副本中执行，config.override()等按上下文生效的配置在线程中同样可见
+    """
+    ctx = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(None, ctx.run, func, *args)
@@ -1,42 +1,143 @@
-from datetime import datetime, timedelta
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
+from common.log import logger
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+# 后台线程清理过期数据的间隔(秒)
+SWEEP_INTERVAL = 5
+
+
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的字典，读写会刷新过期时间(滑动过期)，使用单调时钟计时
+
+    所有数据的有效期相同，按最近访问顺序保存在OrderedDict中，最早过期的总在最前面，
+    因此过期清理和超出max_size时的LRU淘汰都只需从头部弹出，均摊O(1)
+    除了访问时顺带清理，后台线程也会定期清理，没有再被访问的数据不会一直占用内存
+
+    :param expires_in_seconds: 有效期(秒)
+    :param max_size: 最多保存的数量，超出时淘汰最久未访问的数据，0表示不限制
+    :param on_evict: 数据过期或被淘汰时的回调on_evict(key, value)，主动删除时不调用
+    """
+
+    def __init__(self, expires_in_seconds, max_size=0, on_evict=None):
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._data = OrderedDict()  # key -> (value, expiry_time)
+        self._lock = threading.RLock()
+        _register(self)
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
+        with self._lock:
+            value, expiry_time = self._data[key]
+            if time.monotonic() > expiry_time:
+                del self._data[key]
+                expired = True
+            else:
+                self._data[key] = (value, time.monotonic() + self.expires_in_seconds)
+                self._data.move_to_end(key)
+                expired = False
+        if expired:
+            self._evicted([(key, value)])
             raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
         return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            evicted = self._pop_expired(limit=2)
+            while self.max_size and len(self._data) > self.max_size:
+                old_key, (old_value, _) = self._data.popitem(last=False)
+                evicted.append((old_key, old_value))
+        self._evicted(evicted)
 
-    def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
 
     def __contains__(self, key):
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
+        # 只检查是否有效，不刷新过期时间
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and time.monotonic() <= item[1]
+
+    def __len__(self):
+        self.sweep()
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self.keys())
 
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        # 遍历不刷新过期时间
+        now = time.monotonic()
+        with self._lock:
+            return [key for key, (_, expiry_time) in self._data.items() if now <= expiry_time]
+
+    def values(self):
+        return [value for _, value in self.items()]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expiry_time) in self._data.items() if now <= expiry_time]
 
-    def __iter__(self):
-        return self.keys().__iter__()
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def sweep(self):
+        """
+        清理所有过期数据
+        """
+        with self._lock:
+            evicted = self._pop_expired()
+        self._evicted(evicted)
+
+    def _pop_expired(self, limit=None):
+        evicted = []
+        now = time.monotonic()
+        while self._data and (limit is None or len(evicted) < limit):
+            key, (value, expiry_time) = next(iter(self._data.items()))
+            if now <= expiry_time:
+                break
+            del self._data[key]
+            evicted.append((key, value))
+        return evicted
+
+    def _evicted(self, items):
+        if not self.on_evict:
+            return
+        for key, value in items:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logger.warn("[ExpiredDict] on_evict error, key={}: {}".format(key, e))
+
+
+_caches = weakref.WeakValueDictionary()  # id -> ExpiredDict，字典不可哈希所以不用WeakSet
+_caches_lock = threading.Lock()
+_sweeper = None
+
+
+def _register(cache):
+    global _sweeper
+    with _caches_lock:
+        _caches[id(cache)] = cache
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep_loop, name="expired-dict-sweeper", daemon=True)
+            _sweeper.start()
+
+
+def _sweep_loop():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        with _caches_lock:
+            caches = list(_caches.values())
+        for cache in caches:
+            cache.sweep()
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+from common.expired_dict import ExpiredDict
+from common.metrics import LatencyStat
+
+
+class _Tenant:
+    def __init__(self, weight):
+        self.weight = weight
+        self.deficit = 0.0
+        self.sessions = OrderedDict()  # 该租户下就绪的session_id，按就绪先后排列
+
+
+class FairScheduler:
+    """
+    按租户(私聊用户、群等)加权的赤字轮转(DRR)调度
+
+    每个租户轮到时获得weight个额度，每取出一条消息消耗1个额度，额度不足时排到队尾，
+    因此各租户按权重比例分到处理机会，消息多的群不会挤占私聊，同一租户下的多个会话之间轮流处理
+    暂时不能处理的会话(如租户处理中的任务已达上限)由调用方park到等待列表，不参与轮转，额度释放时unpark重新就绪，
+    取出会话时不需要反复扫描处理不了的会话
+    非线程安全，由调用方加锁
+    """
+
+    def __init__(self):
+        self.tenants = OrderedDict()  # 有就绪会话的租户，队首为当前轮到的租户
+        self.session_tenants = {}  # 就绪的session_id -> 租户
+        self.waiting = {}  # 等待的额度 -> OrderedDict(session_id -> (租户, 权重))，按等待先后排列
+        self.session_waiting = {}  # 等待中的session_id -> 等待的额度
+        self.wait_time = ExpiredDict(3600)  # 租户 -> 排队耗时统计
+
+    def __contains__(self, session_id):
+        return session_id in self.session_tenants or session_id in self.session_waiting
+
+    def __bool__(self):
+        return bool(self.session_tenants)
+
+    def push(self, tenant, session_id, weight=1):
+        """标记会话就绪，weight只在租户新加入调度时生效"""
+        if session_id in self:
+            return
+        state = self.tenants.get(tenant)
+        if state is None:
+            state = self.tenants[tenant] = _Tenant(max(1, weight))  # 权重不小于1，保证每次轮到时至少能处理一条
+        state.sessions[session_id] = True
+        self.session_tenants[session_id] = tenant
+
+    def pop(self):
+        """
+        按DRR顺序取出一个就绪的会话
+        :return: (tenant, session_id)，没有就绪的会话时返回None
+        """
+        if not self.tenants:
+            return None
+        tenant, state = next(iter(self.tenants.items()))
+        if state.deficit < 1:
+            state.deficit += state.weight
+        session_id = next(iter(state.sessions))
+        del state.sessions[session_id]
+        del self.session_tenants[session_id]
+        state.deficit -= 1
+        if not state.sessions:
+            del self.tenants[tenant]
+        elif state.deficit < 1:
+            self.tenants.move_to_end(tenant)
+        return tenant, session_id
+
+    def park(self, key, tenant, session_id, weight=1):
+        """取出的会话暂时不能处理，等待key对应的额度释放，期间不参与轮转"""
+        if session_id in self:
+            return
+        self.waiting.setdefault(key, OrderedDict())[session_id] = (tenant, weight)
+        self.session_waiting[session_id] = key
+
+    def unpark(self, key, count=None):
+        """
+        key对应的额度已释放，把等待的会话按等待先后重新标记为就绪
+        :param count: 最多恢复的会话数，None表示全部
+        :return: 恢复的会话数
+        """
+        sessions = self.waiting.get(key)
+        resumed = 0
+        while sessions and (count is None or resumed < count):
+            session_id, (tenant, weight) = sessions.popitem(last=False)
+            del self.session_waiting[session_id]
+            self.push(tenant, session_id, weight)
+            resumed += 1
+        if key in self.waiting and not sessions:
+            del self.waiting[key]
+        return resumed
+
+    def unpark_session(self, session_id):
+        """会话不再需要等待(如队首换成了管理命令)时立即重新标记为就绪"""
+        key = self.session_waiting.pop(session_id, None)
+        if key is None:
+            return False
+        tenant, weight = self.waiting[key].pop(session_id)
+        if not self.waiting[key]:
+            del self.waiting[key]
+        self.push(tenant, session_id, weight)
+        return True
+
+    def record_wait(self, tenant, seconds):
+        stat = self.wait_time.get(tenant)
+        if stat is None:
+            stat = self.wait_time[tenant] = LatencyStat(window=256)
+        stat.add(seconds)
+
+    def metrics(self) -> dict:
+        return {tenant: stat.snapshot() for tenant, stat in self.wait_time.items()}
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.log import logger
+from common.metrics import LatencyStat
+from common.singleton import singleton
+from config import conf
+
+_aio_sessions = {}
+
+
+@singleton
+class HttpClient:
+    """
+    全局共享的HTTP客户端，所有bot、语音、通道复用同一组keep-alive连接池
+    每个host一个连接池，连接池大小、超时时间和代理从配置读取，并按host统计连接复用和请求耗时
+    注：requests只支持HTTP/1.1，通过keep-alive复用连接避免每次请求重新握手
+    """
+
+    def __init__(self):
+        self.pool_connections = conf().get("http_pool_connections", 20)
+        self.pool_maxsize = conf().get("http_pool_maxsize", 20)
+        self.timeout = (conf().get("http_connect_timeout", 10), conf().get("http_read_timeout", 180))
+        proxy = conf().get("http_proxy")
+        self.proxies = {"http": proxy, "https": proxy} if proxy else None
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.latencies = {}  # host -> LatencyStat
+        self.errors = {}  # host -> 请求异常次数
+        self.lock = threading.Lock()
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        if self.proxies and "proxies" not in kwargs:
+            kwargs["proxies"] = self.proxies
+        host = urlparse(url).netloc
+        start = time.monotonic()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.errors[host] = self.errors.get(host, 0) + 1
+            raise
+        finally:
+            self._latency(host).add(time.monotonic() - start)
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def _latency(self, host) -> LatencyStat:
+        stat = self.latencies.get(host)
+        if stat is None:
+            with self.lock:
+                stat = self.latencies.setdefault(host, LatencyStat())
+        return stat
+
+    def stats(self) -> dict:
+        """
+        按host汇总的连接池统计
+        requests: 请求次数, connections: 新建连接数, reused: 复用已有连接的请求数, errors: 请求异常次数, latency: 耗时分布
+        """
+        result = {}
+        pools = self.adapter.poolmanager.pools
+        with pools.lock:
+            pool_list = list(pools._container.values())
+        for pool in pool_list:
+            host = pool.host if pool.port in (None, 80, 443) else "{}:{}".format(pool.host, pool.port)
+            item = result.setdefault(host, {"requests": 0, "connections": 0, "reused": 0})
+            item["requests"] += pool.num_requests
+            item["connections"] += pool.num_connections
+            item["reused"] = max(0, item["requests"] - item["connections"])
+        with self.lock:
+            latencies = dict(self.latencies)
+            errors = dict(self.errors)
+        for host, stat in latencies.items():
+            item = result.setdefault(host, {"requests": 0, "connections": 0, "reused": 0})
+            item["errors"] = errors.get(host, 0)
+            item["latency"] = stat.snapshot()
+        return result
+
+
+def request(method, url, **kwargs) -> requests.Response:
+    return HttpClient().request(method, url, **kwargs)
+
+
+def get(url, **kwargs) -> requests.Response:
+    return HttpClient().get(url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    return HttpClient().post(url, **kwargs)
+
+
+def stats() -> dict:
+    return HttpClient().stats()
+
+
+def _get_aio_session():
+    """
+    每个事件循环复用一个aiohttp.ClientSession，保持连接
+    """
+    import aiohttp
+
+    loop = asyncio.get_event_loop()
+    session = _aio_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=conf().get("http_pool_connections", 20) * conf().get("http_pool_maxsize", 20),
+                                         limit_per_host=conf().get("http_pool_maxsize", 20))
+        session = aiohttp.ClientSession(connector=connector)
+        _aio_sessions[loop] = session
+    return session
+
+
+async def async_post_json(url, headers=None, json=None, data=None, timeout=None, proxy=None):
+    """
+    异步POST请求
+    :return: (status_code, 响应json)，响应不是json时为None
+    """
+    import aiohttp
+
+    session = _get_aio_session()
+    client_timeout = aiohttp.ClientTimeout(total=timeout or conf().get("http_read_timeout", 180),
+                                           connect=conf().get("http_connect_timeout", 10))
+    host = urlparse(url).netloc
+    start = time.monotonic()
+    try:
+        async with session.post(url, headers=headers, json=json, data=data, timeout=client_timeout,
+                                proxy=proxy or conf().get("http_proxy") or None) as res:
+            try:
+                body = await res.json(content_type=None)
+            except ValueError as e:
+                logger.warn("[HTTP] response is not json, url={}, status={}, error={}".format(url, res.status, e))
+                body = None
+            return res.status, body
+    finally:
+        HttpClient()._latency(host).add(time.monotonic() - start)
@@ -0,0 +1,107 @@
+"""
+web、公众号、企业微信、飞书等通道共用的HTTP服务
+
+通过http_server配置选择服务实现：
+  cheroot:  多线程WSGI服务(默认)，web.py自带的依赖，支持keep-alive
+  waitress: 多线程WSGI服务，需要 pip install waitress
+  simple:   web.py的开发服务器(web.httpserver.runsimple)
+
+注：会话、消息队列等状态都保存在进程内，且通道线程在启动服务前已经创建，
+因此只支持单进程多线程，通过http_server_threads配置处理线程数
+"""
+
+from common.log import logger
+from config import conf
+
+
+class CherootServer:
+    def __init__(self, wsgi_app, bind_addr, threads):
+        from cheroot import wsgi
+
+        self.server = wsgi.Server(
+            bind_addr,
+            wsgi_app,
+            numthreads=threads,
+            server_name="localhost",
+            request_queue_size=conf().get("http_server_backlog", 128),
+            timeout=conf().get("http_server_keepalive_timeout", 10),
+            shutdown_timeout=conf().get("http_server_shutdown_timeout", 5),
+        )
+        self.server.nodelay = True
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+
+class WaitressServer:
+    def __init__(self, wsgi_app, bind_addr, threads):
+        from waitress.server import create_server
+
+        self.server = create_server(
+            wsgi_app,
+            host=bind_addr[0],
+            port=bind_addr[1],
+            threads=threads,
+            backlog=conf().get("http_server_backlog", 128),
+            channel_timeout=conf().get("http_server_keepalive_timeout", 10),
+            connection_limit=max(100, threads * 4),
+        )
+
+    def start(self):
+        self.server.run()
+
+    def stop(self):
+        self.server.close()
+
+
+class SimpleServer:
+    """
+    与web.httpserver.runsimple相同，可以在退出时停止
+    """
+
+    def __init__(self, wsgi_app, bind_addr, threads):
+        import web
+
+        wsgi_app = web.httpserver.LogMiddleware(web.httpserver.StaticMiddleware(wsgi_app))
+        self.server = web.httpserver.WSGIServer(bind_addr, wsgi_app)
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+
+SERVERS = {
+    "cheroot": CherootServer,
+    "waitress": WaitressServer,
+    "simple": SimpleServer,
+}
+
+
+def create_server(wsgi_app, port, threads=None, host="0.0.0.0", server_type=None):
+    server_type = server_type or conf().get("http_server", "cheroot")
+    if server_type not in SERVERS:
+        logger.warn("[HTTP] unknown http_server {}, use cheroot".format(server_type))
+        server_type = "cheroot"
+    threads = threads or conf().get("http_server_threads", 32)
+    logger.info("[HTTP] {} server listening on {}:{}, threads={}".format(server_type, host, port, threads))
+    return SERVERS[server_type](wsgi_app, (host, port), threads)
+
+
+def serve(wsgi_app, port, threads=None, host="0.0.0.0"):
+    """
+    启动HTTP服务并阻塞，收到退出信号时先停止接收新请求并等待处理中的请求结束，再保存用户数据
+    """
+    server = create_server(wsgi_app, port, threads, host)
+    try:
+        server.start()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("[HTTP] shutting down server on port {}".format(port))
+        raise
+    finally:
+        server.stop()
+        conf().save_user_datas()
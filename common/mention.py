@@ -0,0 +1,63 @@
+"""
+群聊消息中"@名称"的识别和去除，提及以\u2005(微信@后的特殊空格)或普通空格结尾
+"""
+
+import functools
+import re
+
+SEPARATORS = "\u2005\u0020"
+
+
+@functools.lru_cache(maxsize=256)
+def mention_pattern(name) -> re.Pattern:
+    """按名称缓存编译好的提及正则，机器人名称、群昵称只编译一次"""
+    return re.compile(f"@{re.escape(name)}[{SEPARATORS}]")
+
+
+def has_mention(content, name) -> bool:
+    """content中是否有"@name"，用于识别复制粘贴的、没有触发@通知的消息"""
+    return name is not None and mention_pattern(name).search(content) is not None
+
+
+def strip_mentions(content, names) -> str:
+    """
+    去掉content中所有"@名称"的提及，names通常是机器人名称加上消息的at_list
+    只扫描一遍content：在每个@处按names中出现的名称长度检查其后是否为分隔符、名称是否在names中，不需要为每个名称编译正则，
+    也不随at_list变长而多次替换。多个名称都能匹配时(如"Tom"和"Tom Lee")去掉最长的，避免昵称的一部分留在内容中
+    """
+    if not content or "@" not in content:
+        return content
+    names = {name for name in names if isinstance(name, str)}
+    if not names:
+        return content
+    lengths = sorted({len(name) for name in names}, reverse=True)
+    parts = []
+    start = 0
+    pos = content.find("@")
+    while pos != -1:
+        end = _match(content, pos, names, lengths)
+        if end:
+            parts.append(content[start:pos])
+            start = end
+            pos = content.find("@", end)
+        else:
+            pos = content.find("@", pos + 1)
+    if not parts:
+        return content
+    parts.append(content[start:])
+    return "".join(parts)
+
+
+def _match(content, pos, names, lengths):
+    """
+    :param lengths: names中名称的长度，降序
+    :return: content[pos]处的@匹配names中的名称时，返回提及(包括分隔符)结束的位置，否则返回0
+    """
+    name_start = pos + 1
+    for length in lengths:
+        end = name_start + length
+        if end >= len(content):
+            continue
+        if content[end] in SEPARATORS and content[name_start:end] in names:
+            return end + 1
+    return 0
@@ -0,0 +1,54 @@
+import threading
+from collections import deque
+
+
+class LatencyStat:
+    """
+    耗时统计，累计次数/总耗时/最大值，并保留最近window个样本用于计算分位数
+    """
+
+    def __init__(self, window=1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p):
+        with self.lock:
+            samples = sorted(self.samples)
+        return _percentile(samples, p)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            samples = sorted(self.samples)
+            count, total, max_value = self.count, self.total, self.max
+        return {
+            "count": count,
+            "avg": total / count if count else 0.0,
+            "p50": _percentile(samples, 50),
+            "p99": _percentile(samples, 99),
+            "max": max_value,
+        }
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+
+def _percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    idx = min(len(sorted_samples) - 1, int(round(p / 100.0 * (len(sorted_samples) - 1))))
+    return sorted_samples[idx]
@@ -0,0 +1,128 @@
+import hashlib
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+
+from common.expired_dict import ExpiredDict
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s?？!！。.~～,，、]+$")
+
+
+def normalize(text) -> str:
+    """
+    归一化：全角转半角、转小写、合并空白、去掉末尾的标点，"你好？"和"你好"视为同一个问题
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower().strip()
+    text = _TRAILING_PUNCTUATION.sub("", text)
+    return _SPACES.sub(" ", text)
+
+
+def ngrams(text) -> frozenset:
+    """字符bigram，中文不需要分词，过短的文本使用单字"""
+    if len(text) < 2:
+        return frozenset(text)
+    return frozenset(text[i : i + 2] for i in range(len(text) - 1))
+
+
+def _digest(*parts) -> str:
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class ReplyCache:
+    """
+    回复缓存
+      精确匹配：以(范围, 近期上下文, 归一化的问题)为键，范围包括模型和人设(system prompt)
+      相似匹配：只用于没有上下文的问题，按字符bigram的Jaccard相似度查找同一范围内最相似的问题，
+               相似度不低于similarity时命中，similarity为0时关闭
+    两级缓存都有过期时间和LRU数量上限
+    """
+
+    def __init__(self, ttl=3600, max_size=1000, similarity=0.0):
+        self.similarity = similarity
+        self.exact = ExpiredDict(ttl, max_size)  # key -> 回复
+        self.similar = ExpiredDict(ttl, max_size, on_evict=self._unindex)  # key -> (scope, grams, 回复)
+        self.index = defaultdict(set)  # (scope, gram) -> key，用于查找有相同bigram的问题
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def get(self, scope, history, query):
+        """
+        :param scope: 缓存范围，如模型和人设
+        :param history: 近期上下文[(role, content)]
+        :return: 命中时返回缓存的回复，否则返回None
+        """
+        scope = _digest(scope)
+        query = normalize(query)
+        reply = self.exact.get(_digest(scope, history, query))
+        if reply is not None:
+            self.stats["exact_hits"] += 1
+            return reply
+        if self.similarity and not history:
+            reply = self._get_similar(scope, query)
+            if reply is not None:
+                self.stats["similar_hits"] += 1
+                return reply
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, scope, history, query, reply):
+        scope = _digest(scope)
+        query = normalize(query)
+        self.exact[_digest(scope, history, query)] = reply
+        if self.similarity and not history:
+            key = _digest(scope, query)
+            grams = ngrams(query)
+            with self.lock:
+                for gram in grams:
+                    self.index[(scope, gram)].add(key)
+            self.similar[key] = (scope, grams, reply)
+        self.stats["stores"] += 1
+
+    def skip(self):
+        """记录不适合缓存而跳过的消息"""
+        self.stats["skipped"] += 1
+
+    def _get_similar(self, scope, query):
+        grams = ngrams(query)
+        shared = Counter()
+        with self.lock:
+            for gram in grams:
+                shared.update(self.index.get((scope, gram), ()))
+        best, best_score = None, self.similarity
+        for key, count in shared.items():
+            item = self.similar.get(key)
+            if item is None:
+                continue
+            score = count / (len(grams) + len(item[1]) - count)
+            if score >= best_score:
+                best, best_score = item[2], score
+        return best
+
+    def _unindex(self, key, item):
+        scope, grams, _ = item
+        with self.lock:
+            for gram in grams:
+                keys = self.index.get((scope, gram))
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.index[(scope, gram)]
+
+    def clear(self):
+        with self.lock:
+            self.exact.clear()
+            self.similar.clear()
+            self.index.clear()
+
+    def metrics(self) -> dict:
+        stats = dict(self.stats)
+        lookups = stats.get("exact_hits", 0) + stats.get("similar_hits", 0) + stats.get("misses", 0)
+        stats["hit_rate"] = (lookups - stats.get("misses", 0)) / lookups if lookups else 0.0
+        stats["size"] = len(self.exact)
+        return stats
@@ -0,0 +1,265 @@
+"""
+会话存储，通过session_store配置选择：
+  memory: 会话只保存在进程内(默认)，重启后丢失
+  sqlite: 保存到本地SQLite数据库(WAL模式)，重启后恢复
+  redis:  保存到Redis或兼容Redis协议的服务，多个实例可以共享会话，需要 pip install redis
+
+写入由后台线程批量完成(write-behind)，处理消息的线程只把会话放入待写队列，不会阻塞在磁盘或网络上
+"""
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+# 超过该长度的数据用zlib压缩后保存
+COMPRESS_THRESHOLD = 1024
+
+
+def dumps(system_prompt, messages) -> bytes:
+    """
+    紧凑序列化：只有role和content的消息保存为[role, content]，较长的数据再用zlib压缩
+    """
+    items = []
+    for message in messages:
+        if len(message) == 2 and "role" in message and "content" in message:
+            items.append([message["role"], message["content"]])
+        else:
+            items.append(message)
+    data = json.dumps({"p": system_prompt, "m": items}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(data) > COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(data)
+    return b"j" + data
+
+
+def loads(payload: bytes):
+    """
+    :return: (system_prompt, messages)
+    """
+    data = payload[1:]
+    if payload[:1] == b"z":
+        data = zlib.decompress(data)
+    data = json.loads(data.decode("utf-8"))
+    messages = [{"role": item[0], "content": item[1]} if isinstance(item, list) else item for item in data["m"]]
+    return data["p"], messages
+
+
+class MemoryStore:
+    """
+    会话只保存在SessionManager的进程内缓存中，不做持久化
+    """
+
+    persistent = False
+
+    def load(self, key):
+        return None
+
+    def save_many(self, items, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self, prefix):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteStore:
+    persistent = True
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_appdata_dir(), "sessions.db")
+        self.local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)")
+        conn.commit()
+        self.last_purge = 0.0
+
+    def _conn(self):
+        # sqlite连接不能跨线程使用，每个线程一个连接
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def load(self, key):
+        row = self._conn().execute("SELECT data, expires_at FROM sessions WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] and row[1] < time.time()):
+            return None
+        return bytes(row[0])
+
+    def save_many(self, items, ttl):
+        now = time.time()
+        expires_at = now + ttl if ttl else 0
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (key, data, expires_at) VALUES (?, ?, ?)",
+                [(key, payload, expires_at) for key, payload in items.items() if payload is not None],
+            )
+            conn.executemany("DELETE FROM sessions WHERE key = ?", [(key,) for key, payload in items.items() if payload is None])
+            if now - self.last_purge > 60:
+                conn.execute("DELETE FROM sessions WHERE expires_at > 0 AND expires_at < ?", (now,))
+                self.last_purge = now
+
+    def delete(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def clear(self, prefix):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+class RedisStore:
+    persistent = True
+
+    def __init__(self, url=None, key_prefix=None):
+        import redis
+
+        self.client = redis.Redis.from_url(url or conf().get("session_store_redis_url", "redis://localhost:6379/0"))
+        self.key_prefix = key_prefix if key_prefix is not None else conf().get("session_store_redis_prefix", "cow:session:")
+
+    def load(self, key):
+        return self.client.get(self.key_prefix + key)
+
+    def save_many(self, items, ttl):
+        pipe = self.client.pipeline(transaction=False)
+        for key, payload in items.items():
+            if payload is None:
+                pipe.delete(self.key_prefix + key)
+            elif ttl:
+                pipe.set(self.key_prefix + key, payload, ex=int(ttl))
+            else:
+                pipe.set(self.key_prefix + key, payload)
+        pipe.execute()
+
+    def delete(self, key):
+        self.client.delete(self.key_prefix + key)
+
+    def clear(self, prefix):
+        keys = list(self.client.scan_iter(match=self.key_prefix + prefix + "*", count=500))
+        for i in range(0, len(keys), 500):
+            self.client.delete(*keys[i : i + 500])
+
+    def close(self):
+        self.client.close()
+
+
+class WriteBehindStore:
+    """
+    后台线程每隔flush_interval秒把待写入的会话批量写入存储，同一会话在一个周期内多次修改只写最后一次
+    """
+
+    def __init__(self, store, ttl=0, flush_interval=1.0):
+        self.store = store
+        self.persistent = store.persistent
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.pending = {}  # key -> payload，payload为None表示删除
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        if self.persistent:
+            threading.Thread(target=self._run, name="session-store-writer", daemon=True).start()
+            atexit.register(self.close)
+
+    def load(self, key):
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+        return self.store.load(key)
+
+    def put(self, key, payload):
+        if not self.persistent:
+            return
+        with self.lock:
+            self.pending[key] = payload
+
+    def delete(self, key):
+        self.put(key, None)
+
+    def clear(self, prefix):
+        if not self.persistent:
+            return
+        with self.lock:
+            self.pending = {key: payload for key, payload in self.pending.items() if not key.startswith(prefix)}
+        self.store.clear(prefix)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                items, self.pending = self.pending, {}
+            if not items:
+                return
+            try:
+                self.store.save_many(items, self.ttl)
+            except Exception as e:
+                logger.warn("[SessionStore] failed to save {} sessions: {}".format(len(items), e))
+                with self.lock:
+                    # 写入失败的会话放回队列，下个周期重试，期间有更新的以新数据为准
+                    for key, payload in items.items():
+                        self.pending.setdefault(key, payload)
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.flush()
+        self.store.close()
+
+
+STORES = {
+    "memory": MemoryStore,
+    "sqlite": SqliteStore,
+    "redis": RedisStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> WriteBehindStore:
+    """
+    进程内所有SessionManager共用一个存储和写入线程
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            store_type = conf().get("session_store", "memory")
+            if store_type not in STORES:
+                logger.warn("[SessionStore] unknown session_store {}, use memory".format(store_type))
+                store_type = "memory"
+            try:
+                store = STORES[store_type]()
+            except Exception as e:
+                logger.error("[SessionStore] failed to init {} store, use memory: {}".format(store_type, e))
+                store_type, store = "memory", MemoryStore()
+            logger.info("[SessionStore] using {} session store".format(store_type))
+            _store = WriteBehindStore(store, conf().get("expires_in_seconds") or 0, conf().get("session_store_flush_interval", 1.0))
+        return _store
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import json
+import threading
+from collections import Counter
+
+from common.log import logger
+
+
+def make_key(*parts) -> str:
+    """把请求参数序列化后取摘要作为合并请求的键"""
+    data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+_flights = {}  # name -> SingleFlight
+
+
+def metrics() -> dict:
+    return {name: flight.metrics() for name, flight in _flights.items()}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class _LeaderCancelled(Exception):
+    pass
+
+
+class SingleFlight:
+    """
+    合并相同的并发请求：同一个key同时只有一个请求(leader)真正执行，其余请求等待并共享它的结果或异常
+    等待者超过max_waiters时不再合并，单独执行，避免一个慢请求拖住太多线程
+    同步调用和异步调用分别合并
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}  # key -> _Call
+        self.async_calls = {}  # key -> (asyncio.Future, 等待数)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        _flights[name] = self
+
+    def do(self, key, fn, max_waiters=0):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = _Call()
+                leader = True
+            elif max_waiters and call.waiters >= max_waiters:
+                call, leader = None, False
+            else:
+                call.waiters += 1
+                leader = False
+        if call is None:
+            self.stats["overflow"] += 1
+            return fn()
+        if not leader:
+            self.stats["saved"] += 1
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        self.stats["calls"] += 1
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            if call.waiters:
+                logger.debug("[SingleFlight] {} shared one call with {} waiters".format(self.name, call.waiters))
+            call.done.set()
+
+    async def async_do(self, key, coro_fn, max_waiters=0):
+        """
+        do的asyncio版本，coro_fn()返回协程
+        leader被取消时，等待者各自重新执行，不受影响
+        """
+        with self.lock:
+            item = self.async_calls.get(key)
+            if item is None:
+                future = asyncio.get_running_loop().create_future()
+                self.async_calls[key] = (future, 0)
+                leader = True
+            elif max_waiters and item[1] >= max_waiters:
+                future, leader = None, False
+            else:
+                future = item[0]
+                self.async_calls[key] = (future, item[1] + 1)
+                leader = False
+        if future is None:
+            self.stats["overflow"] += 1
+            return await coro_fn()
+        if not leader:
+            self.stats["saved"] += 1
+            try:
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                self.stats["saved"] -= 1
+                return await coro_fn()
+        self.stats["calls"] += 1
+        try:
+            result = await coro_fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.async_calls[key]
+            if not future.done():
+                future.set_exception(_LeaderCancelled())
+            future.exception()  # 标记异常已读取，没有等待者时避免"Future exception was never retrieved"警告
+
+    def metrics(self) -> dict:
+        return dict(self.stats)
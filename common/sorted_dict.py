@@ -1,7 +1,13 @@
-import heapq
+import bisect
 
 
 class SortedDict(dict):
+    """
+    按sort_func(k, v)排序的dict，迭代、keys()和items()按排序结果返回
+    self.order是按(priority, key)升序排列的列表，self.priorities记录每个key当前的priority，
+    修改和删除时二分查找原位置，不需要扫描和重新排序
+    """
+
     def __init__(self, sort_func=lambda k, v: k, init_dict=None, reverse=False):
         if init_dict is None:
             init_dict = []
@@ -10,53 +16,45 @@ class SortedDict(dict):
         self.sort_func = sort_func
         self.sorted_keys = None
         self.reverse = reverse
-        self.heap = []
+        self.order = []  # [(priority, key)]，升序
+        self.priorities = {}  # key -> priority
         for k, v in init_dict:
             self[k] = v
 
     def __setitem__(self, key, value):
-        if key in self:
-            super().__setitem__(key, value)
-            for i, (priority, k) in enumerate(self.heap):
-                if k == key:
-                    self.heap[i] = (self.sort_func(key, value), key)
-                    heapq.heapify(self.heap)
-                    break
-            self.sorted_keys = None
-        else:
-            super().__setitem__(key, value)
-            heapq.heappush(self.heap, (self.sort_func(key, value), key))
-            self.sorted_keys = None
+        super().__setitem__(key, value)
+        self._reposition(key, self.sort_func(key, value))
 
     def __delitem__(self, key):
         super().__delitem__(key)
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                del self.heap[i]
-                heapq.heapify(self.heap)
-                break
+        self._remove(key)
+        self.sorted_keys = None
+
+    def _remove(self, key):
+        priority = self.priorities.pop(key)
+        del self.order[bisect.bisect_left(self.order, (priority, key))]
+
+    def _reposition(self, key, priority):
+        if key in self.priorities:
+            if self.priorities[key] == priority:
+                return
+            self._remove(key)
+        self.priorities[key] = priority
+        bisect.insort(self.order, (priority, key))
         self.sorted_keys = None
 
     def keys(self):
         if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
+            order = reversed(self.order) if self.reverse else self.order
+            self.sorted_keys = [k for _, k in order]
         return self.sorted_keys
 
     def items(self):
-        if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
-        sorted_items = [(k, self[k]) for k in self.sorted_keys]
-        return sorted_items
+        return [(k, self[k]) for k in self.keys()]
 
     def _update_heap(self, key):
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                new_priority = self.sort_func(key, self[key])
-                if new_priority != priority:
-                    self.heap[i] = (new_priority, key)
-                    heapq.heapify(self.heap)
-                    self.sorted_keys = None
-                break
+        """value在外部被修改后调用，按新的priority调整key的位置"""
+        self._reposition(key, self.sort_func(key, self[key]))
 
     def __iter__(self):
         return iter(self.keys())
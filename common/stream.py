@@ -0,0 +1,80 @@
+"""
+流式回复(ReplyType.TEXT_STREAM)的辅助函数，回复内容为逐段产出文本增量的生成器
+"""
+import re
+import time
+
+from common.log import logger
+
+# 分段发送时的断句位置
+_SENTENCE_END = re.compile(r"[。！？；!?;\n]|\.(?=\s)")
+
+
+def record_stream(chunks, on_finish):
+    """
+    透传文本增量，生成器结束(包括中途被关闭或出错)时把已产出的完整文本交给on_finish，用于写入会话记录
+    """
+    parts = []
+    try:
+        for chunk in chunks:
+            if chunk:
+                parts.append(chunk)
+                yield chunk
+    except Exception as e:
+        logger.warn("[Stream] stream interrupted: {}".format(e))
+    finally:
+        on_finish("".join(parts))
+
+
+def collect(chunks) -> str:
+    return "".join(chunk for chunk in chunks if chunk)
+
+
+def wrap(chunks, prefix="", suffix=""):
+    """
+    在流式文本前后加上前缀、后缀
+    """
+    if prefix:
+        yield prefix
+    yield from chunks
+    if suffix:
+        yield suffix
+
+
+def sentence_chunks(chunks, min_length=100):
+    """
+    把文本增量合并为句子粒度的分段，每段至少min_length个字符且在句末断开，用于不支持流式更新的通道
+    """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) < min_length:
+            continue
+        end = None
+        for match in _SENTENCE_END.finditer(buffer, min_length - 1):
+            end = match.end()
+        if end:
+            segment, buffer = buffer[:end].strip(), buffer[end:]
+            if segment:
+                yield segment
+    buffer = buffer.strip()
+    if buffer:
+        yield buffer
+
+
+def snapshots(chunks, interval=1.0):
+    """
+    把文本增量转换为截至当前的完整文本，相邻两次产出至少间隔interval秒，结束时总会产出最终文本
+    用于通过编辑/更新消息实现流式显示的通道，避免触发接口频率限制
+    """
+    text = ""
+    last_text = ""
+    last_time = 0.0
+    for chunk in chunks:
+        text += chunk
+        now = time.monotonic()
+        if text.strip() and now - last_time >= interval:
+            last_text, last_time = text, now
+            yield text
+    if text != last_text:
+        yield text
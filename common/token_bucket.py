@@ -1,39 +1,92 @@
+import asyncio
 import threading
 import time
 
+from common.expired_dict import ExpiredDict
+
 
 class TokenBucket:
-    def __init__(self, tpm, timeout=None):
-        self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
-        self.rate = int(tpm) / 60  # 令牌每秒生成速率
-        self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
-
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
-            self.tokens -= 1
+    """
+    令牌桶限流，不使用线程：每次取令牌时根据距上次取令牌经过的时间补充令牌
+
+    等待令牌时采用预约方式：先扣减令牌(可以为负)，再等待令牌补足所需的时间，先到先得
+    """
+
+    def __init__(self, tpm, timeout=None, capacity=None):
+        self.rate = tpm / 60  # 令牌每秒生成速率
+        self.capacity = capacity or max(1, int(tpm))  # 令牌桶容量
+        self.tokens = self.capacity  # 初始时令牌桶是满的
+        self.timeout = timeout  # 等待令牌超时时间，None表示一直等待
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, n=1) -> bool:
+        """不等待，令牌不足时直接返回False"""
+        with self.lock:
+            self._refill()
+            if self.tokens < n:
+                return False
+            self.tokens -= n
+            return True
+
+    def _reserve(self, n, timeout):
+        """
+        预约n个令牌
+        :return: 需要等待的秒数，超过timeout时不预约并返回None
+        """
+        with self.lock:
+            self._refill()
+            wait = max(0.0, (n - self.tokens) / self.rate)
+            if timeout is not None and wait > timeout:
+                return None
+            self.tokens -= n
+            return wait
+
+    def get_token(self, timeout=-1) -> bool:
+        """获取令牌，令牌不足时阻塞等待，超时返回False"""
+        wait = self._reserve(1, self.timeout if timeout == -1 else timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    async def async_get_token(self, timeout=-1) -> bool:
+        """get_token的asyncio版本，等待时不占用线程"""
+        wait = self._reserve(1, self.timeout if timeout == -1 else timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
         return True
 
     def close(self):
-        self.is_running = False
+        # 没有后台线程，保留接口兼容
+        pass
+
+
+# 按名称和key(用户、会话、api key、模型等)共享的令牌桶，一段时间不用的令牌桶已经补满，过期删除后重建等价
+_buckets = ExpiredDict(3600)
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(name, tpm, key=None, timeout=None, capacity=None) -> TokenBucket:
+    """
+    获取共享的令牌桶，如get_bucket("chatgpt", 20)为全局限流，get_bucket("chatgpt_session", 5, key=session_id)为每个会话单独限流
+    tpm变化(如修改配置后)时重建令牌桶
+    """
+    bucket_key = (name, key)
+    with _buckets_lock:
+        bucket = _buckets.get(bucket_key)
+        if bucket is None or bucket.rate != tpm / 60 or bucket.timeout != timeout:
+            bucket = TokenBucket(tpm, timeout, capacity)
+            _buckets[bucket_key] = bucket
+        return bucket
 
 
 if __name__ == "__main__":
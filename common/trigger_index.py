@@ -0,0 +1,151 @@
+"""
+消息触发词索引：把群聊前缀、群聊关键词、私聊前缀、画图前缀和群名关键词白名单编译成一个Aho-Corasick自动机，
+前缀(check_prefix)和包含(check_contain)的判断都在同一个索引上完成，结果与逐个startswith/find相同
+
+自动机的goto边本身就是所有触发词的前缀树：前缀匹配从开头沿goto边走，最多扫描最长前缀的长度；
+包含匹配按Aho-Corasick扫描一遍内容，同时查找多个列表的所有关键词，不随关键词数量变慢
+触发词较少时逐个用in查找(C实现)比逐字符遍历自动机更快，少于AUTOMATON_MIN_KEYWORDS个的列表不走自动机查找包含
+配置重载(#reconf、load_config)后各列表是新的对象，trigger_index()发现列表变化时重新编译
+"""
+
+from collections import deque
+
+from config import conf
+
+# 配置项 -> 代码中使用的默认值
+TRIGGERS = {
+    "group_chat_prefix": None,
+    "group_chat_keyword": None,
+    "single_chat_prefix": [""],
+    "image_create_prefix": [""],
+    "group_name_keyword_white_list": [],
+}
+
+# 包含匹配的触发词达到这个数量时才用自动机扫描，见scripts/bench_trigger_index.py
+AUTOMATON_MIN_KEYWORDS = 128
+
+
+class TriggerIndex:
+    def __init__(self, triggers: dict):
+        """
+        :param triggers: 名称 -> 触发词列表，同一个词可以出现在多个列表中
+        """
+        self.triggers = triggers
+        self.goto = [{}]  # 状态 -> {字符: 下一个状态}
+        self.fail = [0]
+        self.depth = [0]
+        self.output = [[]]  # 状态 -> [(名称, 在列表中的位置, 长度)]，包含fail链上的输出
+        self.empty = {}  # 名称 -> 空字符串在列表中的位置，空字符串是任何内容的前缀，也包含在任何内容中
+        self.scan = set()  # 用自动机查找包含的列表名称
+        for name, words in triggers.items():
+            for order, word in enumerate(words or []):
+                if not word:
+                    self.empty.setdefault(name, order)
+                    continue
+                self._add(word, (name, order, len(word)))
+            if len(words or ()) >= AUTOMATON_MIN_KEYWORDS:
+                self.scan.add(name)
+        self._build()
+
+    def _add(self, word, item):
+        state = 0
+        for ch in word:
+            next_state = self.goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][ch] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[state] + 1)
+                self.output.append([])
+            state = next_state
+        self.output[state].append(item)
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(ch, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def match(self, content, prefix=(), contain=()) -> dict:
+        """
+        :param prefix: 按前缀匹配的列表名称，结果为列表中第一个匹配的前缀，同check_prefix
+        :param contain: 按包含匹配的列表名称，结果为True，同check_contain
+        :return: 名称 -> 匹配结果，没有匹配时为None
+        """
+        result = {}
+        pending = None
+        for name in contain:
+            if name in self.empty:
+                result[name] = True
+                continue
+            result[name] = None
+            if name in self.scan:
+                if pending is None:
+                    pending = set()
+                pending.add(name)
+                continue
+            for word in self.triggers[name] or ():
+                if word in content:
+                    result[name] = True
+                    break
+        if prefix:
+            self._match_prefix(content, prefix, result)
+        if pending:
+            self._scan(content, pending, result)
+        return result
+
+    def _match_prefix(self, content, names, result):
+        """从开头沿goto边(前缀树)匹配，走不下去时结束，最多扫描最长前缀的长度"""
+        best = {}  # 名称 -> 已匹配前缀在列表中的最小位置
+        for name in names:
+            result[name] = None
+            if name in self.empty:
+                best[name] = self.empty[name]
+        goto, depth, output = self.goto, self.depth, self.output
+        state = 0
+        for ch in content:
+            state = goto[state].get(ch)
+            if state is None:
+                break
+            for name, order, length in output[state]:
+                # 只有以当前状态结尾的触发词是前缀，fail链上的是后缀
+                if length == depth[state] and name in names and order < best.get(name, order + 1):
+                    best[name] = order
+        for name, order in best.items():
+            result[name] = self.triggers[name][order]
+
+    def _scan(self, content, pending, result):
+        """扫描整个内容查找pending中列表的触发词，全部找到后提前结束"""
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for ch in content:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for name, _, _ in output[state]:
+                if name in pending:
+                    result[name] = True
+                    pending.discard(name)
+                    if not pending:
+                        return
+
+
+_index = None
+
+
+def trigger_index() -> TriggerIndex:
+    """返回按当前配置编译的索引，配置中的触发词列表变化时重新编译"""
+    global _index
+    config = conf()
+    triggers = {name: config.get(name, default) for name, default in TRIGGERS.items()}
+    index = _index
+    if index is None or any(index.triggers[name] is not words for name, words in triggers.items()):
+        index = _index = TriggerIndex(triggers)
+    return index
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from common.log import logger
+from common.metrics import LatencyStat
+
+
+class WorkerLane:
+    """
+    单个处理通道的线程池
+    常驻workers个线程，排队任务数达到scale_queue_depth时临时扩容到max_workers，扩容的线程空闲idle_timeout秒后退出
+    """
+
+    def __init__(self, name, workers, max_workers=0, scale_queue_depth=1, idle_timeout=60):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.max_workers = max(self.workers, int(max_workers or 0))
+        self.scale_queue_depth = max(1, int(scale_queue_depth))
+        self.idle_timeout = idle_timeout
+        self.wait_time = LatencyStat()  # 排队耗时
+        self.run_time = LatencyStat()  # 执行耗时
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._threads = 0
+        self._idle = 0
+        self._active = 0
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._queue.append((future, fn, args, kwargs, time.monotonic()))
+            if self._idle < len(self._queue):
+                if self._threads < self.workers:
+                    self._start_worker()
+                elif self._threads < self.max_workers and len(self._queue) - self._idle >= self.scale_queue_depth:
+                    logger.debug("[WorkerPool] lane {} scale up, threads={}, queue={}".format(self.name, self._threads + 1, len(self._queue)))
+                    self._start_worker()
+            self._cond.notify()
+        return future
+
+    def _start_worker(self):
+        self._threads += 1
+        t = threading.Thread(target=self._work, name="{}-worker-{}".format(self.name, self._threads))
+        t.daemon = True
+        t.start()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                while not self._queue and not self._shutdown:
+                    if self._threads <= self.workers:
+                        self._cond.wait()
+                    elif not self._cond.wait(self.idle_timeout) and not self._queue and self._threads > self.workers:
+                        break
+                self._idle -= 1
+                if not self._queue:  # 空闲超时或已关闭
+                    self._threads -= 1
+                    return
+                future, fn, args, kwargs, enqueue_time = self._queue.popleft()
+                self._active += 1
+            try:
+                if not future.set_running_or_notify_cancel():  # 排队期间已被取消
+                    continue
+                start = time.monotonic()
+                self.wait_time.add(start - enqueue_time)
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+                finally:
+                    self.run_time.add(time.monotonic() - start)
+            finally:
+                with self._cond:
+                    self._active -= 1
+
+    def shutdown(self, cancel_futures=False):
+        with self._cond:
+            self._shutdown = True
+            if cancel_futures:
+                while self._queue:
+                    self._queue.popleft()[0].cancel()
+            self._cond.notify_all()
+
+    def metrics(self) -> dict:
+        with self._cond:
+            stats = {
+                "threads": self._threads,
+                "workers": self.workers,
+                "max_workers": self.max_workers,
+                "active": self._active,
+                "queue_depth": len(self._queue),
+            }
+        stats["wait_time"] = self.wait_time.snapshot()
+        stats["run_time"] = self.run_time.snapshot()
+        return stats
+
+
+class WorkerPool:
+    """
+    按lane划分的消息处理线程池，不同开销的任务在各自的lane中排队，互不阻塞
+    """
+
+    LIGHT = "light"  # 管理指令、插件指令等不需要调用模型的轻量任务
+    HEAVY = "heavy"  # 调用模型、语音、画图等耗时任务
+
+    def __init__(self, lanes: dict, default_lane=HEAVY):
+        self.lanes = lanes
+        self.default_lane = default_lane
+
+    @property
+    def _shutdown(self):  # 兼容ThreadPoolExecutor的属性，itchat重新登录时会重置该标志
+        return all(lane._shutdown for lane in self.lanes.values())
+
+    @_shutdown.setter
+    def _shutdown(self, value):
+        for lane in self.lanes.values():
+            lane._shutdown = value
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self.submit_to(self.default_lane, fn, *args, **kwargs)
+
+    def submit_to(self, lane: str, fn, *args, **kwargs) -> Future:
+        worker_lane = self.lanes.get(lane) or self.lanes[self.default_lane]
+        return worker_lane.submit(fn, *args, **kwargs)
+
+    def shutdown(self, cancel_futures=False):
+        for lane in self.lanes.values():
+            lane.shutdown(cancel_futures)
+
+    def metrics(self) -> dict:
+        return {name: lane.metrics() for name, lane in self.lanes.items()}
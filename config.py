@@ -1,5 +1,7 @@
 # encoding:utf-8
 
+import contextlib
+import contextvars
 import json
 import logging
 import os
@@ -49,15 +51,46 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "handler_pool_size": 8,  # 处理模型、语音、画图等耗时消息的线程数
+    "handler_pool_max_size": 0,  # 耗时消息排队时线程池最多扩容到多少个线程，不大于handler_pool_size时不扩容
+    "handler_pool_scale_queue_depth": 1,  # 排队消息数达到该值时触发扩容
+    "handler_pool_light_size": 2,  # 处理管理指令、插件指令等轻量消息的线程数
+    "message_queue_max_size": 0,  # 每个会话最多排队的消息数，超出时不再处理新消息，0表示不限制
+    "message_queue_total_max_size": 0,  # 所有会话排队的消息总数上限，0表示不限制
+    "message_deadline_seconds": 0,  # 消息的处理期限(秒)，排队超过期限的消息不再调用模型，重试也不会超过期限，0表示不限制
+    "busy_reply": "当前消息较多，请稍后再试",  # 消息因排队过多或超过期限未处理时的回复，为空时直接丢弃
+    "fair_queue_weights": {},  # 公平调度的权重，key为群名、群id或用户id，默认为1，权重越高分到的处理机会越多，如 {"VIP群": 3}
+    "fair_queue_admin_weight": 2,  # 管理员私聊的调度权重
+    "fair_queue_tenant_max_inflight": 0,  # 每个群或私聊用户同时处理中的模型调用数上限，0表示不限制
+    "http_server": "cheroot",  # web、公众号、企业微信、飞书通道的HTTP服务，可选cheroot、waitress、simple(web.py开发服务器)
+    "http_server_threads": 32,  # HTTP服务处理线程数，web通道使用web_server_threads
+    "http_server_backlog": 128,  # HTTP服务等待accept的连接队列长度
+    "http_server_keepalive_timeout": 10,  # HTTP空闲连接保持时间(秒)
+    "http_server_shutdown_timeout": 5,  # 退出时等待处理中请求结束的最长时间(秒)
+    "stream_reply": False,  # 是否流式回复，web、终端、飞书、钉钉(AI卡片)增量显示，其他通道按句分段发送
+    "stream_chunk_min_length": 100,  # 不支持增量显示的通道分段发送时，每段的最少字数
+    "stream_update_interval": 1.0,  # 飞书、钉钉等通过更新消息实现流式显示时，两次更新的最小间隔(秒)
+    "http_pool_connections": 20,  # HTTP连接池缓存的host数量
+    "http_pool_maxsize": 20,  # 每个host最多保持的keep-alive连接数
+    "http_connect_timeout": 10,  # HTTP建立连接超时时间(秒)
+    "http_read_timeout": 180,  # HTTP读取响应超时时间(秒)，调用处指定了timeout时以调用处为准
+    "http_proxy": "",  # 模型、语音、通道等HTTP请求使用的代理，openai sdk仍使用proxy配置
+    "async_mode": False,  # 是否使用asyncio并发处理模型请求，开启后文本消息不再占用处理线程，不支持异步的bot会自动转为线程池执行
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_store": "memory",  # 会话存储，支持 memory(进程内), sqlite(本地数据库，重启后恢复), redis(多实例共享)
+    "session_store_flush_interval": 1.0,  # 会话批量写入存储的间隔(秒)
+    "session_store_shared": False,  # 多个实例共享会话存储时开启，每次使用会话前检查是否被其他实例修改
+    "session_store_redis_url": "redis://localhost:6379/0",  # session_store为redis时的连接地址
+    "session_store_redis_prefix": "cow:session:",  # redis中会话key的前缀
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
+    "rate_limit_chatgpt_per_session": 0,  # 每个会话每分钟最多调用chatgpt的次数，超出时直接提示，0表示不限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
@@ -66,6 +99,30 @@ available_setting = {
     "presence_penalty": 0,
     "request_timeout": 180,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
+    "request_max_retries": 2,  # 模型请求失败时的最大重试次数，重试间隔按指数退避并加随机抖动
+    "chat_backends": [],  # 多个对话模型后端，按顺序失败切换，如["chatGPT", {"bot_type": "moonshot", "model": "moonshot-v1-8k", "weight": 1}]
+    "circuit_breaker_failures": 5,  # 后端连续失败多少次后熔断
+    "circuit_breaker_error_rate": 0.5,  # 后端最近请求的失败率达到多少时熔断
+    "circuit_breaker_cooldown": 30,  # 熔断后多少秒再试探恢复，连续熔断时指数增长
+    "hedge_requests": False,  # 是否开启对冲请求，首选后端超过一定时间未回复时同时请求下一个后端，采用先返回的回复，需配置chat_backends
+    "hedge_percentile": 95,  # 首选后端超过其近期耗时的该分位数仍未回复时发送对冲请求
+    "hedge_delay": 10,  # 首选后端耗时样本不足时，等待多少秒后发送对冲请求
+    "hedge_min_delay": 2,  # 发送对冲请求前最少等待的秒数
+    "reply_cache": False,  # 是否缓存模型回复，相同的问题直接使用缓存的回复，不再请求模型
+    "reply_cache_ttl": 3600,  # 缓存的回复有效期(秒)
+    "reply_cache_max_size": 1000,  # 最多缓存的回复数量，超出时淘汰最久未命中的
+    "reply_cache_similarity": 0,  # 相似问题命中缓存的相似度阈值(0~1，如0.9)，0表示只使用完全相同的问题
+    "reply_cache_context_messages": 0,  # 会话中已有的上下文消息不超过该数量时才使用缓存，上下文会作为缓存键的一部分
+    "reply_cache_exclude": [],  # 不使用回复缓存的群名、群id、用户id或会话id
+    "request_coalescing": True,  # 是否合并同时发起的相同模型请求(相同的模型、参数和消息)，只请求一次并共享结果
+    "request_coalescing_max_waiters": 50,  # 一个请求最多合并多少个相同请求，超出的单独请求
+    "session_compaction": False,  # 是否压缩会话，上下文较长时把较早的对话总结为摘要，代替直接丢弃
+    "session_compaction_ratio": 0.7,  # 上下文超过conversation_max_tokens的该比例时开始总结
+    "session_compaction_keep_messages": 4,  # 保留原文的最近消息数
+    "session_compaction_model": "gpt-4o-mini",  # 总结使用的模型，建议使用较便宜的模型
+    "session_compaction_summary_length": 300,  # 摘要的最大字数
+    "prompt_cache": False,  # 是否按提示词缓存优化会话，超出上下文上限时一次丢弃一整块较早的消息，保持前缀不变，Claude会发送缓存标记
+    "prompt_cache_trim_ratio": 0.5,  # 开启prompt_cache时，超出上限后丢弃较早的消息直到上下文不超过conversation_max_tokens的该比例
     # Baidu 文心一言参数
     "baidu_wenxin_model": "eb-instant",  # 默认使用ERNIE-Bot-turbo模型
     "baidu_wenxin_api_key": "",  # Baidu api key
@@ -183,9 +240,17 @@ available_setting = {
     "Minimax_group_id": "",
     "Minimax_base_url": "",
     "web_port": 9899,
+    "web_server_threads": 200,  # web通道的处理线程数，每个打开的网页会占用一个线程等待推送
+    "web_long_poll_timeout": 30,  # web通道长轮询的最长等待时间(秒)
+    "web_stream_heartbeat": 15,  # web通道SSE连接空闲时发送心跳的间隔(秒)
+    "web_max_waiting_connections": 150,  # web通道同时等待回复的SSE和长轮询连接数上限，超出的页面改为定时轮询，最多为web_server_threads的3/4
 }
 
 
+# 当前线程或协程内临时覆盖的配置，见override()
+_overrides = contextvars.ContextVar("config_overrides", default=None)
+
+
 class Config(dict):
     def __init__(self, d=None):
         super().__init__()
@@ -199,6 +264,9 @@ class Config(dict):
     def __getitem__(self, key):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
+        overrides = _overrides.get()
+        if overrides and key in overrides:
+            return overrides[key]
         return super().__getitem__(key)
 
     def __setitem__(self, key, value):
@@ -318,6 +386,20 @@ def conf():
     return config
 
 
+@contextlib.contextmanager
+def override(overrides: dict):
+    """
+    在当前线程或协程内临时覆盖配置，不影响其他线程，如bridge为备用模型指定model、api key
+    with override({"model": "moonshot-v1-8k"}):
+        bot = create_bot(const.MOONSHOT)
+    """
+    token = _overrides.set({**(_overrides.get() or {}), **overrides})
+    try:
+        yield
+    finally:
+        _overrides.reset(token)
+
+
 def get_appdata_dir():
     data_path = os.path.join(get_root(), conf().get("appdata_dir", ""))
     if not os.path.exists(data_path):
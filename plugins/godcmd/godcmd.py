@@ -92,6 +92,10 @@ ADMIN_COMMANDS = {
         "alias": ["plist", "插件"],
         "desc": "打印当前插件列表",
     },
+    "pstat": {
+        "alias": ["pstat", "插件耗时"],
+        "desc": "查看各插件处理事件的耗时和熔断状态",
+    },
     "setpri": {
         "alias": ["setpri", "设置插件优先级"],
         "args": ["插件名", "优先级"],
@@ -131,6 +135,26 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "pool": {
+        "alias": ["pool", "线程池"],
+        "desc": "查看消息处理线程池状态",
+    },
+    "http": {
+        "alias": ["http", "连接池"],
+        "desc": "查看HTTP连接池状态",
+    },
+    "backends": {
+        "alias": ["backends", "模型后端"],
+        "desc": "查看对话模型后端的熔断状态",
+    },
+    "cache": {
+        "alias": ["cache", "回复缓存"],
+        "desc": "查看回复缓存、提示词缓存命中率和合并请求数",
+    },
+    "compaction": {
+        "alias": ["compaction", "会话压缩"],
+        "desc": "查看会话压缩节省的token数",
+    },
 }
 
 
@@ -353,6 +377,16 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "pool":
+                            ok, result = True, self.pool_status()
+                        elif cmd == "http":
+                            ok, result = True, self.http_status()
+                        elif cmd == "backends":
+                            ok, result = True, self.backends_status()
+                        elif cmd == "cache":
+                            ok, result = True, self.cache_status()
+                        elif cmd == "compaction":
+                            ok, result = True, self.compaction_status()
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
@@ -363,6 +397,8 @@ class Godcmd(Plugin):
                                     result += "已启用\n"
                                 else:
                                     result += "未启用\n"
+                        elif cmd == "pstat":
+                            ok, result = True, self.plugin_stats()
                         elif cmd == "scanp":
                             new_plugins = PluginManager().scan_plugins()
                             ok, result = True, "插件扫描完成"
@@ -462,6 +498,91 @@ class Godcmd(Plugin):
         else:
             return False, "认证失败"
 
+    def pool_status(self) -> str:
+        from channel.chat_channel import ChatChannel, handler_pool
+
+        result = "线程池状态："
+        for lane, stats in handler_pool.metrics().items():
+            wait, run = stats["wait_time"], stats["run_time"]
+            result += f"\n[{lane}] 线程 {stats['threads']}/{stats['max_workers']}, 执行中 {stats['active']}, 排队 {stats['queue_depth']}"
+            result += f"\n  排队耗时 p50={wait['p50'] * 1000:.0f}ms p99={wait['p99'] * 1000:.0f}ms"
+            result += f"\n  执行耗时 p50={run['p50'] * 1000:.0f}ms p99={run['p99'] * 1000:.0f}ms, 共{run['count']}条"
+        tenants = sorted(ChatChannel.ready_sessions.metrics().items(), key=lambda item: item[1]["p99"], reverse=True)
+        if tenants:
+            result += "\n排队最久的群/用户："
+            for tenant, wait in tenants[:5]:
+                result += f"\n  {tenant} p50={wait['p50'] * 1000:.0f}ms p99={wait['p99'] * 1000:.0f}ms, 共{wait['count']}条"
+        return result
+
+    def http_status(self) -> str:
+        from common import http
+
+        stats = http.stats()
+        if not stats:
+            return "HTTP连接池暂无请求"
+        result = "HTTP连接池状态："
+        for host, item in stats.items():
+            latency = item.get("latency") or {"p50": 0, "p99": 0}
+            result += f"\n[{host}] 请求 {item['requests']}, 新建连接 {item['connections']}, 复用 {item['reused']}, 异常 {item.get('errors', 0)}"
+            result += f"\n  耗时 p50={latency['p50'] * 1000:.0f}ms p99={latency['p99'] * 1000:.0f}ms"
+        return result
+
+    def plugin_stats(self) -> str:
+        metrics = PluginManager().handler_metrics()
+        if not metrics:
+            return "插件暂未处理过事件"
+        guards = PluginManager().guard_metrics()
+        result = "插件耗时："
+        for name, events in metrics.items():
+            for event, latency in events.items():
+                result += f"\n[{name}] {event} p50={latency['p50'] * 1000:.1f}ms p99={latency['p99'] * 1000:.1f}ms, 共{latency['count']}次"
+            guard = guards.get(name)
+            if guard:
+                pool = f", 独立线程 {guard['inflight']}/{guard['pool_size']}" if guard["pool_size"] else ""
+                result += f"\n  预算 {guard['timeout']}s, 熔断状态 {guard['breaker']}{pool}"
+        return result
+
+    def backends_status(self) -> str:
+        stats = Bridge().chat_backend_stats()
+        if not stats:
+            return "未配置chat_backends"
+        result = "模型后端状态："
+        for name, item in stats.items():
+            latency = item["latency"]
+            result += f"\n[{name}] {item['state']}, 失败率 {item['error_rate']:.0%}, 连续失败 {item['consecutive_failures']}"
+            if item["open_remaining"]:
+                result += f", {item['open_remaining']:.0f}秒后试探恢复"
+            result += f"\n  耗时 p50={latency['p50'] * 1000:.0f}ms p99={latency['p99'] * 1000:.0f}ms, 共{latency['count']}次"
+        return result
+
+    def cache_status(self) -> str:
+        from common import single_flight
+
+        if conf().get("reply_cache", False):
+            stats = Bridge().reply_cache.metrics()
+            result = f"回复缓存：{stats['size']}条, 命中率 {stats['hit_rate']:.0%}"
+            result += f"\n  精确命中 {stats.get('exact_hits', 0)}, 相似命中 {stats.get('similar_hits', 0)}, 未命中 {stats.get('misses', 0)}, 不适合缓存 {stats.get('skipped', 0)}"
+        else:
+            result = "回复缓存未开启"
+        sessions = getattr(Bridge().get_bot("chat"), "sessions", None)
+        if sessions is not None:
+            stats = sessions.cache_usage_stats()
+            result += f"\n提示词缓存：{stats['sessions']}个会话, 命中 {stats['cached_tokens']}/{stats['prompt_tokens']} tokens ({stats['hit_rate']:.0%})"
+        for name, stats in single_flight.metrics().items():
+            result += f"\n[{name}] 合并请求：调用 {stats.get('calls', 0)}, 节省 {stats.get('saved', 0)}, 等待数超限 {stats.get('overflow', 0)}"
+        return result
+
+    def compaction_status(self) -> str:
+        from bot import session_compactor
+
+        if not session_compactor.enabled():
+            return "会话压缩未开启"
+        stats = session_compactor.metrics()
+        result = f"会话压缩：{stats['sessions']}个会话, 共节省 {stats['saved_tokens']} tokens"
+        for session_id, saved in stats["top"]:
+            result += f"\n  {session_id} 节省 {saved} tokens"
+        return result
+
     def get_help_text(self, isadmin=False, isgroup=False, **kwargs):
         return get_help_text(isadmin, isgroup)
 
@@ -0,0 +1,100 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from common.circuit_breaker import CircuitBreaker
+from common.log import logger
+
+from .event import EventContext
+
+
+class PluginGuard:
+    """
+    插件handler的耗时预算，在plugins.json中按插件配置，如：
+        "Keyword": {"enabled": true, "priority": 900, "timeout": 5, "pool_size": 2}
+      timeout:      耗时预算(秒)，超出或抛出异常记为一次失败
+      pool_size:    大于0时handler在该插件独立的线程池中执行，超时后不再等待，消息继续交给后面的插件和默认逻辑处理；
+                    线程池的线程都在执行时直接跳过该插件。不配置时在处理消息的线程中执行，超时只能事后计入失败
+      max_failures: 连续失败多少次后熔断，熔断期间跳过该插件，cooldown(秒)后试探恢复
+    """
+
+    def __init__(self, name, timeout, pool_size=0, max_failures=5, cooldown=60):
+        self.name = name
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="plugin-" + name.lower()) if pool_size else None
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self.breaker = CircuitBreaker("plugin " + name, failure_threshold=max_failures, min_requests=max(10, max_failures), cooldown=cooldown)
+
+    @classmethod
+    def from_config(cls, name, plugin_conf: dict):
+        timeout = plugin_conf.get("timeout")
+        if not timeout:
+            return None
+        return cls(name, timeout, plugin_conf.get("pool_size", 0), plugin_conf.get("max_failures", 5), plugin_conf.get("cooldown", 60))
+
+    def call(self, handler, e_context: EventContext, stat, *args, **kwargs):
+        """
+        :return: handler是否执行完成，被跳过或超时返回False
+        """
+        if not self.breaker.allow():
+            logger.debug("[PluginGuard] plugin {} is circuit broken, skipped".format(self.name))
+            return False
+        start = time.perf_counter()
+        try:
+            if self.pool is None:
+                handler(e_context, *args, **kwargs)
+                done = True
+            else:
+                done = self._call_isolated(handler, e_context, *args, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            stat.add(elapsed)
+        if done and elapsed <= self.timeout:
+            self.breaker.record_success()
+        else:
+            if done:
+                logger.warn("[PluginGuard] plugin {} took {:.2f}s, exceeds budget {}s".format(self.name, elapsed, self.timeout))
+            self.breaker.record_failure()
+        return done
+
+    def _call_isolated(self, handler, e_context: EventContext, *args, **kwargs):
+        with self.lock:
+            if self.inflight >= self.pool_size:
+                logger.warn("[PluginGuard] plugin {} pool is full, skipped".format(self.name))
+                return False
+            self.inflight += 1
+        # handler修改的是副本，超时后再完成也不会影响后续处理
+        shadow = EventContext(e_context.event, dict(e_context.econtext))
+        shadow.action = e_context.action
+        future = self.pool.submit(handler, shadow, *args, **kwargs)
+        future.add_done_callback(self._release)
+        try:
+            future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            logger.warn("[PluginGuard] plugin {} timed out after {}s, skipped".format(self.name, self.timeout))
+            return False
+        e_context.econtext = shadow.econtext
+        e_context.action = shadow.action
+        return True
+
+    def _release(self, future):
+        with self.lock:
+            self.inflight -= 1
+
+    def metrics(self) -> dict:
+        return {
+            "timeout": self.timeout,
+            "pool_size": self.pool_size,
+            "inflight": self.inflight,
+            "breaker": self.breaker.metrics()["state"],
+        }
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
@@ -3,15 +3,19 @@
 import importlib
 import importlib.util
 import json
+import logging
 import os
 import sys
+import time
 
 from common.log import logger
+from common.metrics import LatencyStat
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
 from config import conf, remove_plugin_config, write_plugin_config
 
 from .event import *
+from .plugin_guard import PluginGuard
 
 
 @singleton
@@ -23,6 +27,9 @@ class PluginManager:
         self.pconf = {}
         self.current_plugin_path = None
         self.loaded = {}
+        self.dispatch = {}  # event -> ((插件名, handler, 耗时统计), ...)，按优先级排列，只包含已开启的插件
+        self.handler_stats = {}  # (插件名, event) -> LatencyStat
+        self.guards = {}  # 插件名 -> (PluginGuard, 生成它的配置)，plugins.json中配置了timeout的插件
 
     def register(self, name: str, desire_priority: int = 0, **kwargs):
         def wrapper(plugincls):
@@ -136,6 +143,42 @@ class PluginManager:
     def refresh_order(self):
         for event in self.listening_plugins.keys():
             self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority, reverse=True)
+        self.compile_dispatch()
+
+    def compile_dispatch(self):
+        """
+        插件开启、关闭、重载或调整优先级后调用，预先生成每个事件依次调用的handler，
+        emit_event时不再查找插件、检查是否开启
+        """
+        dispatch = {}
+        for event, names in self.listening_plugins.items():
+            handlers = []
+            for name in dict.fromkeys(names):  # 去重，插件重复激活时不会被调用多次
+                plugincls = self.plugins.get(name)
+                instance = self.instances.get(name)
+                if plugincls is None or not plugincls.enabled or instance is None or event not in instance.handlers:
+                    continue
+                stat = self.handler_stats.get((name, event))
+                if stat is None:
+                    stat = self.handler_stats[(name, event)] = LatencyStat(window=256)
+                handlers.append((name, instance.handlers[event], stat, self._get_guard(name)))
+            if handlers:
+                dispatch[event] = tuple(handlers)
+        self.dispatch = dispatch
+
+    def _get_guard(self, name):
+        """
+        配置未变化时沿用原来的PluginGuard，保留熔断状态
+        """
+        plugin_conf = self.pconf.get("plugins", {}).get(self.plugins[name].name) or {}
+        options = tuple(plugin_conf.get(key) for key in ("timeout", "pool_size", "max_failures", "cooldown"))
+        guard, old_options = self.guards.get(name, (None, None))
+        if options != old_options:
+            if guard is not None:
+                guard.close()
+            guard = PluginGuard.from_config(name, plugin_conf)
+            self.guards[name] = (guard, options)
+        return guard
 
     def activate_plugins(self):  # 生成新开启的插件实例
         failed_plugins = []
@@ -188,17 +231,43 @@ class PluginManager:
         self.activate_plugins()
 
     def emit_event(self, e_context: EventContext, *args, **kwargs):
-        if e_context.event in self.listening_plugins:
-            for name in self.listening_plugins[e_context.event]:
-                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
-                    instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
-                    if e_context.is_break():
-                        e_context["breaked_by"] = name
-                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        handlers = self.dispatch.get(e_context.event)
+        if not handlers:
+            return e_context
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for name, handler, stat, guard in handlers:
+            if e_context.action != EventAction.CONTINUE:
+                break
+            if debug:
+                logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
+            if guard is not None:
+                # 有耗时预算的插件，超时、熔断时跳过
+                if not guard.call(handler, e_context, stat, *args, **kwargs):
+                    continue
+            else:
+                start = time.perf_counter()
+                try:
+                    handler(e_context, *args, **kwargs)
+                finally:
+                    stat.add(time.perf_counter() - start)
+            if e_context.is_break():
+                e_context["breaked_by"] = name
+                logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
         return e_context
 
+    def guard_metrics(self) -> dict:
+        return {name: guard.metrics() for name, (guard, _) in list(self.guards.items()) if guard is not None}
+
+    def handler_metrics(self) -> dict:
+        """
+        :return: {插件名: {事件名: 耗时统计}}
+        """
+        metrics = {}
+        for (name, event), stat in list(self.handler_stats.items()):
+            if stat.count:
+                metrics.setdefault(name, {})[event.name] = stat.snapshot()
+        return metrics
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
@@ -238,6 +307,7 @@ class PluginManager:
             rawname = self.plugins[name].name
             self.pconf["plugins"][rawname]["enabled"] = False
             self.save_config()
+            self.compile_dispatch()
             return True
         return True
 
@@ -339,6 +409,7 @@ class PluginManager:
             del self.pconf["plugins"][rawname]
             self.loaded[dirname] = None
             self.save_config()
+            self.compile_dispatch()
             return True, "卸载插件成功"
         except Exception as e:
             logger.error("Failed to uninstall plugin, {}".format(e))
@@ -0,0 +1,155 @@
+# encoding:utf-8
+"""
+通道HTTP服务基准测试
+
+分别用不同的http_server启动公众号通道(/wx)和web通道(/message)，并发请求一段时间后统计吞吐和耗时。
+  /wx:      公众号服务器校验请求(GET，校验签名后返回echostr)
+  /message: web通道接收消息的接口(POST)，基准测试时不把消息投递给模型，只统计HTTP处理能力
+
+用法: python scripts/bench_http_server.py --servers simple,cheroot,waitress --concurrency 64 --duration 10
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "bench"
+
+SERVER_CODE = {
+    "wx": """
+import sys
+sys.path.insert(0, {root!r})
+from config import conf, load_config
+load_config()
+conf()["http_server"] = {server!r}
+conf()["wechatmp_port"] = {port}
+conf()["wechatmp_token"] = {token!r}
+from channel.wechatmp.wechatmp_channel import WechatMPChannel
+WechatMPChannel(passive_reply=True).startup()
+""",
+    "message": """
+import sys
+sys.path.insert(0, {root!r})
+from config import conf, load_config
+load_config()
+conf()["http_server"] = {server!r}
+conf()["web_port"] = {port}
+from channel.web.web_channel import WebChannel
+WebChannel.produce = lambda self, context: None  # 只测HTTP处理，不调用模型
+WebChannel().startup()
+""",
+}
+
+
+def wx_request():
+    timestamp, nonce = str(int(time.time())), "123456"
+    signature = hashlib.sha1("".join(sorted([TOKEN, timestamp, nonce])).encode()).hexdigest()
+    params = {"signature": signature, "timestamp": timestamp, "nonce": nonce, "echostr": "hello"}
+    return "GET", "/wx", {"params": params}
+
+
+def message_request():
+    return "POST", "/message", {"json": {"session_id": "bench", "message": "hello"}}
+
+
+REQUESTS = {"wx": wx_request, "message": message_request}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+async def worker(session, base_url, endpoint, deadline, latencies, errors):
+    method, path, kwargs = REQUESTS[endpoint]()
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            async with session.request(method, base_url + path, **kwargs) as res:
+                await res.read()
+                if res.status != 200:
+                    errors.append(res.status)
+                    continue
+        except aiohttp.ClientError as e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.monotonic() - start)
+
+
+async def run_load(base_url, endpoint, concurrency, duration):
+    latencies, errors = [], []
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        deadline = time.monotonic() + duration
+        start = time.monotonic()
+        await asyncio.gather(*[worker(session, base_url, endpoint, deadline, latencies, errors) for _ in range(concurrency)])
+        elapsed = time.monotonic() - start
+    return latencies, errors, elapsed
+
+
+async def wait_ready(proc, base_url, endpoint, timeout=60):
+    method, path, kwargs = REQUESTS[endpoint]()
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError("server exited with code {}".format(proc.returncode))
+            try:
+                async with session.request(method, base_url + path, **kwargs) as res:
+                    if res.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError("server did not start in {}s".format(timeout))
+
+
+def bench(server, endpoint, args):
+    code = SERVER_CODE[endpoint].format(root=ROOT, server=server, port=args.port, token=TOKEN)
+    proc = subprocess.Popen([sys.executable, "-c", code], cwd=ROOT, stdout=subprocess.DEVNULL)
+    base_url = "http://127.0.0.1:{}".format(args.port)
+    try:
+        asyncio.run(wait_ready(proc, base_url, endpoint))
+        latencies, errors, elapsed = asyncio.run(run_load(base_url, endpoint, args.concurrency, args.duration))
+    finally:
+        proc.terminate()
+        proc.wait()
+    if not latencies:
+        print("{:<9} /{:<8} no successful requests, errors={}".format(server, endpoint, len(errors)))
+        return
+    print(
+        "{:<9} /{:<8} {:>8.0f} req/s  p50={:.1f}ms p99={:.1f}ms errors={}".format(
+            server,
+            endpoint,
+            len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+            len(errors),
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", default="simple,cheroot,waitress", help="逗号分隔的http_server")
+    parser.add_argument("--endpoints", default="wx,message", help="逗号分隔的接口: wx,message")
+    parser.add_argument("--concurrency", type=int, default=64, help="并发连接数")
+    parser.add_argument("--duration", type=float, default=10, help="每组测试时长(秒)")
+    parser.add_argument("--port", type=int, default=19890)
+    args = parser.parse_args()
+
+    for endpoint in args.endpoints.split(","):
+        for server in args.servers.split(","):
+            bench(server, endpoint, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# encoding:utf-8
+"""
+ChatChannel 调度延迟基准测试
+
+模拟大量处于活跃状态的会话(已有消息在处理中且还有消息排队)，再向新的会话投递探测消息，
+统计从 produce 到 _handle 开始执行之间的调度延迟。
+
+用法: python scripts/bench_session_scheduler.py --sessions 10000 --probes 2000
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bridge.context import Context, ContextType  # noqa: E402
+from channel.chat_channel import ChatChannel  # noqa: E402
+from common.dequeue import Dequeue  # noqa: E402
+
+
+class BenchChannel(ChatChannel):
+    def __init__(self, expected):
+        self.latencies = []
+        self.expected = expected
+        self.done = threading.Event()
+        super().__init__()
+
+    def _handle(self, context: Context):
+        self.latencies.append(time.perf_counter() - context["enqueue_time"])
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=10000, help="活跃会话数")
+    parser.add_argument("--probes", type=int, default=2000, help="探测消息数")
+    parser.add_argument("--interval", type=float, default=0.001, help="探测消息投递间隔(秒)")
+    args = parser.parse_args()
+
+    channel = BenchChannel(args.probes)
+    # 活跃会话：信号量已被占满(有消息正在处理)，队列中还有待处理的消息
+    with channel.lock:
+        for i in range(args.sessions):
+            semaphore = threading.BoundedSemaphore(1)
+            semaphore.acquire()
+            queue = Dequeue()
+            queue.put(Context(ContextType.TEXT, "busy", {"session_id": "busy-%d" % i, "enqueue_time": 0}))
+            channel.sessions["busy-%d" % i] = [queue, semaphore]
+
+    start = time.perf_counter()
+    for i in range(args.probes):
+        channel.produce(Context(ContextType.TEXT, "probe", {"session_id": "probe-%d" % i, "enqueue_time": time.perf_counter()}))
+        time.sleep(args.interval)
+    channel.done.wait(timeout=60)
+    elapsed = time.perf_counter() - start
+
+    latencies = channel.latencies
+    print("active sessions: {}, probes: {}/{}, elapsed: {:.2f}s".format(args.sessions, len(latencies), args.probes, elapsed))
+    if latencies:
+        print(
+            "dispatch latency p50={:.3f}ms p99={:.3f}ms max={:.3f}ms".format(
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000,
+                max(latencies) * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# encoding:utf-8
+"""
+ChatGPTSession token计数基准测试
+
+模拟一个100轮的会话，每轮与session_query/session_reply一样先后加入问题和回答并调用discard_exceeding，
+对比旧实现(每删除一条消息都重新编码整个历史)和增量计数的耗时及编码消息条数。
+
+用法: python scripts/bench_session_tokens.py --turns 100 --max-tokens 1000 --model gpt-3.5-turbo
+注：tiktoken需要下载编码文件，无法下载时改用按字符计数的模型(wenxin)测试
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot.chatgpt import chat_gpt_session
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, num_tokens_from_messages
+
+QUERY = "请帮我总结一下这段对话里提到的几个关键问题，并给出每个问题的处理建议。"
+REPLY = "好的，这段对话里主要提到了三个问题。第一，会话过长导致每次请求都很慢；第二，重复计算token浪费CPU；第三，历史记录裁剪不够及时。" * 3
+
+
+class FullRecountSession(ChatGPTSession):
+    """
+    旧实现：每次删除消息后都重新计算整个历史的token数
+    """
+
+    def discard_exceeding(self, max_tokens, cur_tokens=None):
+        cur_tokens = self.calc_tokens()
+        while cur_tokens > max_tokens:
+            if len(self.messages) > 2:
+                self.messages.pop(1)
+            elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
+                self.messages.pop(1)
+                cur_tokens = self.calc_tokens()
+                break
+            else:
+                break
+            cur_tokens = self.calc_tokens()
+        return cur_tokens
+
+    def calc_tokens(self):
+        return num_tokens_from_messages(self.messages, self.model)
+
+
+def run(session_cls, args):
+    counter = {"messages": 0}
+    count_message = chat_gpt_session.num_tokens_from_message
+
+    def counting(message, model):
+        counter["messages"] += 1
+        return count_message(message, model)
+
+    chat_gpt_session.num_tokens_from_message = counting
+    try:
+        session = session_cls("bench", system_prompt="You are a helpful assistant.", model=args.model)
+        start = time.perf_counter()
+        for i in range(args.turns):
+            session.add_query("{} ({})".format(QUERY, i))
+            session.discard_exceeding(args.max_tokens)
+            session.add_reply(REPLY)
+            tokens = session.discard_exceeding(args.max_tokens)
+        elapsed = time.perf_counter() - start
+    finally:
+        chat_gpt_session.num_tokens_from_message = count_message
+    return elapsed, counter["messages"], tokens, len(session.messages)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=100, help="对话轮数")
+    parser.add_argument("--max-tokens", type=int, default=1000, help="会话保留的最大token数(conversation_max_tokens)")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    args = parser.parse_args()
+
+    try:
+        chat_gpt_session.get_encoding(args.model)
+    except Exception as e:
+        print("tiktoken encoding unavailable ({}), use model wenxin (count by character)".format(type(e).__name__))
+        args.model = "wenxin"
+
+    print("model: {}, turns: {}, max_tokens: {}".format(args.model, args.turns, args.max_tokens))
+    for name, session_cls in [("full recount", FullRecountSession), ("incremental", ChatGPTSession)]:
+        elapsed, encoded, tokens, messages = run(session_cls, args)
+        print(
+            "{:<13} {:>8.2f}ms  encoded messages: {:>6}  final tokens: {}  messages: {}".format(name, elapsed * 1000, encoded, tokens, messages)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# encoding:utf-8
+"""
+消息触发词匹配基准测试
+
+生成数百个群聊前缀、群聊关键词和画图前缀，按_compose_context的顺序判断群聊消息是否触发，
+对比逐个startswith/find(check_prefix、check_contain)和编译后的TriggerIndex一次扫描的耗时，并校验两者结果一致。
+
+用法: python scripts/bench_trigger_index.py --keywords 500 --messages 20000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from channel.chat_channel import check_contain, check_prefix
+from common.trigger_index import TriggerIndex
+
+CHARS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+
+
+def random_word(rng, min_length, max_length):
+    return "".join(rng.choice(CHARS) for _ in range(rng.randint(min_length, max_length)))
+
+
+def run_linear(triggers, messages):
+    results = []
+    for content in messages:
+        match_prefix = check_prefix(content, triggers["group_chat_prefix"])
+        match_contain = check_contain(content, triggers["group_chat_keyword"])
+        img_match_prefix = check_prefix(content, triggers["image_create_prefix"])
+        results.append((match_prefix, match_contain, img_match_prefix))
+    return results
+
+
+def run_index(index, messages):
+    results = []
+    for content in messages:
+        match = index.match(content, prefix=("group_chat_prefix",), contain=("group_chat_keyword",))
+        img_match_prefix = index.match(content, prefix=("image_create_prefix",))["image_create_prefix"]
+        results.append((match["group_chat_prefix"], match["group_chat_keyword"], img_match_prefix))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keywords", type=int, default=500, help="每类触发词的数量")
+    parser.add_argument("--messages", type=int, default=20000, help="消息数")
+    parser.add_argument("--length", type=int, default=60, help="消息的平均长度")
+    parser.add_argument("--hit-rate", type=float, default=0.1, help="带触发词的消息比例")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    triggers = {
+        "group_chat_prefix": ["@" + random_word(rng, 2, 6) for _ in range(args.keywords)],
+        "group_chat_keyword": [random_word(rng, 3, 6) for _ in range(args.keywords)],
+        "image_create_prefix": [random_word(rng, 1, 3) + "画" for _ in range(args.keywords)],
+    }
+    messages = []
+    for _ in range(args.messages):
+        content = random_word(rng, args.length // 2, args.length * 3 // 2)
+        if rng.random() < args.hit_rate:
+            name = rng.choice(list(triggers))
+            word = rng.choice(triggers[name])
+            content = word + content if name != "group_chat_keyword" else content[: len(content) // 2] + word + content[len(content) // 2 :]
+        messages.append(content)
+
+    start = time.perf_counter()
+    index = TriggerIndex(triggers)
+    compile_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = run_linear(triggers, messages)
+    linear_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = run_index(index, messages)
+    index_time = time.perf_counter() - start
+
+    assert actual == expected, "results differ"
+    print("keywords: {} x {}, messages: {}, states: {}".format(args.keywords, len(triggers), args.messages, len(index.goto)))
+    print("compile       {:>8.2f}ms".format(compile_time * 1000))
+    for name, elapsed in [("linear", linear_time), ("trigger index", index_time)]:
+        print("{:<13} {:>8.2f}ms  {:>6.2f}us/msg".format(name, elapsed * 1000, elapsed * 1e6 / args.messages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# encoding:utf-8
+"""
+web通道空闲连接压测
+
+启动一个web通道服务进程，模拟大量打开着页面但没有对话的浏览器标签页，统计空闲期间服务进程的CPU占用，
+同时定期发送一条消息(POST /message)，统计发送消息的耗时，检查空闲连接是否占满了处理线程。
+  stream:   通过SSE(/stream)等待推送，等待中的连接数达到上限后与页面一样改用轮询
+  longpoll: 长轮询(/poll 带timeout)，等待中的连接数达到上限后按返回的retry_after间隔轮询
+  poll:     旧版页面的忙轮询，每2秒请求一次/poll
+
+用法: python scripts/bench_web_idle_connections.py --tabs 1000 --mode stream --duration 30
+服务端使用配置中的web_server_threads和web_max_waiting_connections，可用--threads指定线程数
+注：CPU和内存从/proc读取，仅支持Linux
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_CODE = """
+import sys
+from queue import Queue
+sys.path.insert(0, {root!r})
+from config import conf, load_config
+load_config()
+conf()["web_port"] = {port}
+if {threads}:
+    conf()["web_server_threads"] = {threads}
+from channel.web.web_channel import WebChannel
+channel = WebChannel()
+for i in range({tabs}):
+    channel.session_queues["bench-%d" % i] = Queue()
+channel.startup()
+"""
+
+
+def proc_stats(pid):
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    status = {}
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            status[key] = value.strip()
+    return cpu_seconds, int(status["Threads"]), status["VmRSS"]
+
+
+async def stream_tab(session, base_url, session_id, stop, counts):
+    while not stop.is_set():
+        try:
+            async with session.get(base_url + "/stream", params={"session_id": session_id}, timeout=aiohttp.ClientTimeout(total=None)) as res:
+                if res.status == 503:
+                    # 等待中的连接数已满，和页面一样改用长轮询
+                    counts["fallback"] += 1
+                    await res.read()
+                    await poll_tab(session, base_url, session_id, stop, 25, 0)
+                    return
+                counts["stream"] += 1
+                async for _ in res.content:
+                    if stop.is_set():
+                        return
+        except aiohttp.ClientError:
+            await asyncio.sleep(1)
+
+
+async def poll_tab(session, base_url, session_id, stop, timeout, interval):
+    while not stop.is_set():
+        try:
+            async with session.post(base_url + "/poll", json={"session_id": session_id, "timeout": timeout}) as res:
+                data = await res.json(content_type=None)
+        except aiohttp.ClientError:
+            await asyncio.sleep(1)
+            continue
+        delay = interval or data.get("retry_after") or 0
+        if delay:
+            await asyncio.sleep(delay)
+
+
+async def message_probe(session, base_url, stop, latencies, interval, timeout):
+    """定期发送一条消息，记录POST /message的耗时，超时记为None"""
+    while not stop.is_set():
+        start = time.monotonic()
+        try:
+            async with session.post(base_url + "/message", json={"session_id": "bench-probe", "message": "ping"}, timeout=aiohttp.ClientTimeout(total=timeout)) as res:
+                await res.read()
+            latencies.append(time.monotonic() - start)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            latencies.append(None)
+        await asyncio.sleep(interval)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run_clients(args, base_url, server):
+    stop = asyncio.Event()
+    counts = {"stream": 0, "fallback": 0}
+    latencies = []
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = []
+        for i in range(args.tabs):
+            session_id = "bench-%d" % i
+            if args.mode == "stream":
+                tasks.append(asyncio.ensure_future(stream_tab(session, base_url, session_id, stop, counts)))
+            elif args.mode == "longpoll":
+                tasks.append(asyncio.ensure_future(poll_tab(session, base_url, session_id, stop, 25, 0)))
+            else:
+                tasks.append(asyncio.ensure_future(poll_tab(session, base_url, session_id, stop, 0, 2)))
+        await asyncio.sleep(args.warmup)
+
+        cpu_start, _, _ = proc_stats(server.pid)
+        start = time.monotonic()
+        probe = asyncio.ensure_future(message_probe(session, base_url, stop, latencies, args.message_interval, args.message_timeout))
+        await asyncio.sleep(args.duration)
+        cpu_end, threads, rss = proc_stats(server.pid)
+        elapsed = time.monotonic() - start
+        tasks.append(probe)
+
+        stop.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    cpu_percent = (cpu_end - cpu_start) / elapsed * 100
+    print("mode: {}, tabs: {}, duration: {:.1f}s".format(args.mode, args.tabs, elapsed))
+    print("server cpu: {:.2f}% ({:.2f}s), threads: {}, rss: {}".format(cpu_percent, cpu_end - cpu_start, threads, rss))
+    if args.mode == "stream":
+        print("stream connections: {}, fell back to polling: {}".format(counts["stream"], counts["fallback"]))
+    ok = [latency for latency in latencies if latency is not None]
+    if ok:
+        print("POST /message: {} sent, {} timed out (>{}s), p50: {:.3f}s, p99: {:.3f}s, max: {:.3f}s".format(
+            len(latencies), len(latencies) - len(ok), args.message_timeout, percentile(ok, 50), percentile(ok, 99), max(ok)))
+    else:
+        print("POST /message: {} sent, all timed out (>{}s)".format(len(latencies), args.message_timeout))
+
+
+async def wait_ready(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(base_url + "/chat") as res:
+                    if res.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError("web channel did not start in {}s".format(timeout))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tabs", type=int, default=1000, help="模拟的浏览器标签页数")
+    parser.add_argument("--mode", choices=["stream", "longpoll", "poll"], default="stream")
+    parser.add_argument("--duration", type=float, default=30, help="统计CPU占用的时长(秒)")
+    parser.add_argument("--warmup", type=float, default=5, help="所有连接建立后等待多久开始统计(秒)")
+    parser.add_argument("--port", type=int, default=19899)
+    parser.add_argument("--threads", type=int, default=0, help="服务端处理线程数，默认使用配置中的web_server_threads")
+    parser.add_argument("--message-interval", type=float, default=1, help="发送消息的间隔(秒)")
+    parser.add_argument("--message-timeout", type=float, default=10, help="发送消息的超时(秒)，与页面一致")
+    args = parser.parse_args()
+
+    code = SERVER_CODE.format(root=ROOT, port=args.port, threads=args.threads, tabs=args.tabs)
+    server = subprocess.Popen([sys.executable, "-c", code], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = "http://127.0.0.1:{}".format(args.port)
+    try:
+        asyncio.run(wait_ready(base_url))
+        asyncio.run(run_clients(args, base_url, server))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()